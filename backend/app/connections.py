@@ -0,0 +1,201 @@
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional, Set, Union
+
+from fastapi import WebSocket
+
+logger = logging.getLogger(__name__)
+
+# 接続ごとの送信待ちメッセージの上限（満杯になるクライアントは切断する）
+OUTBOUND_QUEUE_SIZE = 64
+# 1件の送信にかかる時間の上限（秒）。これを超えたクライアントは切断する
+SEND_TIMEOUT = 5.0
+# キープアライブのPing間隔（秒）と、タイマーホイールの分割数
+KEEPALIVE_INTERVAL = 30.0
+KEEPALIVE_SLOTS = 30
+# 遅いクライアントを切断するときのクローズコード（Try Again Later）
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+Message = Union[str, Dict[str, Any]]
+
+
+class Connection:
+    """1接続分の送信キューと書き込みタスク
+
+    送信はすべてキュー経由で書き込みタスクが行うので、呼び出し側が遅いクライアントに引きずられることはない。
+    """
+
+    def __init__(self, session_id: str, websocket: WebSocket, manager: "ConnectionManager"):
+        self.session_id = session_id
+        self.websocket = websocket
+        self.manager = manager
+        self.outbound: asyncio.Queue = asyncio.Queue(maxsize=OUTBOUND_QUEUE_SIZE)
+        self.closed = False
+        self.sent_messages = 0
+        self._loop = asyncio.get_running_loop()
+        self.last_sent = self._loop.time()
+        self._writer: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._writer = asyncio.create_task(self._write_loop())
+
+    async def send(self, message: Message):
+        """送信キューに積む（満杯なら空くまで待つ。同じ接続の解析結果の順序を保つため）"""
+        if not self.closed:
+            await self.outbound.put(message)
+
+    def send_nowait(self, message: Message) -> bool:
+        """待たずに送信キューに積む（満杯ならFalse）"""
+        if self.closed:
+            return False
+        try:
+            self.outbound.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def close(self, code: int = 1000):
+        if self.closed:
+            return
+        self.closed = True
+        if self._writer is not None and self._writer is not asyncio.current_task():
+            self._writer.cancel()
+            # wait_forの完了とキャンセルが重なるとキャンセルが握りつぶされることがあるので、
+            # 書き込みタスクが受信待ちで止まらないように終了の合図も積んでおく
+            try:
+                self.outbound.put_nowait(None)
+            except asyncio.QueueFull:
+                pass
+            await asyncio.gather(self._writer, return_exceptions=True)
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            # 既に切断されている
+            pass
+
+    async def _write_loop(self):
+        while not self.closed:
+            message = await self.outbound.get()
+            if message is None:
+                return
+            try:
+                if isinstance(message, str):
+                    send = self.websocket.send_text(message)
+                else:
+                    send = self.websocket.send_json(message)
+                await asyncio.wait_for(send, SEND_TIMEOUT)
+                self.sent_messages += 1
+                self.last_sent = self._loop.time()
+            except asyncio.CancelledError:
+                raise
+            except asyncio.TimeoutError:
+                logger.warning("Send timed out, evicting slow consumer %s", self.session_id)
+                await self.manager.evict(self.session_id)
+                return
+            except Exception as e:
+                logger.error("Error while sending message: %s", e)
+
+
+class ConnectionManager:
+    """セッションIDをキーにした接続の管理とブロードキャスト
+
+    キープアライブは接続ごとのタスクではなく、1つのタイマーホイールでまとめて送る。
+    各接続はホイールのスロットに振り分けられ、1周（KEEPALIVE_INTERVAL秒）ごとに1回Pingを送る。
+    直前に他のメッセージを送っていればPingは省略する。
+    """
+
+    def __init__(self, keepalive_interval: float = KEEPALIVE_INTERVAL, keepalive_slots: int = KEEPALIVE_SLOTS):
+        self.active_connections: Dict[str, Connection] = {}
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_slots = keepalive_slots
+        self._wheel: List[Set[str]] = [set() for _ in range(keepalive_slots)]
+        self._slot_of: Dict[str, int] = {}
+        self._cursor = 0
+        self._keepalive_task: Optional[asyncio.Task] = None
+        self.evicted = 0
+
+    def start(self):
+        """キープアライブのタイマーを開始（FastAPIのstartupで呼ぶ）"""
+        if self._keepalive_task is None:
+            self._keepalive_task = asyncio.create_task(self._keepalive_loop())
+
+    async def close(self):
+        if self._keepalive_task is not None:
+            self._keepalive_task.cancel()
+            await asyncio.gather(self._keepalive_task, return_exceptions=True)
+            self._keepalive_task = None
+        for session_id in list(self.active_connections):
+            await self.evict(session_id, code=1001)
+
+    async def connect(self, websocket: WebSocket, session_id: str) -> Connection:
+        await websocket.accept()
+        connection = Connection(session_id, websocket, self)
+        connection.start()
+        self.active_connections[session_id] = connection
+        # 直前のスロットに入れて、ちょうど1周後に最初のPingを送る
+        slot = (self._cursor - 1) % self.keepalive_slots
+        self._wheel[slot].add(session_id)
+        self._slot_of[session_id] = slot
+        # 接続直後に1回送る（従来どおりクライアントが接続を確認できるように）
+        connection.send_nowait("ping")
+        return connection
+
+    async def disconnect(self, session_id: str):
+        connection = self.active_connections.pop(session_id, None)
+        slot = self._slot_of.pop(session_id, None)
+        if slot is not None:
+            self._wheel[slot].discard(session_id)
+        if connection is not None:
+            await connection.close()
+
+    async def evict(self, session_id: str, code: int = SLOW_CONSUMER_CLOSE_CODE):
+        """遅いクライアントを切断する（受信ループ側はWebSocketDisconnectで後片付けする）"""
+        connection = self.active_connections.get(session_id)
+        if connection is None:
+            return
+        self.evicted += 1
+        await connection.close(code=code)
+        await self.disconnect(session_id)
+
+    def get(self, session_id: str) -> Optional[Connection]:
+        return self.active_connections.get(session_id)
+
+    async def send(self, session_id: str, message: Message) -> bool:
+        connection = self.active_connections.get(session_id)
+        if connection is None:
+            return False
+        await connection.send(message)
+        return True
+
+    async def broadcast(self, message: Message, exclude: Optional[str] = None) -> int:
+        """全接続に送信する（待たずに各接続のキューに積み、溢れた接続は切断する）
+
+        送信先の件数を返す。
+        """
+        slow = []
+        delivered = 0
+        for session_id, connection in self.active_connections.items():
+            if session_id == exclude:
+                continue
+            if connection.send_nowait(message):
+                delivered += 1
+            else:
+                slow.append(session_id)
+        if slow:
+            logger.warning("Evicting %s slow consumers during broadcast", len(slow))
+            await asyncio.gather(*(self.evict(session_id) for session_id in slow))
+        return delivered
+
+    async def _keepalive_loop(self):
+        tick = self.keepalive_interval / self.keepalive_slots
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(tick)
+            self._cursor = (self._cursor + 1) % self.keepalive_slots
+            now = loop.time()
+            for session_id in list(self._wheel[self._cursor]):
+                connection = self.active_connections.get(session_id)
+                if connection is None:
+                    continue
+                if now - connection.last_sent >= self.keepalive_interval - tick:
+                    connection.send_nowait("ping")
@@ -0,0 +1,580 @@
+import asyncio
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from collections import Counter, deque
+from contextlib import aclosing
+from dataclasses import asdict, dataclass, field
+from typing import TYPE_CHECKING, Any, AsyncIterator, Callable, Deque, Dict, List, Optional, Tuple
+
+from .logging_config import SAMPLED
+from .metrics import JOB_MEDIA_SECONDS, STAGE_SECONDS
+from .pacer import COMMENT_INTERVAL
+
+if TYPE_CHECKING:
+    import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# ジョブの状態・途中結果・アップロードされたファイルを置くディレクトリ
+JOBS_DIR = os.getenv("JOBS_DIR", "jobs")
+# パスで指定できるファイルはこのディレクトリの中に限る
+JOB_MEDIA_ROOT = os.getenv("JOB_MEDIA_ROOT", "media")
+# メディアをこの長さ（秒）の区間に分け、区間ごとに結果を保存する（再開の単位）
+JOB_CHUNK_SECONDS = float(os.getenv("JOB_CHUNK_SECONDS", "120"))
+# 1ジョブで同時に処理する区間の数（上流の呼び出しはレート制御を通るので、ライブの接続が優先される）
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", "4"))
+# 同時に実行するジョブの数（それ以外は順番待ち）
+JOB_MAX_RUNNING = int(os.getenv("JOB_MAX_RUNNING", "1"))
+# 映像から画面を取り出す間隔（秒）。ライブの画面キャプチャと同じ間隔
+JOB_FRAME_INTERVAL = float(os.getenv("JOB_FRAME_INTERVAL", "2.0"))
+# 取り出す画面の最大幅（解析器が縮小するので、デコードの負荷を抑える）
+JOB_FRAME_MAX_WIDTH = int(os.getenv("JOB_FRAME_MAX_WIDTH", "1280"))
+# 混雑で解析を見送られた画面を再試行する間隔（秒）と回数
+JOB_THROTTLE_DELAY = float(os.getenv("JOB_THROTTLE_DELAY", "2.0"))
+JOB_THROTTLE_RETRIES = int(os.getenv("JOB_THROTTLE_RETRIES", "30"))
+# アップロードできるファイルの上限（バイト）
+JOB_MAX_UPLOAD_BYTES = int(os.getenv("JOB_MAX_UPLOAD_BYTES", str(4 * 1024 * 1024 * 1024)))
+
+SAMPLE_RATE = 16000
+# 音声はこの長さずつ読んでアセンブラーに渡す
+AUDIO_BLOCK_BYTES = SAMPLE_RATE * 2
+READ_SIZE = 64 * 1024
+FFMPEG_STDERR_LIMIT = 1000
+ANALYZERS = ("screen", "camera")
+# 終了していないジョブの状態（プロセスの再起動後はinterruptedとして扱う）
+ACTIVE_STATUSES = ("queued", "running")
+
+
+class JobError(Exception):
+    def __init__(self, message: str, error_type: str):
+        self.message = message
+        self.error_type = error_type
+        super().__init__(self.message)
+
+
+@dataclass
+class Job:
+    """1件のオフライン解析ジョブ（job.jsonにそのまま保存する）"""
+    job_id: str
+    source: str
+    analyzer: str = "screen"
+    audio: bool = True
+    status: str = "queued"
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    error: Optional[Dict[str, str]] = None
+    # ffprobeで調べたメディアの長さと、含まれるストリーム
+    duration: Optional[float] = None
+    has_video: bool = False
+    has_audio: bool = False
+    chunk_seconds: float = JOB_CHUNK_SECONDS
+    frame_interval: float = JOB_FRAME_INTERVAL
+    chunks_total: int = 0
+    chunks_done: List[int] = field(default_factory=list)
+    # 処理し終えたメディアの秒数と、そのためにかかった時間（再開前の分を含む）
+    media_seconds: float = 0.0
+    processing_seconds: float = 0.0
+    # 解析結果の内訳（コメント・書き起こしの件数、変化なし・無音などでスキップした件数）
+    stats: Dict[str, int] = field(default_factory=dict)
+
+    def progress(self) -> Dict[str, Any]:
+        return {
+            "chunks_done": len(self.chunks_done),
+            "chunks_total": self.chunks_total,
+            "ratio": round(len(self.chunks_done) / self.chunks_total, 4) if self.chunks_total else 0.0,
+            "media_seconds": round(self.media_seconds, 1),
+            # 1分間に処理できたメディアの分数
+            "media_minutes_per_minute": (
+                round(self.media_seconds / self.processing_seconds, 2) if self.processing_seconds else None
+            ),
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {**asdict(self), "progress": self.progress()}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Job":
+        data = {key: value for key, value in data.items() if key in cls.__dataclass_fields__}
+        return cls(**data)
+
+
+def chunk_bounds(job: Job, index: int) -> Tuple[float, float]:
+    """区間の開始時刻と長さ"""
+    start = index * job.chunk_seconds
+    return start, min(job.chunk_seconds, job.duration - start)
+
+
+def jpeg_length(buffer: bytearray) -> int:
+    """先頭のJPEG（SOIから始まる）の長さを返す。まだ終わりまで届いていなければ0
+
+    圧縮データの中に0xFFD9と同じ並びが出てもEOIと取り違えないように、マーカーの区切りをたどる。
+    """
+    if buffer[:2] != b"\xff\xd8":
+        raise JobError("画面の切り出し結果がJPEGではありません", "extraction_error")
+    pos = 2
+    while pos + 4 <= len(buffer):
+        if buffer[pos] != 0xFF:
+            raise JobError("画面の切り出し結果のJPEGが壊れています", "extraction_error")
+        marker = buffer[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        pos += 2 + int.from_bytes(buffer[pos + 2:pos + 4], "big")
+        if marker != 0xDA:
+            continue
+        # SOSの後は圧縮データ。0xFF00（バイトスタッフィング）とRSTマーカー以外の0xFFxxまで読み飛ばす
+        while True:
+            pos = buffer.find(b"\xff", pos)
+            if pos < 0 or pos + 1 >= len(buffer):
+                return 0
+            following = buffer[pos + 1]
+            if following == 0x00 or 0xD0 <= following <= 0xD7:
+                pos += 2
+                continue
+            if following == 0xD9:
+                return pos + 2
+            break
+    return 0
+
+
+async def _run_all(coroutines) -> None:
+    """すべて並行して実行し、1つでも失敗したら残りを止めてから送出する"""
+    tasks = [asyncio.create_task(coroutine) for coroutine in coroutines]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def _spawn_ffmpeg(*args: str) -> asyncio.subprocess.Process:
+    try:
+        return await asyncio.create_subprocess_exec(
+            "ffmpeg", "-hide_banner", "-loglevel", "error", "-nostdin", *args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+    except FileNotFoundError:
+        raise JobError("FFmpegが見つかりません", "ffmpeg_not_found")
+
+
+async def _finish_ffmpeg(process: asyncio.subprocess.Process):
+    """出力を読み終えたFFmpegの終了を待つ（途中で中断された場合は止める）"""
+    if process.returncode is None and process.stdout is not None and not process.stdout.at_eof():
+        process.kill()
+        await process.wait()
+        return
+    stderr = await process.stderr.read()
+    await process.wait()
+    if process.returncode != 0:
+        logger.error("FFmpeg error: %s", stderr[-FFMPEG_STDERR_LIMIT:].decode(errors="replace"))
+        raise JobError("メディアの読み込みに失敗しました", "extraction_error")
+
+
+async def probe_media(path: str) -> Tuple[float, bool, bool]:
+    """ffprobeでメディアの長さ（秒）と、映像・音声のストリームがあるかを調べる"""
+    try:
+        process = await asyncio.create_subprocess_exec(
+            "ffprobe", "-v", "error", "-show_entries", "format=duration:stream=codec_type,disposition",
+            "-of", "json", path,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+    except FileNotFoundError:
+        raise JobError("ffprobeが見つかりません", "ffmpeg_not_found")
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        logger.error("ffprobe error: %s", stderr[-FFMPEG_STDERR_LIMIT:].decode(errors="replace"))
+        raise JobError("メディアの情報を読み取れませんでした", "invalid_media")
+    info = json.loads(stdout or b"{}")
+    streams = info.get("streams", [])
+    # カバー画像（attached_pic）は映像として扱わない
+    has_video = any(
+        s.get("codec_type") == "video" and not (s.get("disposition") or {}).get("attached_pic") for s in streams
+    )
+    has_audio = any(s.get("codec_type") == "audio" for s in streams)
+    try:
+        duration = float(info.get("format", {}).get("duration"))
+    except (TypeError, ValueError):
+        raise JobError("メディアの長さが分かりません", "invalid_media")
+    return duration, has_video, has_audio
+
+
+async def extract_frames(
+    path: str, start: float, length: float, interval: float
+) -> AsyncIterator[Tuple[float, bytes]]:
+    """区間の映像からinterval秒ごとの画面をJPEGで取り出す（FFmpegの標準出力から順に読む）"""
+    process = await _spawn_ffmpeg(
+        "-ss", f"{start:.3f}", "-t", f"{length:.3f}", "-i", path,
+        "-an", "-vf", f"fps=1/{interval:g},scale='min({JOB_FRAME_MAX_WIDTH},iw)':-2",
+        "-f", "image2pipe", "-c:v", "mjpeg", "-q:v", "3", "pipe:1",
+    )
+    try:
+        buffer = bytearray()
+        index = 0
+        while True:
+            block = await process.stdout.read(READ_SIZE)
+            if not block:
+                break
+            buffer += block
+            while buffer:
+                size = jpeg_length(buffer)
+                if not size:
+                    break
+                # 読み終えるまでFFmpegは待たされるので、メモリに溜まるのは数枚分だけ
+                yield start + index * interval, bytes(buffer[:size])
+                del buffer[:size]
+                index += 1
+    finally:
+        await _finish_ffmpeg(process)
+
+
+async def extract_pcm(path: str, start: float, length: float) -> AsyncIterator["np.ndarray"]:
+    """区間の音声を16kHzモノラルの16bit PCMにして1秒ずつ返す"""
+    # app.mainのimportを軽く保つため、NumPyは使うときにimportする
+    import numpy as np
+    process = await _spawn_ffmpeg(
+        "-ss", f"{start:.3f}", "-t", f"{length:.3f}", "-i", path,
+        "-vn", "-ar", str(SAMPLE_RATE), "-ac", "1", "-f", "s16le", "pipe:1",
+    )
+    try:
+        while True:
+            try:
+                block = await process.stdout.readexactly(AUDIO_BLOCK_BYTES)
+            except asyncio.IncompleteReadError as e:
+                block = e.partial[:len(e.partial) - len(e.partial) % 2]
+                if block:
+                    yield np.frombuffer(block, dtype="<i2")
+                break
+            yield np.frombuffer(block, dtype="<i2")
+    finally:
+        await _finish_ffmpeg(process)
+
+
+def _comment_entries(t: float, source: str, result: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """解析結果のコメントを、ライブの送信間隔（COMMENT_INTERVAL）で並べたタイムラインの行にする"""
+    entries = []
+    for i, text in enumerate(result.get("comments") or [result["text"]]):
+        entry = {"t": round(t + i * COMMENT_INTERVAL, 3), "source": source, "type": "comment", "text": text}
+        if result.get("fallback"):
+            entry["fallback"] = True
+        entries.append(entry)
+    return entries
+
+
+def _error_type(result: Dict[str, Any]) -> str:
+    """失敗した解析結果の種類（JSONの解析に失敗した結果などerrorを持たないものは"unknown"）"""
+    return (result.get("error") or {}).get("type", "unknown")
+
+
+class JobManager:
+    """録画・録音したメディアからコメントのタイムライン（JSONL）を作るジョブを管理する
+
+    メディアはJOB_CHUNK_SECONDSごとの区間に分け、JOB_CONCURRENCY個の区間を並行して処理する。
+    区間ごとに、FFmpegの標準出力から画面（JOB_FRAME_INTERVAL秒ごと）と音声を順に読み、
+    画面は解析器（ScreenAnalyzer / CameraAnalyzer）の変化検出で重複を除いてから解析し、
+    音声はAudioAssemblerで発話に区切ってAudioServiceで書き起こしとコメント生成を行う。
+
+    区間の結果はchunks/<番号>.jsonlに保存するので、中断したジョブは終わっていない区間から再開できる。
+    すべての区間が終わるとtimeline.jsonlに時刻順にまとめる。
+
+        jobs/<job_id>/job.json        状態・進捗（GET /jobs/<job_id>と同じ内容）
+        jobs/<job_id>/chunks/*.jsonl  区間ごとの結果
+        jobs/<job_id>/timeline.jsonl  {"t": 秒, "source": "screen", "type": "comment", "text": "..."} の行
+    """
+
+    def __init__(
+        self,
+        services,
+        root: str = JOBS_DIR,
+        concurrency: int = JOB_CONCURRENCY,
+        max_running: int = JOB_MAX_RUNNING,
+    ):
+        self.services = services
+        self.root = root
+        self.concurrency = max(1, concurrency)
+        self._running = asyncio.Semaphore(max(1, max_running))
+        self.jobs: Dict[str, Job] = {}
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self._loaded = False
+
+    def _job_dir(self, job_id: str) -> str:
+        return os.path.join(self.root, job_id)
+
+    def _load(self):
+        """保存済みのジョブを読み込む（前回のプロセスで終わらなかったものはinterruptedにする）"""
+        if self._loaded:
+            return
+        self._loaded = True
+        if not os.path.isdir(self.root):
+            return
+        for job_id in os.listdir(self.root):
+            try:
+                with open(os.path.join(self._job_dir(job_id), "job.json")) as f:
+                    job = Job.from_dict(json.load(f))
+            except (OSError, ValueError, TypeError) as e:
+                logger.warning("Skipping job %s: %s", job_id, e)
+                continue
+            if job.status in ACTIVE_STATUSES:
+                job.status = "interrupted"
+            self.jobs.setdefault(job.job_id, job)
+
+    def _save(self, job: Job):
+        path = os.path.join(self._job_dir(job.job_id), "job.json")
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(job.to_dict(), f, ensure_ascii=False)
+        os.replace(f"{path}.tmp", path)
+
+    def list_jobs(self) -> List[Job]:
+        self._load()
+        return sorted(self.jobs.values(), key=lambda job: job.created_at, reverse=True)
+
+    def get(self, job_id: str) -> Job:
+        self._load()
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise JobError(f"ジョブが見つかりません: {job_id}", "not_found")
+        return job
+
+    def timeline_path(self, job_id: str) -> str:
+        job = self.get(job_id)
+        if job.status != "completed":
+            raise JobError(f"ジョブが完了していません（{job.status}）", "not_ready")
+        return os.path.join(self._job_dir(job_id), "timeline.jsonl")
+
+    def _new_job(self, source: str, analyzer: str, audio: bool, job_id: Optional[str] = None) -> Job:
+        if analyzer not in ANALYZERS:
+            raise JobError(f"analyzerは{'/'.join(ANALYZERS)}のいずれかです", "invalid_request")
+        self._load()
+        job = Job(job_id or uuid.uuid4().hex, source, analyzer, audio)
+        os.makedirs(os.path.join(self._job_dir(job.job_id), "chunks"), exist_ok=True)
+        self.jobs[job.job_id] = job
+        return job
+
+    def submit_path(self, path: str, analyzer: str = "screen", audio: bool = True) -> Job:
+        """JOB_MEDIA_ROOT内のファイルを解析するジョブを開始する"""
+        root = os.path.realpath(JOB_MEDIA_ROOT)
+        source = os.path.realpath(os.path.join(root, path))
+        if os.path.commonpath([root, source]) != root:
+            raise JobError(f"{JOB_MEDIA_ROOT}の外のファイルは指定できません", "invalid_path")
+        if not os.path.isfile(source):
+            raise JobError(f"ファイルが見つかりません: {path}", "invalid_path")
+        job = self._new_job(source, analyzer, audio)
+        self._start(job)
+        return job
+
+    async def submit_upload(self, upload, analyzer: str = "screen", audio: bool = True) -> Job:
+        """アップロードされたファイル（UploadFile）をジョブのディレクトリに保存してジョブを開始する"""
+        job_id = uuid.uuid4().hex
+        _, ext = os.path.splitext(upload.filename or "")
+        job = self._new_job(os.path.join(os.path.abspath(self._job_dir(job_id)), f"source{ext}"), analyzer, audio, job_id)
+        size = 0
+        try:
+            # 大きなファイルの書き込みでライブの接続を止めないように、ファイルの操作は別スレッドで行う
+            f = await asyncio.to_thread(open, job.source, "wb")
+            try:
+                while True:
+                    block = await upload.read(1024 * 1024)
+                    if not block:
+                        break
+                    size += len(block)
+                    if size > JOB_MAX_UPLOAD_BYTES:
+                        raise JobError(f"ファイルが大きすぎます（上限 {JOB_MAX_UPLOAD_BYTES} バイト）", "too_large")
+                    await asyncio.to_thread(f.write, block)
+            finally:
+                await asyncio.to_thread(f.close)
+        except JobError:
+            self.jobs.pop(job.job_id, None)
+            await asyncio.to_thread(shutil.rmtree, self._job_dir(job.job_id), ignore_errors=True)
+            raise
+        logger.info("Saved upload for job %s (%s bytes)", job.job_id, size)
+        self._start(job)
+        return job
+
+    def resume(self, job_id: str) -> Job:
+        """中断・失敗したジョブを、終わっていない区間から再開する"""
+        job = self.get(job_id)
+        if job.job_id in self.tasks:
+            raise JobError("ジョブは実行中です", "conflict")
+        if job.status == "completed":
+            raise JobError("ジョブは完了しています", "conflict")
+        job.error = None
+        self._start(job)
+        return job
+
+    async def cancel(self, job_id: str) -> Job:
+        job = self.get(job_id)
+        task = self.tasks.get(job_id)
+        if task is None:
+            raise JobError("ジョブは実行中ではありません", "conflict")
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        job.status = "cancelled"
+        self._save(job)
+        return job
+
+    async def close(self):
+        """実行中のジョブを止める（FastAPIのshutdownで呼ぶ。次回はresumeで続きから再開できる）"""
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _start(self, job: Job):
+        job.status = "queued"
+        self._save(job)
+        task = asyncio.create_task(self._run(job))
+        self.tasks[job.job_id] = task
+        task.add_done_callback(lambda _: self.tasks.pop(job.job_id, None))
+
+    async def _run(self, job: Job):
+        async with self._running:
+            job.status = "running"
+            self._save(job)
+            try:
+                await self.services.ensure_ready()
+                if job.duration is None:
+                    job.duration, job.has_video, job.has_audio = await probe_media(job.source)
+                    job.chunks_total = max(1, int(-(-job.duration // job.chunk_seconds)))
+                    logger.info(
+                        "Job %s: %.1fs, video=%s, audio=%s, %d chunks",
+                        job.job_id, job.duration, job.has_video, job.has_audio, job.chunks_total,
+                    )
+                if not job.has_video and not (job.audio and job.has_audio):
+                    raise JobError("解析できる映像・音声がありません", "invalid_media")
+                done = set(job.chunks_done)
+                pending = deque(index for index in range(job.chunks_total) if index not in done)
+                # 処理時間は再開前の分に今回の経過時間を足す
+                base, run_started = job.processing_seconds, time.perf_counter()
+                await _run_all(
+                    self._lane(job, pending, lambda: base + time.perf_counter() - run_started)
+                    for _ in range(min(self.concurrency, len(pending)))
+                )
+                self._write_timeline(job)
+                job.status = "completed"
+                job.finished_at = time.time()
+                progress = job.progress()
+                logger.info(
+                    "Job %s completed: %ss of media, %s media-min/min, %s",
+                    job.job_id, progress["media_seconds"], progress["media_minutes_per_minute"], job.stats,
+                )
+            except asyncio.CancelledError:
+                job.status = "interrupted"
+                raise
+            except JobError as e:
+                logger.error("Job %s failed: %s", job.job_id, e.message)
+                job.status = "failed"
+                job.error = {"type": e.error_type, "message": e.message}
+            except Exception as e:
+                logger.error("Job %s failed: %s", job.job_id, e)
+                job.status = "failed"
+                job.error = {"type": "processing_error", "message": str(e)}
+            finally:
+                self._save(job)
+
+    async def _lane(self, job: Job, pending: Deque[int], processing_seconds: Callable[[], float]):
+        """空いている区間を順に処理する（JOB_CONCURRENCY個を並行して動かす）"""
+        while pending:
+            index = pending.popleft()
+            started = time.perf_counter()
+            stats: Counter = Counter()
+            with STAGE_SECONDS.time("job_chunk"):
+                entries = await self._process_chunk(job, index, stats)
+            elapsed = time.perf_counter() - started
+            self._write_chunk(job, index, entries)
+            _, length = chunk_bounds(job, index)
+            job.chunks_done.append(index)
+            job.media_seconds += length
+            job.processing_seconds = processing_seconds()
+            job.stats = dict(Counter(job.stats) + stats)
+            JOB_MEDIA_SECONDS.inc(amount=length)
+            self._save(job)
+            logger.info(
+                "Job %s chunk %d/%d done in %.1fs (%d entries)",
+                job.job_id, index + 1, job.chunks_total, elapsed, len(entries), extra=SAMPLED,
+            )
+
+    async def _process_chunk(self, job: Job, index: int, stats: Counter) -> List[Dict[str, Any]]:
+        start, length = chunk_bounds(job, index)
+        entries: List[Dict[str, Any]] = []
+        work = []
+        if job.has_video:
+            work.append(self._analyze_frames(job, start, length, entries, stats))
+        if job.audio and job.has_audio:
+            work.append(self._analyze_audio(job, start, length, entries, stats))
+        await _run_all(work)
+        entries.sort(key=lambda entry: entry["t"])
+        return entries
+
+    async def _analyze_frames(self, job: Job, start: float, length: float, entries: list, stats: Counter):
+        analyzer = getattr(self.services, f"{job.analyzer}_analyzer")
+        # 区間ごとに状態を持つ（変化検出は区間内の直前の画面と比べる）
+        state = analyzer.new_state()
+        state.session_id = job.job_id
+        async with aclosing(extract_frames(job.source, start, length, job.frame_interval)) as frames:
+            async for t, frame in frames:
+                for _ in range(JOB_THROTTLE_RETRIES + 1):
+                    # 間引きはメディアの時刻（frame_interval）で済んでいるので、実時間の最小間隔は使わない
+                    state.last_analysis_time = 0.0
+                    result = await analyzer.analyze_frame(frame, state)
+                    if result["success"] or _error_type(result) != "throttled":
+                        break
+                    # ライブの接続を優先し、混雑が収まるまで待つ
+                    await asyncio.sleep(JOB_THROTTLE_DELAY)
+                if result["success"]:
+                    entries.extend(_comment_entries(t, job.analyzer, result))
+                    stats["comments"] += len(result.get("comments") or [result["text"]])
+                else:
+                    stats[_error_type(result)] += 1
+
+    async def _analyze_audio(self, job: Job, start: float, length: float, entries: list, stats: Counter):
+        from .services.audio_assembler import AudioAssembler
+        audio_service = self.services.audio_service
+        vad_config = audio_service.vad_config
+        assembler = AudioAssembler()
+
+        async def transcribe(utterances, t: float):
+            for utterance in utterances:
+                transcription = await audio_service.transcribe(
+                    utterance, vad_config, session_id=job.job_id, assembler=assembler,
+                )
+                if not transcription["success"]:
+                    stats[_error_type(transcription)] += 1
+                    continue
+                entries.append({"t": round(t, 3), "source": "audio", "type": "transcript", "text": transcription["text"]})
+                stats["transcripts"] += 1
+                result = await audio_service.generate_response(transcription["text"], session_id=job.job_id)
+                if result["success"]:
+                    entries.extend(_comment_entries(t, "audio", result))
+                    stats["comments"] += len(result.get("comments") or [result["text"]])
+                else:
+                    stats[_error_type(result)] += 1
+
+        async with aclosing(extract_pcm(job.source, start, length)) as blocks:
+            async for pcm in blocks:
+                # 発話は区切られた時点（発話の終わり）の時刻に置く
+                await transcribe(assembler.push(pcm, vad_config), start + assembler.position / SAMPLE_RATE)
+        await transcribe(assembler.flush(vad_config), start + assembler.position / SAMPLE_RATE)
+
+    def _write_chunk(self, job: Job, index: int, entries: List[Dict[str, Any]]):
+        # 書き終えてから名前を付けるので、存在する区間のファイルは常に完全
+        path = os.path.join(self._job_dir(job.job_id), "chunks", f"{index:05d}.jsonl")
+        with open(f"{path}.tmp", "w") as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        os.replace(f"{path}.tmp", path)
+
+    def _write_timeline(self, job: Job):
+        """区間の結果を区間の順につなげる（区間内は時刻順に並べてある）"""
+        job_dir = self._job_dir(job.job_id)
+        path = os.path.join(job_dir, "timeline.jsonl")
+        with open(f"{path}.tmp", "w") as out:
+            for index in range(job.chunks_total):
+                with open(os.path.join(job_dir, "chunks", f"{index:05d}.jsonl")) as f:
+                    shutil.copyfileobj(f, out)
+        os.replace(f"{path}.tmp", path)
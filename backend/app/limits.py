@@ -0,0 +1,54 @@
+import os
+from typing import Dict, Optional
+
+from .metrics import registry
+
+# 1件あたりのペイロードの上限（バイト）。超えたデータはキューに積む前に断る
+MAX_FRAME_BYTES: Dict[str, int] = {
+    "screen": int(os.getenv("MAX_SCREEN_FRAME_BYTES", str(8 * 1024 * 1024))),
+    "camera": int(os.getenv("MAX_CAMERA_FRAME_BYTES", str(4 * 1024 * 1024))),
+    "audio": int(os.getenv("MAX_AUDIO_SEGMENT_BYTES", str(2 * 1024 * 1024))),
+}
+# 封筒のヘッダーを読む前に断るメッセージの大きさ（どのモダリティの上限より大きいもの）
+MAX_MESSAGE_BYTES = max(MAX_FRAME_BYTES.values()) + 64
+# 1接続が受け付けてまだ処理し終えていないデータの合計の上限
+SESSION_INFLIGHT_BYTES = int(os.getenv("SESSION_INFLIGHT_BYTES", str(16 * 1024 * 1024)))
+# プロセス全体（全接続の合計）の上限。同時に多数の配信者が送ってきてもメモリ使用量が読めるようにする
+WORKER_INFLIGHT_BYTES = int(os.getenv("WORKER_INFLIGHT_BYTES", str(256 * 1024 * 1024)))
+
+
+class ByteBudget:
+    """処理中のデータの合計バイト数の上限（parentを渡すと親の上限にも同時に数える）
+
+    イベントループからのみ呼ばれるのでロックは持たない。
+    """
+
+    def __init__(self, limit: int, parent: Optional["ByteBudget"] = None):
+        self.limit = limit
+        self.parent = parent
+        self.used = 0
+
+    def try_acquire(self, size: int) -> bool:
+        if self.used + size > self.limit:
+            return False
+        if self.parent is not None and not self.parent.try_acquire(size):
+            return False
+        self.used += size
+        return True
+
+    def release(self, size: int):
+        size = min(size, self.used)
+        self.used -= size
+        if self.parent is not None:
+            self.parent.release(size)
+
+    def close(self):
+        """残っている分をすべて親に返す（接続の終了時）"""
+        self.release(self.used)
+
+
+worker_budget = ByteBudget(WORKER_INFLIGHT_BYTES)
+
+registry.gauge(
+    "inflight_bytes", "Received payload bytes queued or being processed", callback=lambda: {(): worker_budget.used}
+)
@@ -0,0 +1,162 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .metrics import LOG_RECORDS
+
+# ログの出力レベルと形式（json: 1行1件のJSON / text: 従来どおりの行形式）
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+# フレームごとに出るログ（extra=SAMPLED）は呼び出し箇所ごとにN件に1件だけ出力する（1なら間引かない）
+LOG_SAMPLE_EVERY = int(os.getenv("LOG_SAMPLE_EVERY", "50"))
+# 同じ箇所からのWARNING以上は、LOG_RATE_WINDOW秒あたりLOG_RATE_BURST件までにする
+LOG_RATE_BURST = int(os.getenv("LOG_RATE_BURST", "5"))
+LOG_RATE_WINDOW = float(os.getenv("LOG_RATE_WINDOW", "10"))
+# 書き込みスレッドに渡すまでに溜めるログの上限（満杯なら捨てる）
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+# フレームごとに出るログに付ける（logger.info("...", extra=SAMPLED)）
+SAMPLED = {"sampled": True}
+
+# LogRecordが標準で持つ属性（これ以外はextraで渡された項目としてJSONに含める）
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "sampled"}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """1件を1行のJSONにする（extraで渡された項目もそのまま含める）"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """extra=SAMPLEDのログを呼び出し箇所ごとにevery件に1件だけ通す（通したログにはsample_everyを付ける）"""
+
+    def __init__(self, every: int = LOG_SAMPLE_EVERY):
+        super().__init__()
+        self.every = max(1, every)
+        self.counts: Dict[Tuple[str, int], int] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.every == 1 or not getattr(record, "sampled", False):
+            return True
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            count = self.counts.get(key, 0)
+            self.counts[key] = count + 1
+        if count % self.every:
+            LOG_RECORDS.inc("sampled_out")
+            return False
+        record.sample_every = self.every
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """同じ呼び出し箇所から繰り返し出るWARNING以上のログを、window秒あたりburst件までにする
+
+    抑制した件数は、次の区間で最初に通したログにsuppressedとして付ける。
+    """
+
+    def __init__(
+        self,
+        burst: int = LOG_RATE_BURST,
+        window: float = LOG_RATE_WINDOW,
+        clock=time.monotonic,
+    ):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self.clock = clock
+        # 呼び出し箇所ごとの [区間の開始時刻, 区間内の件数, 抑制した件数]
+        self.sites: Dict[Tuple[str, int], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING or self.burst <= 0:
+            return True
+        key = (record.pathname, record.lineno)
+        now = self.clock()
+        with self._lock:
+            site = self.sites.get(key)
+            if site is None or now - site[0] >= self.window:
+                suppressed = int(site[2]) if site else 0
+                self.sites[key] = [now, 1, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+                return True
+            if site[1] < self.burst:
+                site[1] += 1
+                return True
+            site[2] += 1
+        LOG_RECORDS.inc("rate_limited")
+        return False
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """ログをキューに積むだけのハンドラー（整形と書き込みはQueueListenerのスレッドで行う）"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 標準のQueueHandlerは積む前にメッセージを整形するが、同じプロセス内で渡すのでそのまま積む
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # イベントループを止めないように、書き込みが追いつかないときは捨てる
+            LOG_RECORDS.inc("dropped")
+
+
+def configure_logging(level: str = LOG_LEVEL, log_format: str = LOG_FORMAT):
+    """ルートロガーにキュー経由のハンドラーを設定し、書き込みスレッドを開始する（エントリーポイントで1回呼ぶ）"""
+    global _listener
+    if _listener is not None:
+        return
+    output = logging.StreamHandler(sys.stderr)
+    if log_format == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter("%(levelname)s:%(name)s:%(message)s"))
+
+    handler = NonBlockingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    handler.addFilter(SamplingFilter())
+    handler.addFilter(RateLimitFilter())
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(handler.queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """キューに残っているログを書き出して書き込みスレッドを止める"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
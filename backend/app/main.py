@@ -1,16 +1,26 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from dotenv import load_dotenv
+
+# .envの読み込みはアプリ内のモジュールをimportする前に行う（各モジュールはimport時に環境変数から設定を読む）
+load_dotenv()
+
+from fastapi import FastAPI, File, Form, UploadFile, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from .services.audio_service import AudioService
-from .services.screen_analyzer import ScreenAnalyzer
-from .services.camera_analyzer import CameraAnalyzer
-import tempfile
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
+from pydantic import BaseModel
+from .connections import ConnectionManager
+from .jobs import JobError, JobManager
+from .logging_config import SAMPLED, configure_logging, stop_logging
+from .recorder import SessionRecorder
+from .registry import ServiceRegistry
+from .metrics import registry as metrics_registry
 import logging
 import asyncio
 
 app = FastAPI()
-audio_service = AudioService()
-screen_analyzer = ScreenAnalyzer()
-camera_analyzer = CameraAnalyzer()
+# 解析サービスは初回利用時かstartup後のウォームアップで作成する（cv2・NumPy・openaiのimportもそこで行う）
+services = ServiceRegistry()
+# 録画・録音したメディアのオフライン解析（同じサービスを使い、上流のレート制御もライブの接続と共有する）
+jobs = JobManager(services)
 logger = logging.getLogger(__name__)
 
 app.add_middleware(
@@ -21,38 +31,172 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: list[WebSocket] = []
+@app.on_event("startup")
+async def startup_event():
+    # ログの設定はサーバーの起動時に1回だけ行う（app.mainのimportでは行わない）
+    # ログはキューに積むだけにして、整形と書き込みは別スレッドで行う
+    configure_logging()
+    # 全接続で共有するキープアライブのタイマーを開始
+    manager.start()
+    # サービスの作成・OpenAIクライアントの接続プール・画像コーデックの初期化はバックグラウンドで行う
+    services.start_warm_up()
 
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
+@app.on_event("shutdown")
+async def shutdown_event():
+    # 接続と実行中のジョブ（次回は続きから再開できる）を閉じ、画像前処理用のプールとOpenAIクライアントを停止
+    await manager.close()
+    await jobs.close()
+    await services.close()
+    # キューに残っているログを書き出す
+    stop_logging()
 
-    async def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+manager = ConnectionManager()
 
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            await connection.send_text(message)
+# スクレイプ時に現在値を取得するメトリクス
+metrics_registry.gauge(
+    "active_connections", "Open websocket connections",
+    callback=lambda: {(): len(manager.active_connections)},
+)
+# （サービスがまだ作成されていなければ出力しない）
+def _result_cache_stats():
+    cache = services.peek("result_cache")
+    return {(stat,): value for stat, value in cache.stats().items()} if cache else {}
 
-    async def ping(self, websocket: WebSocket):
-        while True:
-            try:
-                await websocket.send_text("ping")  # Pingメッセージを送信
-                await asyncio.sleep(30)  # 30秒ごとにPingを送信
-            except Exception as e:
-                logger.error(f"Error while sending ping: {str(e)}")
-                break
 
-manager = ConnectionManager()
+def _governor_stats():
+    governor = services.peek("rate_governor")
+    if governor is None:
+        return {}
+    return {
+        ("pressure",): governor.pressure(),
+        ("inflight",): governor.inflight,
+        ("waiting",): len(governor.waiters),
+        ("rate",): governor.rate,
+    }
+
+
+def _circuit_states():
+    guard = services.peek("upstream_guard")
+    if guard is None:
+        return {}
+    from .services.upstream_guard import STATE_VALUES
+    return {(model,): STATE_VALUES[state] for model, state in guard.states().items()}
+
+
+metrics_registry.gauge(
+    "result_cache", "Result cache entries and hit/miss/eviction counts", ("stat",), callback=_result_cache_stats,
+)
+metrics_registry.gauge("upstream_governor", "Upstream rate governor state", ("stat",), callback=_governor_stats)
+metrics_registry.gauge(
+    "circuit_state", "Circuit breaker state per upstream model (0=closed, 1=half_open, 2=open)", ("model",),
+    callback=_circuit_states,
+)
+metrics_registry.gauge(
+    "ready", "Whether warm-up has finished and the worker accepts sessions",
+    callback=lambda: {(): float(services.is_ready())},
+)
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus形式のメトリクス"""
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/healthz")
+async def healthz():
+    """プロセスが応答できるか（ウォームアップの完了は問わない）"""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    """ウォームアップの各段階の状態。必須の段階がすべて完了していれば200、それ以外は503"""
+    status = services.status()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+# ジョブのエラーの種類とHTTPステータス（それ以外は400）
+JOB_ERROR_STATUS = {"not_found": 404, "conflict": 409, "not_ready": 409, "too_large": 413}
+
+
+def _job_error(e: JobError) -> JSONResponse:
+    return JSONResponse(
+        {"error": {"type": e.error_type, "message": e.message}}, status_code=JOB_ERROR_STATUS.get(e.error_type, 400)
+    )
+
+
+class JobRequest(BaseModel):
+    # JOB_MEDIA_ROOTからの相対パス
+    path: str
+    analyzer: str = "screen"
+    audio: bool = True
+
+@app.post("/jobs")
+async def create_job(request: JobRequest):
+    """サーバー上のメディアファイルからコメントのタイムラインを作るジョブを開始"""
+    try:
+        job = jobs.submit_path(request.path, request.analyzer, request.audio)
+    except JobError as e:
+        return _job_error(e)
+    return JSONResponse(job.to_dict(), status_code=202)
+
+@app.post("/jobs/upload")
+async def upload_job(file: UploadFile = File(...), analyzer: str = Form("screen"), audio: bool = Form(True)):
+    """アップロードしたメディアファイルからコメントのタイムラインを作るジョブを開始"""
+    try:
+        job = await jobs.submit_upload(file, analyzer, audio)
+    except JobError as e:
+        return _job_error(e)
+    return JSONResponse(job.to_dict(), status_code=202)
+
+@app.get("/jobs")
+async def list_jobs():
+    return {"jobs": [job.to_dict() for job in jobs.list_jobs()]}
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """状態と進捗（処理した区間の数・メディアの秒数・1分あたりに処理したメディアの分数）"""
+    try:
+        return jobs.get(job_id).to_dict()
+    except JobError as e:
+        return _job_error(e)
+
+@app.get("/jobs/{job_id}/timeline")
+async def get_job_timeline(job_id: str):
+    """完了したジョブのタイムライン（1行1件のJSON）"""
+    try:
+        return FileResponse(jobs.timeline_path(job_id), media_type="application/x-ndjson")
+    except JobError as e:
+        return _job_error(e)
+
+@app.post("/jobs/{job_id}/resume")
+async def resume_job(job_id: str):
+    """中断・失敗したジョブを、終わっていない区間から再開"""
+    try:
+        return JSONResponse(jobs.resume(job_id).to_dict(), status_code=202)
+    except JobError as e:
+        return _job_error(e)
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    try:
+        return (await jobs.cancel(job_id)).to_dict()
+    except JobError as e:
+        return _job_error(e)
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    await manager.connect(websocket)
-
-    # Pingメッセージを送信するタスクを開始
-    ping_task = asyncio.create_task(manager.ping(websocket))
+    # ウォームアップ前に届いた接続は完了を待つ（サービスを作成できなかった場合は接続を断る）
+    try:
+        await services.ensure_ready()
+    except Exception as e:
+        logger.error("Service unavailable: %s", e)
+        await websocket.close(code=1011)
+        return
+    # 接続ごとの状態と解析パイプラインを開始（解析器は共有し、状態はセッションごとに持つ）
+    session = services.new_session()
+    # 送信は接続ごとのキューと書き込みタスクが行う（Pingは共有のタイマーから送られる）
+    connection = await manager.connect(websocket, session.session_id)
+    # SESSION_RECORD_DIRを設定した場合は受信データを記録する（bench/replay.pyで再生できる）
+    pipeline = services.new_pipeline(connection, session, recorder=SessionRecorder.for_session(session.session_id))
+    pipeline.start()
 
     try:
         while True:
@@ -61,79 +205,39 @@ async def websocket_endpoint(websocket: WebSocket):
 
                 if "bytes" in message:
                     data = message["bytes"]
-                    logger.info(f"Received binary data of size: {len(data)} bytes")
-                    
-                    # データの先頭バイトをチェックしてタイプを判別
-                    if data[:3].startswith(b"\xff\xd8\xff"):  # JPEG format
-                        # カメラ映像の解析
-                        result = await camera_analyzer.analyze_frame(data)
-                        if result["success"]:
-                            await websocket.send_json({
-                                "type": "message",
-                                "text": result["text"]  # ここでコメントを送信
-                            })
-                        else:
-                            await websocket.send_json({
-                                "type": "error",
-                                "error": result["error"]
-                            })
-                    elif data[:4].startswith(b"\x1a\x45\xdf\xa3"):  # WebM format
-                        # 音声処理
-                        with tempfile.NamedTemporaryFile(suffix=".webm", delete=False) as temp_file:
-                            temp_file.write(data)
-                            temp_file.seek(0)
-                            
-                            result = await audio_service.transcribe_audio(temp_file)
-                            
-                            if result["success"]:
-                                await websocket.send_json({
-                                    "type": "message",
-                                    "text": result["text"]  # ここでもコメントを送信
-                                })
-                            else:
-                                logger.error(f"Processing error: {result['error']}")
-                                await websocket.send_json({
-                                    "type": "error",
-                                    "error": result["error"]
-                                })
-                    elif data[:4].startswith(b"\x89PNG"):  # PNG format
-                        # 画面キャプチャ処理
-                        result = await screen_analyzer.analyze_frame(data)
-                        if not result["success"]:
-                            logger.error(f"Screen analysis error: {result['error']}")
-                            await websocket.send_json({
-                                "type": "error",
-                                "error": result["error"]
-                            })
-                        else:
-                            await websocket.send_json({
-                                "type": "message",
-                                "text": result['text']  # コメントを送信
-                            })
+                    logger.info("Received binary data of size: %d bytes", len(data), extra=SAMPLED)
+
+                    # 解析はワーカーに任せ、受信ループはキューに積むだけにする
+                    if not await pipeline.submit(data):
+                        logger.warning("Unknown binary format: %s", data[:4].hex())
                 elif "text" in message:
-                    logger.info(f"Received text message: {message['text']}")
+                    if not pipeline.handle_text(message["text"]):
+                        logger.info("Received text message: %.200s", message["text"], extra=SAMPLED)
                 else:
                     if message.get("type") == "websocket.disconnect":
                         logger.info("Client initiated disconnect")
                         break
                     else:
-                        logger.warning(f"Unexpected message format: {message}")
+                        logger.warning("Unexpected message format: %s", message.get("type"))
                         continue
 
             except WebSocketDisconnect:
                 logger.info("Client disconnected")
                 break
             except Exception as e:
-                logger.error(f"Error processing message: {str(e)}")
-                await websocket.send_json({
+                if connection.closed:
+                    # 送信が詰まったクライアントとしてサーバー側から切断した
+                    break
+                logger.error("Error processing message: %s", e)
+                await connection.send({
                     "type": "error",
                     #"error": {"type": "processing_error", "message": "メッセージの処理中にエラーが発生しました"}
                 })
                 continue
 
     except Exception as e:
-        logger.error(f"Unexpected error: {str(e)}")
+        logger.error("Unexpected error: %s", e)
     finally:
         logger.info("Cleaning up websocket connection")
-        await manager.disconnect(websocket) 
-        ping_task.cancel()  # Pingタスクをキャンセル
+        await pipeline.close()
+        await manager.disconnect(session.session_id)
@@ -0,0 +1,206 @@
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# 本番でも常時有効にできるよう、記録は辞書の更新と二分探索だけで済ませる
+# （イベントループ上からのみ更新するのでロックは取らない）
+
+METRIC_PREFIX = "stream_companion_"
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        self.name = METRIC_PREFIX + name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Gauge:
+    """現在値を表すメトリクス。callbackを渡すとスクレイプ時に値を取得する"""
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: Tuple[str, ...] = (),
+        callback: Optional[Callable[[], Dict[LabelValues, float]]] = None,
+    ):
+        self.name = METRIC_PREFIX + name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.callback = callback
+        self.values: Dict[LabelValues, float] = {}
+
+    def set(self, value: float, *labels: str):
+        self.values[labels] = value
+
+    def render(self) -> List[str]:
+        values = self.callback() if self.callback is not None else self.values
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        for labels, value in values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class _HistogramData:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self, num_buckets: int):
+        self.counts = [0] * (num_buckets + 1)
+        self.total = 0.0
+        self.count = 0
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram: "Histogram", labels: LabelValues):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+        return False
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        self.name = METRIC_PREFIX + name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.values: Dict[LabelValues, _HistogramData] = {}
+
+    def observe(self, value: float, *labels: str):
+        data = self.values.get(labels)
+        if data is None:
+            data = self.values[labels] = _HistogramData(len(self.buckets))
+        data.counts[bisect_left(self.buckets, value)] += 1
+        data.total += value
+        data.count += 1
+
+    def time(self, *labels: str) -> _Timer:
+        """withブロックの実行時間を記録する"""
+        return _Timer(self, labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, data in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), data.counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(data.total)}")
+            lines.append(f"{self.name}_count{label_text} {data.count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, help_text, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: Tuple[str, ...] = (),
+        callback: Optional[Callable[[], Dict[LabelValues, float]]] = None,
+    ) -> Gauge:
+        metric = Gauge(name, help_text, labelnames, callback)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        metric = Histogram(name, help_text, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Prometheusのテキスト形式で出力"""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+# 処理段階ごとの所要時間（画像のデコード・エンコード、Vision/コメント/Whisper呼び出し、ffmpegなど）
+STAGE_SECONDS = registry.histogram("stage_duration_seconds", "Duration of each processing stage", ("stage",))
+# 受信・破棄・スキップしたフレーム（音声セグメントを含む）
+FRAMES_RECEIVED = registry.counter("frames_received_total", "Binary frames received", ("modality",))
+FRAMES_DROPPED = registry.counter("frames_dropped_total", "Stale frames replaced by a newer one", ("modality",))
+FRAMES_SKIPPED = registry.counter(
+    "frames_skipped_total", "Frames not sent upstream (throttled, unchanged, no speech)", ("modality", "reason")
+)
+UPSTREAM_ERRORS = registry.counter("upstream_errors_total", "Errors raised by upstream API calls", ("type",))
+# キャプチャ時刻（封筒付きのデータのみ）から結果を送信するまでの時間
+CAPTURE_TO_RESULT = registry.histogram(
+    "capture_to_result_seconds", "Time from client capture to result sent", ("modality",)
+)
+# 生成したコメントの行き先（released: 送信 / superseded: 場面が変わって破棄 / expired: 古くなって破棄 / duplicate: 直前と重複）
+COMMENTS = registry.counter("comments_total", "Generated comments by outcome", ("source", "outcome"))
+# コメントが生成されてから送信されるまでの待ち時間
+COMMENT_POOL_WAIT = registry.histogram("comment_pool_wait_seconds", "Time a comment waited in the pool", ("source",))
+# 上流を使えずにローカルのコメント集から返した件数（reason: circuit_open / 締め切り超過 / エラーの種類）
+FALLBACK_COMMENTS = registry.counter("fallback_comments_total", "Results served from the local comment bank", ("source", "reason"))
+# つなげた音声から区切った発話（pause: 無音 / max_length: 長さの上限 / idle_flush: 受信が途切れた / noise: 短すぎて破棄 / coalesced: 前の発話とまとめた）
+AUDIO_UTTERANCES = registry.counter("audio_utterances_total", "Utterances cut from assembled session audio", ("reason",))
+# 出力しなかったログ（sampled_out: 間引き / rate_limited: 繰り返しのエラーを抑制 / dropped: 書き込みが追いつかずに破棄）
+LOG_RECORDS = registry.counter("log_records_suppressed_total", "Log records not written", ("reason",))
+# オフライン解析ジョブで処理し終えたメディアの長さ（rate()が1分あたりに処理できたメディアの分数になる）
+JOB_MEDIA_SECONDS = registry.counter("job_media_seconds_total", "Media seconds processed by offline analysis jobs")
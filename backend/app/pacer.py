@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import os
+import random
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+
+from .metrics import COMMENT_POOL_WAIT, COMMENTS
+
+logger = logging.getLogger(__name__)
+
+# コメントを一定の間隔で送るかどうか（falseなら生成されたコメントをすぐにすべて送る）
+COMMENT_PACING = os.getenv("COMMENT_PACING", "true").lower() == "true"
+# コメントを送る平均間隔（秒）と、そのゆらぎ（間隔に対する割合）
+COMMENT_INTERVAL = float(os.getenv("COMMENT_INTERVAL", "1.5"))
+COMMENT_JITTER = float(os.getenv("COMMENT_JITTER", "0.5"))
+# 生成からこの秒数以上経ったコメントは送らずに捨てる
+COMMENT_POOL_TTL = float(os.getenv("COMMENT_POOL_TTL", "12"))
+# 発生源ごとに溜めておくコメントの上限
+POOL_SIZE_PER_SOURCE = 8
+# 発生源ごとの優先度（小さいほど先に送る。配信者の発言への反応を優先する）
+SOURCE_PRIORITY = {"audio": 0, "window": 0, "screen": 1, "camera": 1}
+# 直近に送ったコメントと同じものは送らない
+RECENT_RELEASED_SIZE = 20
+
+
+@dataclass
+class PooledComment:
+    source: str
+    text: str
+    created_at: float
+    sequence: Optional[int] = None
+
+
+class CommentPacer:
+    """1セッション分のコメントの送信タイミングを調整する
+
+    上流の1回の呼び出しで生成された複数のコメントを発生源（screen / camera / audio / window）ごとに溜め、
+    平均interval秒・ゆらぎ付きの間隔で1件ずつ送る。しばらく送っていなければ最初の1件はすぐに送る。
+    同じ発生源から新しいコメントが届いたら場面が変わったとみなし、溜まっている古いコメントは捨てる。
+    """
+
+    def __init__(
+        self,
+        send: Callable[[Dict[str, Any]], Awaitable[None]],
+        interval: float = COMMENT_INTERVAL,
+        jitter: float = COMMENT_JITTER,
+        ttl: float = COMMENT_POOL_TTL,
+        rng: Optional[random.Random] = None,
+    ):
+        self.send = send
+        self.interval = interval
+        self.jitter = jitter
+        self.ttl = ttl
+        self.rng = rng or random.Random()
+        self.pools: Dict[str, Deque[PooledComment]] = {}
+        self.recent: Deque[str] = deque(maxlen=RECENT_RELEASED_SIZE)
+        self._loop = asyncio.get_running_loop()
+        self._next_release = 0.0
+        self._wakeup = asyncio.Event()
+
+    def pending(self) -> int:
+        return sum(len(pool) for pool in self.pools.values())
+
+    def offer(self, source: str, comments: List[str], sequence: Optional[int] = None) -> int:
+        """新しいコメントを溜める（同じ発生源の古いコメントは置き換える）。溜めた件数を返す"""
+        self.invalidate(source)
+        now = self._loop.time()
+        pool: Deque[PooledComment] = deque(maxlen=POOL_SIZE_PER_SOURCE)
+        for text in comments:
+            if text in self.recent or any(item.text == text for item in pool):
+                COMMENTS.inc(source, "duplicate")
+                continue
+            pool.append(PooledComment(source, text, now, sequence))
+        if pool:
+            self.pools[source] = pool
+            self._wakeup.set()
+        return len(pool)
+
+    def invalidate(self, source: str):
+        """場面が変わったので、発生源の未送信のコメントを捨てる"""
+        pool = self.pools.pop(source, None)
+        if pool:
+            COMMENTS.inc(source, "superseded", amount=len(pool))
+            logger.debug("Dropped %d pooled %s comments", len(pool), source)
+
+    async def run(self):
+        while True:
+            now = self._loop.time()
+            self._expire(now)
+            if not self.pending():
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            if now < self._next_release:
+                await asyncio.sleep(self._next_release - now)
+                continue
+
+            comment = self._pop()
+            self.recent.append(comment.text)
+            COMMENTS.inc(comment.source, "released")
+            COMMENT_POOL_WAIT.observe(now - comment.created_at, comment.source)
+            message = {"type": "message", "text": comment.text}
+            if comment.sequence is not None:
+                message["seq"] = comment.sequence
+            await self.send(message)
+            self._next_release = self._loop.time() + self._next_delay()
+
+    def _next_delay(self) -> float:
+        return self.interval * (1 + self.rng.uniform(-self.jitter, self.jitter))
+
+    def _expire(self, now: float):
+        for source in list(self.pools):
+            pool = self.pools[source]
+            while pool and now - pool[0].created_at > self.ttl:
+                pool.popleft()
+                COMMENTS.inc(source, "expired")
+            if not pool:
+                del self.pools[source]
+
+    def _pop(self) -> PooledComment:
+        # 優先度が高く、溜まってから長い発生源から1件取り出す
+        source = min(
+            self.pools,
+            key=lambda name: (SOURCE_PRIORITY.get(name, 1), self.pools[name][0].created_at),
+        )
+        pool = self.pools[source]
+        comment = pool.popleft()
+        if not pool:
+            del self.pools[source]
+        return comment
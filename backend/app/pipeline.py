@@ -0,0 +1,552 @@
+import asyncio
+import itertools
+import json
+import logging
+import time
+import weakref
+from collections import deque
+from dataclasses import replace
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from .connections import Connection
+from .limits import MAX_FRAME_BYTES, MAX_MESSAGE_BYTES, SESSION_INFLIGHT_BYTES, ByteBudget, worker_budget
+from .metrics import CAPTURE_TO_RESULT, FRAMES_DROPPED, FRAMES_RECEIVED, FRAMES_SKIPPED, STAGE_SECONDS, registry
+from .pacer import COMMENT_PACING, CommentPacer
+from .protocol import Frame, ProtocolError, parse_frame
+from .recorder import SessionRecorder
+from .services.audio_assembler import ASSEMBLY_IDLE_FLUSH, ASSEMBLY_IDLE_FLUSH_FACTOR
+from .services.rate_governor import RateGovernor
+from .session import AnalyzerState, SessionState
+
+logger = logging.getLogger(__name__)
+
+# 音声は取りこぼさないように余裕を持たせる（満杯時は受信ループ側で待機）
+AUDIO_QUEUE_SIZE = 32
+# クライアントに通知しない解析結果（間引き・変化なしによるスキップ）
+SILENT_ERROR_TYPES = {"too_frequent", "unchanged", "no_speech", "throttled", "duplicate_transcript"}
+# フロントエンドのキャプチャ間隔（ミリ秒）の基準値と、混雑度を確認する間隔（秒）
+BASE_CAPTURE_INTERVALS = {"screen": 2000, "camera": 3000}
+CONTROL_CHECK_INTERVAL = 2.0
+# 混雑度に応じてキャプチャ間隔を何倍に延ばすか（混雑度の下限, 倍率）
+CAPTURE_INTERVAL_STEPS = ((0.9, 4.0), (0.75, 3.0), (0.5, 2.0), (0.25, 1.5))
+# キャプチャからこの秒数以上経った画面・カメラのフレームは解析せずに捨てる（音声は捨てない）
+STALE_FRAME_SECONDS = 10.0
+# windowedモードで1区間にまとめる書き起こしの上限
+WINDOW_MAX_TRANSCRIPTS = 8
+
+
+def is_silent(result: Dict[str, Any]) -> bool:
+    return not result["success"] and (result.get("error") or {}).get("type") in SILENT_ERROR_TYPES
+
+
+# メトリクスのキュー長を集計するため、稼働中のパイプラインを弱参照で保持する
+_active_pipelines: "weakref.WeakSet[SessionPipeline]" = weakref.WeakSet()
+
+
+def _queue_depths() -> Dict[tuple, float]:
+    depths = {("screen",): 0, ("camera",): 0, ("audio",): 0, ("outbound",): 0, ("comment_pool",): 0}
+    for pipeline in list(_active_pipelines):
+        depths[("screen",)] += pipeline.screen_queue.qsize()
+        depths[("camera",)] += pipeline.camera_queue.qsize()
+        depths[("audio",)] += pipeline.audio_queue.qsize()
+        depths[("outbound",)] += pipeline.outbound.qsize()
+        if pipeline.pacer is not None:
+            depths[("comment_pool",)] += pipeline.pacer.pending()
+    return depths
+
+
+registry.gauge("queue_depth", "Items waiting in per-session queues", ("queue",), callback=_queue_depths)
+
+
+def capture_interval_factor(pressure: float) -> float:
+    for lower_bound, factor in CAPTURE_INTERVAL_STEPS:
+        if pressure >= lower_bound:
+            return factor
+    return 1.0
+
+
+def result_to_message(
+    result: Dict[str, Any],
+    message_id: Optional[str] = None,
+    sequence: Optional[int] = None,
+) -> Dict[str, Any]:
+    """サービスの解析結果をWebSocket送信用のメッセージに変換
+
+    ストリーミング時は先に送ったdeltaと対応付けるためにidを付ける。
+    封筒付きで受信したデータの結果には、元データのシーケンス番号をseqとして付ける。
+    """
+    if result.get("success"):
+        message = {"type": "message", "text": result["text"]}
+    else:
+        message = {"type": "error", "error": result.get("error")}
+    if message_id is not None:
+        message["id"] = message_id
+        message["final"] = True
+    if sequence is not None:
+        message["seq"] = sequence
+    return message
+
+
+class SessionPipeline:
+    """1接続分の解析パイプライン
+
+    受信ループはデータをキューに積むだけで、解析はモダリティごとのワーカーが行う。
+    画面・カメラは最新フレームのみを保持し、古いフレームは破棄する。
+    音声セグメントは破棄せず順番に処理する。結果の送信は接続の送信キューに積む。
+
+    window_analyzerを渡すとwindowedモードになり、音声は書き起こしのみ行い、
+    window_seconds秒ごとに最新の画面・カメラと書き起こしをまとめて1回で解析する。
+
+    解析結果には複数のコメントが含まれる。pacingが有効ならコメントはCommentPacerに溜め、
+    上流の応答のタイミングに関係なく一定の間隔で1件ずつ送る。
+
+    recorderを渡すと、受信したバイナリ・テキストをそのまま記録する（bench/replay.pyで再生できる）。
+
+    受信データはモダリティごとの上限（MAX_FRAME_BYTES）を超えたら断り、キューに積んでから処理し終えるまでの
+    合計をセッションとプロセス全体の上限（ByteBudget）で数える。上限に達している間に届いたデータは捨てる。
+    """
+
+    def __init__(
+        self,
+        connection: Connection,
+        session: SessionState,
+        audio_service,
+        screen_analyzer,
+        camera_analyzer,
+        governor: RateGovernor,
+        window_analyzer=None,
+        window_seconds: float = 4.0,
+        pacing: bool = COMMENT_PACING,
+        recorder: Optional[SessionRecorder] = None,
+    ):
+        self.connection = connection
+        self.session = session
+        self.governor = governor
+        self.audio_service = audio_service
+        self.screen_analyzer = screen_analyzer
+        self.camera_analyzer = camera_analyzer
+        self.window_analyzer = window_analyzer
+        self.window_seconds = window_seconds
+        # windowedモードで次の区間に含める (書き起こし, 元の音声データ)
+        self.window_transcripts: Deque[Tuple[str, Optional[Frame]]] = deque(maxlen=WINDOW_MAX_TRANSCRIPTS)
+
+        self.screen_queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+        self.camera_queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+        self.audio_queue: asyncio.Queue = asyncio.Queue(maxsize=AUDIO_QUEUE_SIZE)
+        # 送信キューは接続と共有する
+        self.outbound: asyncio.Queue = connection.outbound
+        self.pacer: Optional[CommentPacer] = CommentPacer(connection.send) if pacing else None
+        self.recorder = recorder
+        # キューに積んでから処理し終えるまでのペイロードの合計
+        self.budget = ByteBudget(SESSION_INFLIGHT_BYTES, parent=worker_budget)
+
+        self._message_ids = itertools.count(1)
+        self.capture_interval_factor = 1.0
+        self.dropped_frames = {"screen": 0, "camera": 0}
+        # モダリティごとの (ストリームID, 最後に受け付けたシーケンス番号)
+        self.last_sequence: Dict[str, tuple] = {}
+        # クライアントとサーバーの時計のずれ（受信時刻 - キャプチャ時刻の最小値, ミリ秒）
+        self.clock_offset: Optional[float] = None
+        # 音声セグメントを最後に受信した時刻と、その前のセグメントからの間隔（イベントループの時計, 秒）
+        self.last_segment_at: Optional[float] = None
+        self.segment_interval: Optional[float] = None
+        self.tasks: list[asyncio.Task] = []
+
+    def start(self):
+        _active_pipelines.add(self)
+        if self.window_analyzer is not None:
+            workers = [self._window_worker(), self._transcript_worker()]
+        else:
+            workers = [
+                self._frame_worker("screen", self.screen_queue, self.screen_analyzer, self.session.screen),
+                self._frame_worker("camera", self.camera_queue, self.camera_analyzer, self.session.camera),
+                self._audio_worker(),
+            ]
+        workers.append(self._control_loop())
+        if self.pacer is not None:
+            workers.append(self.pacer.run())
+        self.tasks = [asyncio.create_task(worker) for worker in workers]
+
+    async def submit(self, data: bytes) -> bool:
+        """受信データを該当するキューに積む（判別できないデータはクライアントにエラーを返してFalse）"""
+        if len(data) > MAX_MESSAGE_BYTES:
+            # どのモダリティでも受け付けない大きさなので、ヘッダーも読まずに断る
+            FRAMES_RECEIVED.inc("oversized")
+            await self._reject("frame_too_large", f"データが大きすぎます（上限 {MAX_MESSAGE_BYTES} バイト）")
+            return True
+        try:
+            frame = parse_frame(data)
+        except ProtocolError as e:
+            self._record(data, "unknown")
+            FRAMES_RECEIVED.inc("invalid")
+            await self._reject("invalid_envelope", str(e))
+            return False
+        self._record(data, frame.modality if frame else "unknown")
+        if frame is None:
+            FRAMES_RECEIVED.inc("unknown")
+            await self._reject("unsupported_format", "対応していないデータ形式です")
+            return False
+
+        FRAMES_RECEIVED.inc(frame.modality)
+        size = len(frame.payload)
+        if size > MAX_FRAME_BYTES[frame.modality]:
+            FRAMES_SKIPPED.inc(frame.modality, "too_large")
+            await self._reject(
+                "frame_too_large", f"{frame.modality}のデータが大きすぎます（上限 {MAX_FRAME_BYTES[frame.modality]} バイト）"
+            )
+            return True
+        if frame.sequence is not None:
+            if not self._accept_sequence(frame):
+                FRAMES_SKIPPED.inc(frame.modality, "out_of_order")
+                return True
+            offset = frame.received_at * 1000 - frame.captured_at
+            self.clock_offset = offset if self.clock_offset is None else min(self.clock_offset, offset)
+
+        if frame.modality == "screen":
+            self._put_latest("screen", self.screen_queue, frame)
+        elif frame.modality == "camera":
+            self._put_latest("camera", self.camera_queue, frame)
+        else:
+            self._observe_segment()
+            if self._acquire(frame):
+                await self.audio_queue.put(frame)
+        return True
+
+    def handle_text(self, text: str) -> bool:
+        """テキストメッセージを処理（設定メッセージ以外はFalse）
+
+        例: {"type": "config", "stream": true, "vad": {"enabled": true, "hangover_ms": 400}}
+        """
+        self._record(text.encode("utf-8"), "text")
+        if not text.startswith("{"):
+            return False
+        try:
+            message = json.loads(text)
+        except json.JSONDecodeError:
+            logger.warning("Invalid JSON text message: %s", text[:100])
+            return False
+        if not isinstance(message, dict) or message.get("type") != "config":
+            return False
+
+        if "stream" in message:
+            self.session.streaming = bool(message["stream"])
+            logger.info("Streaming mode: %s", self.session.streaming)
+        if isinstance(message.get("vad"), dict):
+            try:
+                self.session.vad_config = self.session.vad_config.with_overrides(message["vad"])
+                logger.info("VAD config updated: %s", self.session.vad_config)
+            except (TypeError, ValueError) as e:
+                logger.warning("Invalid VAD config: %s", e)
+        return True
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        if self.recorder is not None:
+            # 受信は終わっているので、タスクの終了を待つ前に記録を閉じる
+            self.recorder.close()
+            self.recorder = None
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        # キューに残っている分もまとめてプロセス全体の上限に返す
+        self.budget.close()
+        self.window_transcripts.clear()
+        _active_pipelines.discard(self)
+        self.session.release()
+
+    def _acquire(self, frame: Frame) -> bool:
+        """処理中のデータの上限に数える（上限を超えるならスキップとして数えてFalse）"""
+        if self.budget.try_acquire(len(frame.payload)):
+            return True
+        FRAMES_SKIPPED.inc(frame.modality, "inflight_limit")
+        logger.warning(
+            "In-flight limit reached, dropping %s frame (%d bytes, session %d / worker %d bytes in flight)",
+            frame.modality, len(frame.payload), self.budget.used, worker_budget.used,
+        )
+        return False
+
+    def _release(self, frame: Optional[Frame]):
+        if frame is not None:
+            self.budget.release(len(frame.payload))
+
+    def _record(self, data: bytes, kind: str):
+        if self.recorder is not None:
+            self.recorder.append(data, kind)
+
+    def _delta_emitter(self, modality: str, sequence: Optional[int] = None):
+        """ストリーミング有効時にdeltaを送信するコールバックとメッセージIDを作る"""
+        if not self.session.streaming:
+            return None, None
+        message_id = f"{modality}-{next(self._message_ids)}"
+
+        async def emit(delta: str):
+            message = {"type": "delta", "id": message_id, "text": delta}
+            if sequence is not None:
+                message["seq"] = sequence
+            await self.connection.send(message)
+
+        return message_id, emit
+
+    async def _deliver(
+        self,
+        source: str,
+        result: Dict[str, Any],
+        message_id: Optional[str] = None,
+        sequence: Optional[int] = None,
+    ):
+        """成功した解析結果のコメントを送る（ペーサーがあれば溜めて間隔を空けて送る）"""
+        comments = result.get("comments") or [result["text"]]
+        if message_id is not None:
+            # ストリーミングで送り始めた1件目はそのまま確定させる
+            await self.connection.send(result_to_message({**result, "text": comments[0]}, message_id, sequence))
+            comments = comments[1:]
+        if self.pacer is not None:
+            self.pacer.offer(source, comments, sequence)
+            return
+        for text in comments:
+            await self.connection.send(result_to_message({"success": True, "text": text}, sequence=sequence))
+
+    def _skip(self, source: str, result: Dict[str, Any]):
+        error_type = result["error"]["type"]
+        FRAMES_SKIPPED.inc(source, error_type)
+        # 変化はあったが混雑で解析を見送った場合、溜まっているコメントはもう場面に合わない
+        if error_type == "throttled" and self.pacer is not None:
+            self.pacer.invalidate(source)
+
+    async def _reject(self, error_type: str, message: str):
+        await self.connection.send({"type": "error", "error": {"type": error_type, "message": message}})
+
+    def _accept_sequence(self, frame: Frame) -> bool:
+        """同じストリーム内でシーケンス番号が戻ったデータ（遅れて届いたもの）は受け付けない"""
+        last = self.last_sequence.get(frame.modality)
+        if last is not None and last[0] == frame.stream_id and frame.sequence <= last[1]:
+            return False
+        self.last_sequence[frame.modality] = (frame.stream_id, frame.sequence)
+        return True
+
+    def _age(self, frame: Frame) -> Optional[float]:
+        """キャプチャからの経過秒数（クライアントの時計のずれを補正する。分からなければNone）"""
+        if frame.captured_at is None or self.clock_offset is None:
+            return None
+        return (time.time() * 1000 - frame.captured_at - self.clock_offset) / 1000
+
+    def _is_stale(self, frame: Frame) -> bool:
+        age = self._age(frame)
+        return age is not None and age > STALE_FRAME_SECONDS
+
+    def _observe_segment(self):
+        now = asyncio.get_running_loop().time()
+        if self.last_segment_at is not None:
+            self.segment_interval = now - self.last_segment_at
+        self.last_segment_at = now
+
+    def _idle_flush_timeout(self) -> float:
+        """次のセグメントを待つ時間（これを過ぎたら区切りを待たずに溜まっている発話を書き起こす）"""
+        if self.segment_interval is None:
+            return ASSEMBLY_IDLE_FLUSH
+        return max(ASSEMBLY_IDLE_FLUSH, self.segment_interval * ASSEMBLY_IDLE_FLUSH_FACTOR)
+
+    def _observe_latency(self, frame: Frame):
+        """キャプチャから結果を送るまでの時間を記録"""
+        age = self._age(frame)
+        if age is not None:
+            CAPTURE_TO_RESULT.observe(max(0.0, age), frame.modality)
+
+    def _put_latest(self, modality: str, queue: asyncio.Queue, frame: Frame):
+        # 未処理の古いフレームは捨てて最新のフレームで置き換える
+        if queue.full():
+            try:
+                self._release(queue.get_nowait())
+                self.dropped_frames[modality] += 1
+                FRAMES_DROPPED.inc(modality)
+                logger.debug("Dropped stale %s frame (total: %d)", modality, self.dropped_frames[modality])
+            except asyncio.QueueEmpty:
+                pass
+        if self._acquire(frame):
+            queue.put_nowait(frame)
+
+    async def _frame_worker(self, modality: str, queue: asyncio.Queue, analyzer, state: AnalyzerState):
+        while True:
+            frame = await queue.get()
+            try:
+                if self._is_stale(frame):
+                    FRAMES_SKIPPED.inc(modality, "stale")
+                    continue
+                message_id, on_delta = self._delta_emitter(modality, frame.sequence)
+                with STAGE_SECONDS.time(f"{modality}_analyze_frame"):
+                    result = await analyzer.analyze_frame(frame.payload, state, on_delta=on_delta)
+                if is_silent(result):
+                    self._skip(modality, result)
+                    continue
+                if not result["success"]:
+                    logger.error("%s analysis error: %s", modality, result.get('error'))
+                    await self.connection.send(result_to_message(result, message_id, frame.sequence))
+                    continue
+                self._observe_latency(frame)
+                await self._deliver(modality, result, message_id, frame.sequence)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Error processing %s frame: %s", modality, e)
+                await self.connection.send({"type": "error"})
+            finally:
+                self._release(frame)
+
+    async def _next_audio(self) -> Tuple[Optional[Frame], list]:
+        """次に書き起こす音声（受信したセグメント、または発話ごとに区切ったPCM）と、元のセグメントを返す
+
+        セッションの音声をつなげる場合、セグメントが届くまでに区切りの付いた発話がなければ空のリストを返す。
+        次のセグメントがしばらく届かなければ、区切りを待たずに溜まっている発話を返す（元のセグメントはNone）。
+        """
+        assembler = self.session.audio
+        if assembler is None or not self.session.vad_config.enabled:
+            frame = await self.audio_queue.get()
+            return frame, [frame.payload]
+        try:
+            frame = await asyncio.wait_for(self.audio_queue.get(), self._idle_flush_timeout())
+        except asyncio.TimeoutError:
+            return None, assembler.flush(self.session.vad_config)
+        try:
+            utterances = await self.audio_service.assemble(frame.payload, assembler, self.session.vad_config)
+        except Exception as e:
+            logger.error("Error assembling audio segment: %s", e)
+            utterances = []
+        # デコードしたPCMはアセンブラーが持つので、受信したセグメントはここで手放す
+        self._release(frame)
+        frame = replace(frame, payload=b"")
+        if not utterances:
+            FRAMES_SKIPPED.inc("audio", "assembling")
+        return frame, utterances
+
+    async def _audio_worker(self):
+        while True:
+            frame, segments = await self._next_audio()
+            sequence = frame.sequence if frame else None
+            for segment in segments:
+                try:
+                    message_id, on_delta = self._delta_emitter("audio", sequence)
+                    with STAGE_SECONDS.time("transcribe_audio"):
+                        result = await self.audio_service.transcribe_audio(
+                            segment, self.session.vad_config, on_delta=on_delta,
+                            session_id=self.session.session_id, assembler=self.session.audio,
+                        )
+                    if is_silent(result):
+                        self._skip("audio", result)
+                        continue
+                    if not result["success"]:
+                        logger.error("Processing error: %s", result['error'])
+                        await self.connection.send(result_to_message(result, message_id, sequence))
+                        continue
+                    if frame is not None:
+                        self._observe_latency(frame)
+                    await self._deliver("audio", result, message_id, sequence)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error("Error processing audio segment: %s", e)
+                    await self.connection.send({"type": "error"})
+            self._release(frame)
+
+    async def _transcript_worker(self):
+        """windowedモード: 音声は書き起こしだけ行い、次の区間にまとめる"""
+        while True:
+            frame, segments = await self._next_audio()
+            for segment in segments:
+                try:
+                    with STAGE_SECONDS.time("transcribe_only"):
+                        result = await self.audio_service.transcribe(
+                            segment, self.session.vad_config, session_id=self.session.session_id,
+                            assembler=self.session.audio,
+                        )
+                    if is_silent(result):
+                        FRAMES_SKIPPED.inc("audio", result["error"]["type"])
+                        continue
+                    if not result["success"] and result["error"]["type"] == "upstream_unavailable":
+                        # 上流の障害中は書き起こしなしで区間を解析する
+                        FRAMES_SKIPPED.inc("audio", "upstream_unavailable")
+                        continue
+                    if not result["success"]:
+                        logger.error("Transcription error: %s", result['error'])
+                        await self.connection.send(result_to_message(result, sequence=frame.sequence if frame else None))
+                        continue
+                    # 区間の解析では遅延の計測にしか使わないので、ペイロードは持たない
+                    self.window_transcripts.append((result["text"], frame and replace(frame, payload=b"")))
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error("Error processing audio segment: %s", e)
+                    await self.connection.send({"type": "error"})
+            self._release(frame)
+
+    def _take_latest(self, queue: asyncio.Queue) -> Optional[Frame]:
+        try:
+            frame = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return None
+        if self._is_stale(frame):
+            FRAMES_SKIPPED.inc(frame.modality, "stale")
+            self._release(frame)
+            return None
+        return frame
+
+    async def _window_worker(self):
+        """windowedモード: 区間ごとに最新の画面・カメラと書き起こしをまとめて解析する"""
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time() + self.window_seconds
+        while True:
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
+            next_tick = max(next_tick + self.window_seconds, loop.time())
+            screen = camera = None
+            try:
+                screen = self._take_latest(self.screen_queue)
+                camera = self._take_latest(self.camera_queue)
+                transcripts = list(self.window_transcripts)
+                self.window_transcripts.clear()
+                if screen is None and camera is None and not transcripts:
+                    continue
+
+                message_id, on_delta = self._delta_emitter("window")
+                with STAGE_SECONDS.time("window_analyze"):
+                    result = await self.window_analyzer.analyze_window(
+                        screen.payload if screen else None,
+                        camera.payload if camera else None,
+                        [text for text, _ in transcripts],
+                        self.session,
+                        on_delta=on_delta,
+                    )
+                if is_silent(result):
+                    self._skip("window", result)
+                    continue
+                if not result["success"]:
+                    logger.error("Window analysis error: %s", result.get('error'))
+                    await self.connection.send(result_to_message(result, message_id))
+                    continue
+                for frame in [screen, camera] + [frame for _, frame in transcripts]:
+                    if frame is not None:
+                        self._observe_latency(frame)
+                await self._deliver("window", result, message_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Error processing window: %s", e)
+                await self.connection.send({"type": "error"})
+            finally:
+                self._release(screen)
+                self._release(camera)
+
+    async def _control_loop(self):
+        """上流の混雑度に応じてクライアントにキャプチャ間隔の変更を指示する"""
+        while True:
+            await asyncio.sleep(CONTROL_CHECK_INTERVAL)
+            pressure = self.governor.pressure()
+            factor = capture_interval_factor(pressure)
+            if factor == self.capture_interval_factor:
+                continue
+            self.capture_interval_factor = factor
+            logger.info("Capture interval factor changed to %s (pressure=%.2f)", factor, pressure)
+            await self.connection.send({
+                "type": "control",
+                "action": "capture_interval",
+                "screen_interval_ms": int(BASE_CAPTURE_INTERVALS["screen"] * factor),
+                "camera_interval_ms": int(BASE_CAPTURE_INTERVALS["camera"] * factor),
+            })
@@ -0,0 +1,114 @@
+import struct
+import time
+from dataclasses import dataclass, field
+from typing import Optional, Union
+
+# クライアントから送られるバイナリデータの封筒（ヘッダー + ペイロード）
+#
+#   offset  size  内容
+#   0       2     マジック b"SC"
+#   2       1     バージョン（1）
+#   3       1     モダリティ（1: screen / 2: camera / 3: audio）
+#   4       1     コーデック（1: png / 2: jpeg / 3: webp / 4: webm）
+#   5       1     フラグ（予約）
+#   6       2     ストリームID（キャプチャを開始するたびにクライアントが振り直す）
+#   8       4     シーケンス番号（ストリーム内で単調増加）
+#   12      8     キャプチャ時刻（UNIXエポックからのミリ秒, float64）
+#   20      -     ペイロード
+#
+# 数値はすべてビッグエンディアン。マジックはJPEG/PNG/WebM/WebPの先頭バイトと重ならない。
+# ヘッダーのないデータは従来どおり先頭バイトから種類を判別する。
+
+ENVELOPE_MAGIC = b"SC"
+ENVELOPE_VERSION = 1
+_HEADER = struct.Struct(">2sBBBBHId")
+HEADER_SIZE = _HEADER.size
+
+MODALITIES = {1: "screen", 2: "camera", 3: "audio"}
+CODECS = {1: "png", 2: "jpeg", 3: "webp", 4: "webm"}
+_MODALITY_IDS = {name: value for value, name in MODALITIES.items()}
+_CODEC_IDS = {name: value for value, name in CODECS.items()}
+
+
+class ProtocolError(ValueError):
+    """封筒のヘッダーが不正"""
+
+
+@dataclass
+class Frame:
+    """受信した1件のデータ（封筒なしの場合はシーケンス番号・キャプチャ時刻がNone）
+
+    封筒付きの場合、payloadは受信したメッセージのヘッダー以降を指すmemoryview（コピーしない）。
+    """
+    modality: str
+    codec: str
+    payload: Union[bytes, memoryview]
+    stream_id: int = 0
+    sequence: Optional[int] = None
+    captured_at: Optional[float] = None
+    received_at: float = field(default_factory=time.time)
+
+
+def sniff_codec(data: bytes) -> Optional[str]:
+    """先頭バイトからコーデックを判別"""
+    if data[:3] == b"\xff\xd8\xff":
+        return "jpeg"
+    if data[:4] == b"\x1a\x45\xdf\xa3":
+        return "webm"
+    if data[:4] == b"\x89PNG":
+        return "png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+# 封筒なしのデータはコーデックからモダリティを決める（従来の取り決め: JPEGはカメラ、PNGは画面）
+_LEGACY_MODALITIES = {"jpeg": "camera", "webm": "audio", "png": "screen", "webp": "screen"}
+
+
+def detect_modality(data: bytes) -> Optional[str]:
+    """先頭バイトからデータの種類を判別"""
+    codec = sniff_codec(data)
+    return _LEGACY_MODALITIES.get(codec) if codec else None
+
+
+def encode_envelope(
+    modality: str,
+    codec: str,
+    payload: bytes,
+    stream_id: int = 0,
+    sequence: int = 0,
+    captured_at: Optional[float] = None,
+) -> bytes:
+    """封筒付きのデータを作る（ベンチマーク・テスト用クライアント向け）"""
+    if captured_at is None:
+        captured_at = time.time() * 1000
+    header = _HEADER.pack(
+        ENVELOPE_MAGIC, ENVELOPE_VERSION, _MODALITY_IDS[modality], _CODEC_IDS[codec], 0,
+        stream_id, sequence, captured_at,
+    )
+    return header + payload
+
+
+def parse_frame(data: bytes) -> Optional[Frame]:
+    """受信データを解釈する。封筒があればヘッダーを読み、なければ先頭バイトから判別する
+
+    判別できないデータはNone、封筒のヘッダーが不正な場合はProtocolErrorを送出する。
+    """
+    if data[:2] == ENVELOPE_MAGIC:
+        if len(data) < HEADER_SIZE:
+            raise ProtocolError(f"Envelope too short: {len(data)} bytes")
+        _, version, modality_id, codec_id, _, stream_id, sequence, captured_at = _HEADER.unpack_from(data)
+        if version != ENVELOPE_VERSION:
+            raise ProtocolError(f"Unsupported envelope version: {version}")
+        modality = MODALITIES.get(modality_id)
+        codec = CODECS.get(codec_id)
+        if modality is None or codec is None:
+            raise ProtocolError(f"Unknown modality/codec: {modality_id}/{codec_id}")
+        # ペイロードは受信したメッセージをそのまま参照する（画像1枚分のコピーを作らない）
+        return Frame(modality, codec, memoryview(data)[HEADER_SIZE:], stream_id, sequence, captured_at)
+
+    codec = sniff_codec(data)
+    if codec is None:
+        return None
+    return Frame(_LEGACY_MODALITIES[codec], codec, data)
@@ -0,0 +1,199 @@
+import logging
+import mmap
+import os
+import struct
+import time
+from dataclasses import dataclass
+from typing import BinaryIO, Iterator, Optional
+
+from .protocol import MODALITIES
+
+logger = logging.getLogger(__name__)
+
+# 受信データを記録するディレクトリ（未設定なら記録しない）
+SESSION_RECORD_DIR = os.getenv("SESSION_RECORD_DIR")
+# 1セッションで記録するデータの上限（バイト）。超えたらそのセッションの記録をやめる
+SESSION_RECORD_MAX_BYTES = int(os.getenv("SESSION_RECORD_MAX_BYTES", str(512 * 1024 * 1024)))
+
+# セッションの記録は追記のみの2つのファイルからなる
+#
+#   <session_id>.rec  ヘッダー + 受信したデータ（封筒を含むバイナリ・設定のテキスト）をそのまま連結したもの
+#   <session_id>.idx  ヘッダー + 1件ごとの固定長のエントリ
+#
+#   ヘッダー（16バイト）: マジック(4) バージョン(1) 予約(3) 記録開始時刻（UNIX秒, float64）
+#   エントリ（24バイト）: .rec内のオフセット(8) サイズ(4) 種類(1) 予約(3) 記録開始からの経過秒（float64）
+#
+# 数値はすべてビッグエンディアン。インデックスは固定長なので、mmapでファイル全体を読み込まずに
+# 任意のエントリを参照できる。書き込み途中で終了した場合の末尾の不完全なエントリは読み飛ばす。
+RECORD_VERSION = 1
+DATA_MAGIC = b"SCRD"
+INDEX_MAGIC = b"SCRX"
+_FILE_HEADER = struct.Struct(">4sBxxxd")
+_ENTRY = struct.Struct(">QIBxxxd")
+FILE_HEADER_SIZE = _FILE_HEADER.size
+ENTRY_SIZE = _ENTRY.size
+
+# エントリの種類（1〜3は封筒のモダリティと同じ値）
+KINDS = {0: "unknown", **MODALITIES, 4: "text"}
+_KIND_IDS = {name: value for value, name in KINDS.items()}
+
+
+class RecordingError(ValueError):
+    """記録ファイルのヘッダーが不正"""
+
+
+@dataclass
+class RecordEntry:
+    index: int
+    kind: str
+    arrival: float
+    offset: int
+    size: int
+
+
+class SessionRecorder:
+    """1セッション分の受信データを追記する（SESSION_RECORD_DIRを設定した場合のみ）
+
+    受信ループから呼ばれるので、書き込みはバッファ付きのファイルへの追記だけにする。
+    """
+
+    def __init__(self, path: str, max_bytes: int = SESSION_RECORD_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.started = time.monotonic()
+        self.entries = 0
+        self.bytes_written = 0
+        self.stopped = False
+        started_at = time.time()
+        self._data: Optional[BinaryIO] = open(f"{path}.rec", "wb")
+        self._index: Optional[BinaryIO] = open(f"{path}.idx", "wb")
+        self._data.write(_FILE_HEADER.pack(DATA_MAGIC, RECORD_VERSION, started_at))
+        self._index.write(_FILE_HEADER.pack(INDEX_MAGIC, RECORD_VERSION, started_at))
+        self._offset = FILE_HEADER_SIZE
+
+    @classmethod
+    def for_session(cls, session_id: str) -> Optional["SessionRecorder"]:
+        """記録が有効ならセッションのレコーダーを作る（無効・作成できない場合はNone）"""
+        if not SESSION_RECORD_DIR:
+            return None
+        try:
+            os.makedirs(SESSION_RECORD_DIR, exist_ok=True)
+            recorder = cls(os.path.join(SESSION_RECORD_DIR, session_id))
+        except OSError as e:
+            logger.error("Failed to start session recording: %s", e)
+            return None
+        logger.info("Recording session to %s.rec", recorder.path)
+        return recorder
+
+    def append(self, data: bytes, kind: str):
+        if self.stopped:
+            return
+        if self.bytes_written + len(data) > self.max_bytes:
+            logger.warning("Session recording %s reached %s bytes, stopping", self.path, self.max_bytes)
+            self.stopped = True
+            return
+        try:
+            self._data.write(data)
+            self._index.write(_ENTRY.pack(
+                self._offset, len(data), _KIND_IDS.get(kind, 0), time.monotonic() - self.started,
+            ))
+        except (OSError, ValueError) as e:
+            logger.error("Session recording failed: %s", e)
+            self.stopped = True
+            return
+        self._offset += len(data)
+        self.bytes_written += len(data)
+        self.entries += 1
+
+    def close(self):
+        for f in (self._data, self._index):
+            if f is not None:
+                try:
+                    f.close()
+                except OSError as e:
+                    logger.error("Failed to close session recording: %s", e)
+        self._data = self._index = None
+        self.stopped = True
+        logger.info("Recorded %s messages (%s bytes) to %s.rec", self.entries, self.bytes_written, self.path)
+
+
+class Recording:
+    """記録したセッションを読む
+
+    .idxと.recはどちらもmmapで開き、参照したエントリ・データの範囲だけを読み込む。
+
+        with Recording("records/<session_id>") as recording:
+            for entry in recording:
+                data = recording.payload(entry)
+    """
+
+    def __init__(self, path: str):
+        # 拡張子付きで指定されても受け付ける
+        base, ext = os.path.splitext(path)
+        self.path = base if ext in (".rec", ".idx") else path
+        self._files = [open(f"{self.path}.idx", "rb"), open(f"{self.path}.rec", "rb")]
+        try:
+            self._index = mmap.mmap(self._files[0].fileno(), 0, access=mmap.ACCESS_READ)
+            self._data = mmap.mmap(self._files[1].fileno(), 0, access=mmap.ACCESS_READ)
+            self.started_at = self._check_header(self._index, INDEX_MAGIC)
+            self._check_header(self._data, DATA_MAGIC)
+        except (ValueError, RecordingError):
+            self.close()
+            raise
+        count = (len(self._index) - FILE_HEADER_SIZE) // ENTRY_SIZE
+        # データの書き込みが終わっていないエントリは数えない
+        while count:
+            last = self._read_entry(count - 1)
+            if last.offset + last.size <= len(self._data):
+                break
+            count -= 1
+        self._count = count
+
+    @staticmethod
+    def _check_header(buffer: mmap.mmap, magic: bytes) -> float:
+        if len(buffer) < FILE_HEADER_SIZE:
+            raise RecordingError("Recording header is truncated")
+        file_magic, version, started_at = _FILE_HEADER.unpack_from(buffer)
+        if file_magic != magic:
+            raise RecordingError(f"Not a session recording: {file_magic!r}")
+        if version != RECORD_VERSION:
+            raise RecordingError(f"Unsupported recording version: {version}")
+        return started_at
+
+    def _read_entry(self, index: int) -> RecordEntry:
+        offset, size, kind, arrival = _ENTRY.unpack_from(self._index, FILE_HEADER_SIZE + index * ENTRY_SIZE)
+        return RecordEntry(index, KINDS.get(kind, "unknown"), arrival, offset, size)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, index: int) -> RecordEntry:
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        return self._read_entry(index)
+
+    def __iter__(self) -> Iterator[RecordEntry]:
+        for index in range(self._count):
+            yield self._read_entry(index)
+
+    def payload(self, entry: RecordEntry) -> bytes:
+        return self._data[entry.offset:entry.offset + entry.size]
+
+    @property
+    def duration(self) -> float:
+        return self[-1].arrival if self._count else 0.0
+
+    def close(self):
+        for buffer in (getattr(self, "_index", None), getattr(self, "_data", None)):
+            if buffer is not None:
+                buffer.close()
+        for f in self._files:
+            f.close()
+
+    def __enter__(self) -> "Recording":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
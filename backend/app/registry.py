@@ -0,0 +1,238 @@
+import asyncio
+import importlib
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# パイプラインのモード（per_modality: 画面・カメラ・音声を個別に解析 / windowed: 一定時間ごとにまとめて1回で解析）
+PIPELINE_MODE = os.getenv("PIPELINE_MODE", "per_modality")
+# ウォームアップでimportしておく重いモジュール（cv2・NumPy・openaiを含む）
+HEAVY_MODULES = (
+    "numpy",
+    "cv2",
+    "openai",
+    ".services.image_processing",
+    ".services.audio_service",
+    ".services.screen_analyzer",
+    ".services.camera_analyzer",
+    ".services.window_analyzer",
+    ".pipeline",
+)
+# ウォームアップの段階（readyzに出す順）と、準備ができていなくてもreadyとみなす段階
+WARMUP_STEPS = ("modules", "services", "openai_pool", "upstream_connection", "image_codecs")
+OPTIONAL_STEPS = {"upstream_connection"}
+
+
+class ServiceRegistry:
+    """アプリ全体で共有するサービスを初回利用時に作成する
+
+    重いモジュールはサービスを作るときに初めてimportするので、app.mainのimportは軽いまま。
+    warm_up()はstartup後にバックグラウンドで、モジュールのimport・サービスの作成・
+    OpenAIクライアントの接続プールの作成と事前接続・画像コーデックの初期化を順に行う。
+    """
+
+    def __init__(self):
+        self._instances: Dict[str, Any] = {}
+        self.steps: Dict[str, Dict[str, Any]] = {name: {"ready": False} for name in WARMUP_STEPS}
+        self.started_at = time.time()
+        self._warmup_task: Optional[asyncio.Task] = None
+
+    def _get(self, name: str, factory: Callable[[], Any]) -> Any:
+        if name not in self._instances:
+            started = time.perf_counter()
+            self._instances[name] = factory()
+            logger.info("Created %s in %.1fms", name, (time.perf_counter() - started) * 1000)
+        return self._instances[name]
+
+    def provide(self, name: str, instance: Any):
+        """作成済みのインスタンスを登録する（リプレイでスタブの上流につないだクライアントを使う場合など）"""
+        self._instances[name] = instance
+
+    def peek(self, name: str) -> Optional[Any]:
+        """作成済みの場合だけ返す（メトリクスなど、そのために作成したくない場合）"""
+        return self._instances.get(name)
+
+    @property
+    def openai_clients(self):
+        def create():
+            from .services.openai_client import OpenAIClientRegistry
+            return OpenAIClientRegistry.from_env()
+        return self._get("openai_clients", create)
+
+    @property
+    def result_cache(self):
+        # 書き起こし・画面・コメントの結果キャッシュ（全接続で共有）
+        def create():
+            from .services.result_cache import ResultCache
+            return ResultCache.from_env()
+        return self._get("result_cache", create)
+
+    @property
+    def rate_governor(self):
+        # 上流APIのレート制御（全接続・全サービスで共有）
+        def create():
+            from .services.rate_governor import get_rate_governor
+            return get_rate_governor()
+        return self._get("rate_governor", create)
+
+    @property
+    def upstream_guard(self):
+        def create():
+            from .services.upstream_guard import get_upstream_guard
+            return get_upstream_guard()
+        return self._get("upstream_guard", create)
+
+    @property
+    def image_preprocessor(self):
+        def create():
+            from .services.image_processing import get_image_preprocessor
+            return get_image_preprocessor()
+        return self._get("image_preprocessor", create)
+
+    @property
+    def audio_service(self):
+        def create():
+            from .services.audio_service import AudioService
+            return AudioService(
+                self.openai_clients, cache=self.result_cache, governor=self.rate_governor, guard=self.upstream_guard
+            )
+        return self._get("audio_service", create)
+
+    @property
+    def screen_analyzer(self):
+        def create():
+            from .services.screen_analyzer import ScreenAnalyzer
+            return ScreenAnalyzer(
+                self.openai_clients, preprocessor=self.image_preprocessor, cache=self.result_cache,
+                governor=self.rate_governor, guard=self.upstream_guard,
+            )
+        return self._get("screen_analyzer", create)
+
+    @property
+    def camera_analyzer(self):
+        def create():
+            from .services.camera_analyzer import CameraAnalyzer
+            return CameraAnalyzer(
+                self.openai_clients, preprocessor=self.image_preprocessor, cache=self.result_cache,
+                governor=self.rate_governor, guard=self.upstream_guard,
+            )
+        return self._get("camera_analyzer", create)
+
+    @property
+    def window_analyzer(self):
+        # windowedモードでは画面・カメラ・発言を一定時間ごとにまとめて解析する（それ以外ではNone）
+        def create():
+            if PIPELINE_MODE != "windowed":
+                return None
+            from .services.window_analyzer import WindowAnalyzer
+            return WindowAnalyzer(
+                self.openai_clients, preprocessor=self.image_preprocessor,
+                governor=self.rate_governor, guard=self.upstream_guard,
+            )
+        return self._get("window_analyzer", create)
+
+    def new_session(self):
+        """接続ごとの状態を作る（解析器は共有し、状態はセッションごとに持つ）"""
+        from .services.audio_assembler import AUDIO_ASSEMBLY, AudioAssembler
+        from .session import SessionState
+        window_analyzer = self.window_analyzer
+        return SessionState(
+            self.screen_analyzer.new_state(),
+            self.camera_analyzer.new_state(),
+            self.audio_service.vad_config,
+            window=window_analyzer.new_state() if window_analyzer else None,
+            audio=AudioAssembler() if AUDIO_ASSEMBLY else None,
+        )
+
+    def new_pipeline(self, connection, session, **kwargs):
+        """接続の解析パイプラインを作る（websocket_endpointとbench/replay.pyで共通）"""
+        from .pipeline import SessionPipeline
+        from .services.window_analyzer import WINDOW_SECONDS
+        return SessionPipeline(
+            connection, session, self.audio_service, self.screen_analyzer, self.camera_analyzer,
+            self.rate_governor, window_analyzer=self.window_analyzer, window_seconds=WINDOW_SECONDS, **kwargs,
+        )
+
+    def start_warm_up(self):
+        """バックグラウンドでウォームアップを開始（FastAPIのstartupで呼ぶ）"""
+        if self._warmup_task is None:
+            self._warmup_task = asyncio.create_task(self.warm_up())
+
+    async def ensure_ready(self):
+        """接続を受け付ける前に呼ぶ。ウォームアップが終わっていなければ待ち、必須の段階が失敗していれば送出する"""
+        if self._warmup_task is None:
+            self.start_warm_up()
+        await asyncio.shield(self._warmup_task)
+        for name in WARMUP_STEPS:
+            step = self.steps[name]
+            if not step["ready"] and name not in OPTIONAL_STEPS:
+                raise RuntimeError(f"{name} is not ready: {step.get('error')}")
+
+    def is_ready(self) -> bool:
+        return all(step["ready"] for name, step in self.steps.items() if name not in OPTIONAL_STEPS)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "ready": self.is_ready(),
+            "uptime": round(time.time() - self.started_at, 3),
+            "steps": self.steps,
+        }
+
+    async def warm_up(self):
+        await self._step("modules", self._import_modules)
+        if not self.steps["modules"]["ready"]:
+            return
+        await self._step("services", self._create_services)
+        if not self.steps["services"]["ready"]:
+            return
+        await self._step("openai_pool", self.openai_clients.start)
+        # 上流への事前接続は失敗してもよいので、画像コーデックの初期化と並行して行う
+        steps = [self._step("image_codecs", self.image_preprocessor.warm_up)]
+        if self.steps["openai_pool"]["ready"]:
+            steps.append(self._step("upstream_connection", self.openai_clients.preconnect))
+        await asyncio.gather(*steps)
+        logger.info("Warm-up finished: ready=%s", self.is_ready())
+
+    async def _step(self, name: str, action: Callable[[], Any]):
+        started = time.perf_counter()
+        try:
+            result = action()
+            if asyncio.iscoroutine(result):
+                result = await result
+            self.steps[name] = {"ready": True, "seconds": round(time.perf_counter() - started, 4)}
+            if isinstance(result, int) and not isinstance(result, bool):
+                self.steps[name]["count"] = result
+                if name in OPTIONAL_STEPS and result == 0:
+                    self.steps[name]["ready"] = False
+        except Exception as e:
+            logger.error("Warm-up step %s failed: %s", name, e)
+            self.steps[name] = {"ready": False, "seconds": round(time.perf_counter() - started, 4), "error": str(e)}
+
+    async def _import_modules(self) -> int:
+        # importはGILを握る時間が長いが、イベントループを止めないようにスレッドで行う
+        for module in HEAVY_MODULES:
+            await asyncio.to_thread(importlib.import_module, module, __package__)
+        return len(HEAVY_MODULES)
+
+    def _create_services(self) -> int:
+        services = [
+            self.upstream_guard, self.rate_governor, self.result_cache, self.openai_clients,
+            self.image_preprocessor, self.audio_service, self.screen_analyzer, self.camera_analyzer,
+            self.window_analyzer,
+        ]
+        return sum(service is not None for service in services)
+
+    async def close(self):
+        """作成済みのものだけを停止する（FastAPIのshutdownで呼ぶ）"""
+        if self._warmup_task is not None and not self._warmup_task.done():
+            self._warmup_task.cancel()
+            await asyncio.gather(self._warmup_task, return_exceptions=True)
+        preprocessor = self.peek("image_preprocessor")
+        if preprocessor is not None:
+            preprocessor.shutdown()
+        clients = self.peek("openai_clients")
+        if clients is not None:
+            await clients.close()
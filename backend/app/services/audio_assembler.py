@@ -0,0 +1,230 @@
+import logging
+import os
+from dataclasses import dataclass
+from typing import List, Optional
+
+import numpy as np
+
+from ..metrics import AUDIO_UTTERANCES
+from .vad import VADConfig, VoiceActivityDetector
+
+logger = logging.getLogger(__name__)
+
+# 受信したセグメントをつなげて発話ごとに区切るかどうか（falseならセグメントごとに書き起こす。VAD無効時も同様）
+AUDIO_ASSEMBLY = os.getenv("AUDIO_ASSEMBLY", "true").lower() == "true"
+# この長さ以上の無音で発話を区切る
+ASSEMBLY_PAUSE_MS = int(os.getenv("ASSEMBLY_PAUSE_MS", "500"))
+# 無音が見つからずに区切った場合、区切った位置の手前をこの長さだけ次の発話の先頭にも含める（重複した書き起こしは取り除く）
+ASSEMBLY_OVERLAP_MS = int(os.getenv("ASSEMBLY_OVERLAP_MS", "300"))
+# これより短い発話は次の発話とまとめて1回で書き起こす
+ASSEMBLY_MIN_UTTERANCE_MS = int(os.getenv("ASSEMBLY_MIN_UTTERANCE_MS", "1500"))
+# 短い発話を待たせる上限（受信した音声の長さで数える）
+ASSEMBLY_MAX_HOLD_MS = int(os.getenv("ASSEMBLY_MAX_HOLD_MS", "4000"))
+# 無音がなくてもこの長さで区切る（バッファの大きさ）
+ASSEMBLY_MAX_UTTERANCE_MS = int(os.getenv("ASSEMBLY_MAX_UTTERANCE_MS", "15000"))
+# 次のセグメントがこの秒数届かなければ、区切りを待たずに溜まっている発話を書き起こす
+# （フロントエンドは10秒ごとにセグメントを送るので、それより長くする。送信間隔がこれより長いクライアントは
+# 受信した間隔から延ばす: SessionPipeline._idle_flush_timeout）
+ASSEMBLY_IDLE_FLUSH = float(os.getenv("ASSEMBLY_IDLE_FLUSH", "12.0"))
+# 受信したセグメントの間隔の何倍待っても次が届かなければ、録音が止まったとみなす
+ASSEMBLY_IDLE_FLUSH_FACTOR = 1.5
+# まとめた発話の間に挟む無音
+COALESCE_GAP_MS = 100
+# 重複とみなす書き起こしの最短・最長の文字数
+MIN_OVERLAP_CHARS = 2
+MAX_OVERLAP_CHARS = 24
+
+
+@dataclass
+class Utterance:
+    """書き起こしに送る1回分のPCM"""
+    pcm: np.ndarray
+    # 先頭が直前の発話の末尾と重なっているか（無音のない位置で区切った場合）
+    overlaps_previous: bool = False
+    # まとめた発話の数
+    fragments: int = 1
+
+
+def strip_overlap(previous: str, text: str) -> str:
+    """直前の書き起こしの末尾と重なる先頭部分を取り除く"""
+    limit = min(len(previous), len(text), MAX_OVERLAP_CHARS)
+    for size in range(limit, MIN_OVERLAP_CHARS - 1, -1):
+        if previous[-size:] == text[:size]:
+            return text[size:].lstrip(" 、。,.")
+    return text
+
+
+class AudioAssembler:
+    """1セッション分の音声をつなげて、無音の位置で発話ごとに区切る
+
+    クライアントは一定間隔で録音を区切ってWebMを送ってくるので、セグメントの境目で言葉が切れたり、
+    短い断片ごとに書き起こしを呼んだりしないように、デコードしたPCMを固定長のバッファにつなげていく。
+    ASSEMBLY_PAUSE_MS以上の無音が見つかったらそこで区切り、見つからないままバッファが一杯になったら
+    後半で最も静かな位置で区切る。後者は言葉の途中の可能性があるので、区切った位置の手前ASSEMBLY_OVERLAP_MSは
+    次の発話にも含め、重なった書き起こしはdedupe()で取り除く。短い発話は次の発話とまとめて1回で書き起こす。
+    """
+
+    def __init__(
+        self,
+        sample_rate: int = 16000,
+        pause_ms: int = ASSEMBLY_PAUSE_MS,
+        overlap_ms: int = ASSEMBLY_OVERLAP_MS,
+        min_utterance_ms: int = ASSEMBLY_MIN_UTTERANCE_MS,
+        max_hold_ms: int = ASSEMBLY_MAX_HOLD_MS,
+        max_utterance_ms: int = ASSEMBLY_MAX_UTTERANCE_MS,
+    ):
+        self.sample_rate = sample_rate
+        self.pause_ms = pause_ms
+        self.overlap = sample_rate * overlap_ms // 1000
+        self.min_utterance = sample_rate * min_utterance_ms // 1000
+        self.max_hold = sample_rate * max_hold_ms // 1000
+        self.buffer = np.zeros(sample_rate * max_utterance_ms // 1000, dtype=np.int16)
+        self.length = 0
+        # 受信した音声の合計サンプル数（短い発話を待たせた時間を測る時計）
+        self.position = 0
+        self.pending: List[np.ndarray] = []
+        self.pending_since = 0
+        self.pending_overlaps = False
+        # 次に区切る発話の先頭が、直前の発話と重なっているか
+        self.overlapping = False
+        self.last_text = ""
+
+    @property
+    def buffered_ms(self) -> int:
+        return (self.length + sum(len(pcm) for pcm in self.pending)) * 1000 // self.sample_rate
+
+    def push(self, pcm: np.ndarray, vad_config: VADConfig) -> List[Utterance]:
+        """デコードしたセグメントを追加し、区切りの付いた発話を返す"""
+        utterances: List[Utterance] = []
+        offset = 0
+        while offset < len(pcm):
+            size = min(len(pcm) - offset, len(self.buffer) - self.length)
+            self.buffer[self.length:self.length + size] = pcm[offset:offset + size]
+            self.length += size
+            self.position += size
+            offset += size
+            utterances.extend(self._cut_at_pauses(vad_config))
+            if self.length == len(self.buffer):
+                utterances.extend(self._cut_forced(vad_config))
+        if self.pending and self.position - self.pending_since >= self.max_hold:
+            utterances.append(self._release())
+        return utterances
+
+    def flush(self, vad_config: VADConfig) -> List[Utterance]:
+        """バッファに残っている発話と、まとめるために待たせている発話をすべて返す"""
+        utterances: List[Utterance] = []
+        if self.length:
+            speech = self._trim(VoiceActivityDetector(vad_config), self.length)
+            overlaps = self.overlapping
+            self._consume(self.length, keep_overlap=False)
+            self.overlapping = False
+            if speech is not None:
+                AUDIO_UTTERANCES.inc("idle_flush")
+                utterances.extend(self._collect(speech, overlaps))
+        if self.pending:
+            utterances.append(self._release())
+        return utterances
+
+    def dedupe(self, text: str, utterance: Utterance) -> str:
+        """重ねて送った部分の書き起こしを取り除き、次の発話と比べるために覚えておく"""
+        if utterance.overlaps_previous and self.last_text:
+            stripped = strip_overlap(self.last_text, text)
+            if stripped != text:
+                logger.debug("Removed overlapping transcript: %s", text[:len(text) - len(stripped)])
+            text = stripped
+        if text:
+            self.last_text = text
+        return text
+
+    def reset(self):
+        self.length = 0
+        self.pending = []
+        self.overlapping = False
+        self.last_text = ""
+
+    def _frame_length(self, vad_config: VADConfig) -> int:
+        return max(1, self.sample_rate * vad_config.frame_ms // 1000)
+
+    def _trim(self, detector: VoiceActivityDetector, end: int) -> Optional[np.ndarray]:
+        # バッファは使い回すので、書き起こしに送るPCMはコピーを持つ
+        speech = detector.trim(self.buffer[:end], self.sample_rate)
+        return None if speech is None else speech.copy()
+
+    def _cut_at_pauses(self, vad_config: VADConfig) -> List[Utterance]:
+        utterances: List[Utterance] = []
+        detector = VoiceActivityDetector(vad_config)
+        frame_length = self._frame_length(vad_config)
+        pause_frames = max(1, -(-self.pause_ms // max(1, vad_config.frame_ms)))
+        while self.length:
+            mask = detector.speech_mask(self.buffer[:self.length], self.sample_rate)
+            if not mask.any():
+                # 発話がなければ末尾の無音だけ残して捨てる
+                self._consume(max(0, self.length - pause_frames * frame_length), keep_overlap=False)
+                break
+            first = int(np.argmax(mask))
+            silent = ~mask[first:]
+            if len(silent) < pause_frames:
+                break
+            runs = np.flatnonzero(np.convolve(silent, np.ones(pause_frames, dtype=int), "valid") == pause_frames)
+            if not runs.size:
+                break
+            end = (first + int(runs[0])) * frame_length
+            # 無音の途中で区切る（言葉は切れていないので重ねない）
+            cut = end + pause_frames * frame_length // 2
+            speech = self._trim(detector, end)
+            overlaps = self.overlapping
+            self._consume(cut, keep_overlap=False)
+            self.overlapping = False
+            if speech is None:
+                AUDIO_UTTERANCES.inc("noise")
+                continue
+            AUDIO_UTTERANCES.inc("pause")
+            utterances.extend(self._collect(speech, overlaps))
+        return utterances
+
+    def _cut_forced(self, vad_config: VADConfig) -> List[Utterance]:
+        """無音が見つからないままバッファが一杯になったので、後半で最も静かな位置で区切る"""
+        frame_length = self._frame_length(vad_config)
+        num_frames = self.length // frame_length
+        half = num_frames // 2
+        frames = self.buffer[half * frame_length:num_frames * frame_length].reshape(-1, frame_length).astype(np.float32)
+        cut = (half + int(np.argmin(np.mean(frames * frames, axis=1))) + 1) * frame_length
+        speech = self._trim(VoiceActivityDetector(vad_config), cut)
+        overlaps = self.overlapping
+        self._consume(cut, keep_overlap=True)
+        # 言葉の途中で区切った可能性があるので、次の発話の書き起こしから重なりを取り除く
+        self.overlapping = True
+        if speech is None:
+            return []
+        AUDIO_UTTERANCES.inc("max_length")
+        return self._collect(speech, overlaps)
+
+    def _consume(self, samples: int, keep_overlap: bool):
+        """先頭からsamples分を取り除く（keep_overlapなら手前のoverlap分は残す）"""
+        start = max(0, samples - self.overlap) if keep_overlap else samples
+        remaining = self.length - start
+        if remaining > 0 and start > 0:
+            self.buffer[:remaining] = self.buffer[start:self.length]
+        self.length = max(0, remaining)
+
+    def _collect(self, speech: np.ndarray, overlaps: bool) -> List[Utterance]:
+        if not self.pending:
+            self.pending_since = self.position
+            self.pending_overlaps = overlaps
+        self.pending.append(speech)
+        if sum(len(pcm) for pcm in self.pending) < self.min_utterance:
+            return []
+        return [self._release()]
+
+    def _release(self) -> Utterance:
+        pending, self.pending = self.pending, []
+        if len(pending) == 1:
+            return Utterance(pending[0], self.pending_overlaps)
+        AUDIO_UTTERANCES.inc("coalesced", amount=len(pending) - 1)
+        gap = np.zeros(self.sample_rate * COALESCE_GAP_MS // 1000, dtype=np.int16)
+        parts: List[np.ndarray] = []
+        for pcm in pending:
+            if parts:
+                parts.append(gap)
+            parts.append(pcm)
+        return Utterance(np.concatenate(parts), self.pending_overlaps, len(pending))
@@ -1,18 +1,37 @@
 import os
-import openai
-import tempfile
-import subprocess
-from typing import BinaryIO, Dict, Union
-from dotenv import load_dotenv
+import io
+import wave
+import asyncio
+import numpy as np
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Union
 from fastapi import WebSocketDisconnect
+from .openai_client import OpenAIClientRegistry
+from .comment_batch import COMMENT_BATCH_SIZE, batch_instruction, batch_max_tokens, create_comment_batch, join_comments, split_comments
+from .vad import VADConfig, VoiceActivityDetector
+from .audio_assembler import AudioAssembler, Utterance
+from .result_cache import CacheBackend, transcript_cache_key
+from .rate_governor import PRIORITY_AUDIO, RateGovernor, get_rate_governor
+from .comment_bank import CommentBank, get_comment_bank
+from .upstream_guard import UpstreamGuard, UpstreamUnavailable, get_upstream_guard
+from ..logging_config import SAMPLED
+from ..metrics import FALLBACK_COMMENTS, STAGE_SECONDS
 import logging
 
-load_dotenv()
-
-# ロガーの設定
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 音声の変換方針（auto: Whisperが受け付ける形式はそのまま送る / always: 常に変換 / never: 変換しない）
+AUDIO_TRANSCODE = os.getenv("AUDIO_TRANSCODE", "auto")
+# 音声認識向けの出力形式（16kHzモノラル）
+SPEECH_SAMPLE_RATE = 16000
+SPEECH_BITRATE = "32k"
+
+WEBM_MAGIC = b"\x1a\x45\xdf\xa3"
+# FFmpegのエラー出力をログに残す上限（バイト）
+FFMPEG_STDERR_LIMIT = 1000
+# 音声認識と返答の生成に使うモデル（サーキットブレーカーはモデルごと）
+TRANSCRIPTION_MODEL = "whisper-1"
+RESPONSE_MODEL = "gpt-3.5-turbo"
+
 class AudioServiceError(Exception):
     def __init__(self, message: str, error_type: str):
         self.message = message
@@ -20,149 +39,320 @@ class AudioServiceError(Exception):
         super().__init__(self.message)
 
 class AudioService:
-    def __init__(self):
-        openai.api_key = os.getenv("OPENAI_API_KEY")
-        if not openai.api_key:
+    def __init__(
+        self,
+        clients: OpenAIClientRegistry,
+        transcode: str = AUDIO_TRANSCODE,
+        cache: Optional[CacheBackend] = None,
+        governor: Optional[RateGovernor] = None,
+        batch_size: int = COMMENT_BATCH_SIZE,
+        guard: Optional[UpstreamGuard] = None,
+        bank: Optional[CommentBank] = None,
+    ):
+        # アプリ全体で共有するOpenAIクライアント
+        self.clients = clients
+        # 1回の呼び出しで生成するコメントの件数（送信の間隔はパイプライン側で調整する）
+        self.batch_size = batch_size
+        # 同じ発言（正規化した書き起こし）に対するコメントを使い回すキャッシュ
+        self.cache = cache
+        # 上流APIの呼び出しは全サービス共通のレート制御を通す（音声は最優先）
+        self.governor = governor or get_rate_governor()
+        # 上流の呼び出しの締め切りとサーキットブレーカー、障害時に使うローカルのコメント集
+        self.guard = guard or get_upstream_guard()
+        self.bank = bank or get_comment_bank()
+        self.transcode = transcode
+        # セッションで指定がなければこの設定で無音判定する
+        self.vad_config = VADConfig()
+        if not clients.api_key:
             raise AudioServiceError("OpenAI APIキーが設定されていません", "config_error")
         logger.info("AudioService initialized with OpenAI API key")
 
-    async def convert_audio(self, input_file: str) -> str:
-        """WebMをMP3に変換"""
-        output_file = input_file.replace('.webm', '.mp3')
+    async def _run_ffmpeg(self, audio_data: bytes, output_args: List[str]) -> bytes:
+        """標準入出力経由でFFmpegを実行（ディスクを使わない）"""
         try:
-            logger.info(f"Converting audio: {input_file} -> {output_file}")
-            
-            # 入力ファイルのフォーマットを確認
-            probe_result = subprocess.run([
-                'ffprobe',
-                '-v', 'error',
-                '-show_entries', 'format=format_name',
-                '-of', 'default=noprint_wrappers=1:nokey=1',
-                input_file
-            ], capture_output=True, text=True)
-            if probe_result.returncode != 0:
-                logger.error(f"FFprobe error: {probe_result.stderr}")
-                raise AudioServiceError("入力ファイルのフォーマット取得に失敗しました", "conversion_error")
-            logger.info(f"Input format probe result: {probe_result.stdout.strip()}")
-            
-            result = subprocess.run([
+            process = await asyncio.create_subprocess_exec(
                 'ffmpeg',
                 '-hide_banner',
-                '-y',
+                '-loglevel', 'error',
                 '-f', 'webm',  # 入力フォーマットを明示的に指定
-                '-i', input_file,
+                '-i', 'pipe:0',
+                *output_args,
+                'pipe:1',
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+        except FileNotFoundError:
+            raise AudioServiceError("FFmpegが見つかりません", "conversion_error")
+
+        stdout, stderr = await process.communicate(audio_data)
+        if process.returncode != 0:
+            # stderrは長くなることがあるので末尾だけ残す（繰り返しのエラーはログの設定で抑制される）
+            logger.error("FFmpeg error: %s", stderr[-FFMPEG_STDERR_LIMIT:].decode(errors="replace"))
+            raise AudioServiceError("音声変換に失敗しました", "conversion_error")
+        if not stdout:
+            raise AudioServiceError("変換後の音声データが空でした", "conversion_error")
+        return stdout
+
+    async def convert_audio(self, audio_data: bytes) -> bytes:
+        """WebMを16kHzモノラルのMP3に変換"""
+        with STAGE_SECONDS.time("ffmpeg_convert"):
+            converted = await self._run_ffmpeg(audio_data, [
                 '-acodec', 'libmp3lame',  # コーデック指定
-                '-ar', '44100',
+                '-ar', str(SPEECH_SAMPLE_RATE),
                 '-ac', '1',
-                '-b:a', '128k',
+                '-b:a', SPEECH_BITRATE,
                 '-f', 'mp3',
-                output_file
-            ], capture_output=True, text=True)
-
-            if result.returncode != 0:
-                logger.error(f"FFmpeg error: {result.stderr}")
-                logger.error(f"FFmpeg command output: {result.stdout}")
-                logger.error(f"Input file exists: {os.path.exists(input_file)}")
-                logger.error(f"Input file size: {os.path.getsize(input_file) if os.path.exists(input_file) else 'N/A'}")
-                raise AudioServiceError(f"音声変換に失敗しました: {result.stderr}", "conversion_error")
-
-            if os.path.exists(output_file):
-                file_size = os.path.getsize(output_file)
-                logger.info(f"Converted file size: {file_size} bytes")
-                return output_file
-            else:
-                raise AudioServiceError("変換後のファイルが生成されませんでした", "conversion_error")
+            ])
+        logger.info("Converted audio size: %d -> %d bytes", len(audio_data), len(converted), extra=SAMPLED)
+        return converted
 
-        except subprocess.CalledProcessError as e:
-            logger.error(f"FFmpeg error: {e.stderr}")
-            raise AudioServiceError("FFmpegの実行に失敗しました", "conversion_error")
+    async def decode_pcm(self, audio_data: bytes) -> np.ndarray:
+        """WebMを16kHzモノラルの16bit PCMにデコード"""
+        with STAGE_SECONDS.time("ffmpeg_decode"):
+            raw = await self._run_ffmpeg(audio_data, [
+                '-ar', str(SPEECH_SAMPLE_RATE),
+                '-ac', '1',
+                '-f', 's16le',
+            ])
+        return np.frombuffer(raw, dtype='<i2')
 
-    async def transcribe_audio(self, audio_data: BinaryIO) -> Dict[str, Union[str, bool]]:
-        temp_files = []
+    @staticmethod
+    def encode_wav(pcm: np.ndarray, sample_rate: int = SPEECH_SAMPLE_RATE) -> bytes:
+        """16bit PCMをメモリ上でWAVにまとめる"""
+        buffer = io.BytesIO()
+        with wave.open(buffer, 'wb') as wav_file:
+            wav_file.setnchannels(1)
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(sample_rate)
+            wav_file.writeframes(pcm.astype('<i2', copy=False).tobytes())
+        return buffer.getvalue()
+
+    async def assemble(
+        self, audio_data: bytes, assembler: AudioAssembler, vad_config: Optional[VADConfig] = None
+    ) -> List[Utterance]:
+        """セグメントをデコードしてセッションの音声につなげ、区切りの付いた発話を返す"""
         try:
-            logger.info("Starting audio transcription")
-            with tempfile.NamedTemporaryFile(suffix='.webm', delete=False, mode='wb') as temp_webm:
-                audio_data.seek(0)
-                content = audio_data.read()
-                
-                # ファイルヘッダーの確認
-                logger.info(f"First 16 bytes of content: {content[:16].hex()}")
-                
-                temp_webm.write(content)
-                temp_webm.flush()
-                os.fsync(temp_webm.fileno())  # 確実にディスクに書き込む
-                
-                temp_files.append(temp_webm.name)
-                
-                # ファイルの存在とサイズを確認
-                logger.info(f"Temp file path: {temp_webm.name}")
-                logger.info(f"Temp file exists: {os.path.exists(temp_webm.name)}")
-                logger.info(f"Temp file size: {os.path.getsize(temp_webm.name)}")
-
-            # MP3に変換
-            temp_mp3_path = await self.convert_audio(temp_webm.name)
-            temp_files.append(temp_mp3_path)
+            pcm = await self.decode_pcm(audio_data)
+        except AudioServiceError as e:
+            logger.error("Error while assembling audio: %s", e.message)
+            return []
+        with STAGE_SECONDS.time("audio_assemble"):
+            utterances = assembler.push(pcm, vad_config or self.vad_config)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Assembled %.2fs of audio into %d utterances (%dms buffered)",
+                len(pcm) / SPEECH_SAMPLE_RATE, len(utterances), assembler.buffered_ms,
+            )
+        return utterances
+
+    async def prepare_upload(
+        self, audio_data: Union[bytes, Utterance], vad_config: Optional[VADConfig] = None
+    ) -> Optional[Tuple[str, bytes]]:
+        """Whisper APIに送るファイル名とデータを決める（発話がなければNone）"""
+        if isinstance(audio_data, Utterance):
+            # 区切った時点で前後の無音は切り落としてある
+            return "audio.wav", self.encode_wav(audio_data.pcm)
+        vad_config = vad_config or self.vad_config
+        if vad_config.enabled:
+            # 無音区間を判定するためにPCMへデコードし、前後の無音を切り落とす
+            pcm = await self.decode_pcm(audio_data)
+            with STAGE_SECONDS.time("vad"):
+                speech = VoiceActivityDetector(vad_config).trim(pcm, SPEECH_SAMPLE_RATE)
+            if speech is None:
+                return None
+            logger.info(
+                "Speech detected: %.2fs of %.2fs", len(speech) / SPEECH_SAMPLE_RATE, len(pcm) / SPEECH_SAMPLE_RATE,
+                extra=SAMPLED,
+            )
+            return "audio.wav", self.encode_wav(speech)
+
+        is_webm = audio_data[:4] == WEBM_MAGIC
+        if self.transcode == "never" or (self.transcode == "auto" and is_webm):
+            # WebM/OpusはWhisper APIがそのまま受け付けるので変換を省略（アップロードにはbytesが必要）
+            return "audio.webm", bytes(audio_data)
+        return "audio.mp3", await self.convert_audio(audio_data)
+
+    async def transcribe_audio(
+        self,
+        audio_data: Union[bytes, Utterance],
+        vad_config: Optional[VADConfig] = None,
+        on_delta: Optional[Callable[[str], Awaitable[None]]] = None,
+        session_id: str = "default",
+        assembler: Optional[AudioAssembler] = None,
+    ) -> Dict[str, Union[str, bool]]:
+        """音声認識 → 書き起こしに対するコメント生成"""
+        transcription = await self.transcribe(audio_data, vad_config, session_id, assembler)
+        if not transcription["success"]:
+            if transcription["error"]["type"] == "upstream_unavailable":
+                # 発話があったことは分かっているので、内容に依らない相づちを返す
+                return self._fallback("transcription_unavailable")
+            return transcription
+        # AIによるレスポンス生成
+        return await self.generate_response(transcription["text"], on_delta, session_id)
+
+    async def transcribe(
+        self,
+        audio_data: Union[bytes, Utterance],
+        vad_config: Optional[VADConfig] = None,
+        session_id: str = "default",
+        assembler: Optional[AudioAssembler] = None,
+    ) -> Dict[str, Union[str, bool]]:
+        """音声認識のみを行い、書き起こしをtextに入れて返す
+
+        区切った発話（Utterance）とassemblerを渡すと、直前の発話と重ねて送った部分の書き起こしを取り除く。
+        """
+        try:
+            if isinstance(audio_data, Utterance):
+                logger.info(
+                    "Starting audio transcription (%.2fs, %d fragments)",
+                    len(audio_data.pcm) / SPEECH_SAMPLE_RATE, audio_data.fragments, extra=SAMPLED,
+                )
+            else:
+                logger.info("Starting audio transcription (%d bytes)", len(audio_data), extra=SAMPLED)
+            upload = await self.prepare_upload(audio_data, vad_config)
+            if upload is None:
+                # 無音のセグメントはAPIを呼ばずに捨てる
+                return {
+                    "success": False,
+                    "text": "",
+                    "error": {"type": "no_speech", "message": "発話が検出されませんでした"}
+                }
 
             # Whisper APIで音声認識
-            with open(temp_mp3_path, 'rb') as audio_file:
-                client = openai.AsyncOpenAI()
+            client = self.clients.get("transcription")
+            async with self.guard.call(
+                    TRANSCRIPTION_MODEL, "whisper_call",
+                    self.governor.slot(PRIORITY_AUDIO, session_id, stage="whisper_call"),
+            ):
                 response = await client.audio.transcriptions.create(
-                    file=audio_file,
-                    model="whisper-1",
+                    file=upload,
+                    model=TRANSCRIPTION_MODEL,
                     language="ja"
                 )
 
-                if not response.text:
+            if not response.text:
+                return {
+                    "success": False,
+                    "text": "",
+                    "error": {"type": "transcription_error", "message": "音声認識結果が空でした"}
+                }
+
+            text = response.text
+            if assembler is not None and isinstance(audio_data, Utterance):
+                text = assembler.dedupe(text, audio_data)
+                if not text:
                     return {
                         "success": False,
                         "text": "",
-                        "error": {"type": "transcription_error", "message": "音声認識結果が空でした"}
+                        "error": {"type": "duplicate_transcript", "message": "直前の発話と重なる部分のみでした"}
                     }
 
-                # AIによるレスポンス生成
-                return await self.generate_response(response.text)
+            return {
+                "success": True,
+                "text": text,
+                "error": None
+            }
 
+        except UpstreamUnavailable as e:
+            logger.warning("Transcription unavailable: %s", e)
+            return {
+                "success": False,
+                "text": "",
+                "error": {"type": "upstream_unavailable", "message": str(e)}
+            }
+        except AudioServiceError as e:
+            logger.error("Error during transcription: %s", e.message)
+            return {
+                "success": False,
+                "text": "",
+                "error": {"type": e.error_type, "message": e.message}
+            }
         except Exception as e:
-            logger.error(f"Error during transcription: {str(e)}")
+            logger.error("Error during transcription: %s", e)
             return {
                 "success": False,
                 "text": "",
                 "error": {"type": "unknown", "message": str(e)}
             }
-        finally:
-            for file_path in temp_files:
-                try:
-                    if os.path.exists(file_path):
-                        os.unlink(file_path)
-                except Exception as e:
-                    logger.error(f"Failed to delete {file_path}: {str(e)}")
-
-    async def generate_response(self, text: str) -> Dict[str, Union[str, bool]]:
+
+    async def generate_response(
+        self,
+        text: str,
+        on_delta: Optional[Callable[[str], Awaitable[None]]] = None,
+        session_id: str = "default",
+    ) -> Dict[str, Union[str, bool]]:
+        cache_key = transcript_cache_key(text)
+        if self.cache is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                logger.info("Cached AI response: %s", cached, extra=SAMPLED)
+                comments = split_comments(cached, self.batch_size)
+                return {
+                    "success": True,
+                    "text": comments[0],
+                    "comments": comments,
+                    "error": None
+                }
+
         try:
-            client = openai.AsyncOpenAI()  # AsyncOpenAIクライアントを使用
-            response = await client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[                    {"role": "system", "content": 
-                     "あなたは音声に対してリアクションを返すAIです。\
-                        コメントは自然な日本語で、5文字以下の短文が8割以上ですが、長めのコメントもごくたまに含まれます。\
-                        反応のバリエーションを増やし、面白い・共感・驚き・ツッコミなど多様なトーンを持たせてください。\
-                        カジュアルな表現やスラングがほとんどです。面白いと思ったらwwwや草などの表現を入れて。\
-                        句点を付けたコメントは、コメントとして違和感があるのでしないでください。絵文字もたまに加えるように。"
-                        },
-                        {"role": "user", "content": f"以下の音声に対して自然なコメントをしてください：{text}"}
-                ],
-                max_tokens=100
-            )
-            logger.info(f"Generated AI response: {response.choices[0].message.content}")
+            client = self.clients.get("chat")  # 共有クライアントを使用
+            # on_deltaが指定されていれば1件目のコメントをストリーミングで逐次送信する
+            async with self.guard.call(
+                    RESPONSE_MODEL, "response_call",
+                    self.governor.slot(PRIORITY_AUDIO, session_id, stage="response_call"),
+            ):
+                comments = await create_comment_batch(
+                    client,
+                    self.batch_size,
+                    on_delta,
+                    model=RESPONSE_MODEL,
+                    messages=[                    {"role": "system", "content": 
+                         "あなたは音声に対してリアクションを返すAIです。\
+                            コメントは自然な日本語で、5文字以下の短文が8割以上ですが、長めのコメントもごくたまに含まれます。\
+                            反応のバリエーションを増やし、面白い・共感・驚き・ツッコミなど多様なトーンを持たせてください。\
+                            カジュアルな表現やスラングがほとんどです。面白いと思ったらwwwや草などの表現を入れて。\
+                            句点を付けたコメントは、コメントとして違和感があるのでしないでください。絵文字もたまに加えるように。"
+                            },
+                            {"role": "user", "content": f"以下の音声に対して自然なコメントをしてください：{text}\n{batch_instruction(self.batch_size)}"}
+                    ],
+                    max_tokens=batch_max_tokens(self.batch_size, per_comment=40)
+                )
+            logger.info("Generated AI response: %s", comments, extra=SAMPLED)
+            if not comments:
+                return {
+                    "success": False,
+                    "text": "",
+                    "error": {"type": "response_error", "message": "コメントが生成されませんでした"}
+                }
+            if self.cache is not None:
+                self.cache.put(cache_key, join_comments(comments))
             return {
                 "success": True,
-                "text": response.choices[0].message.content,
+                "text": comments[0],
+                "comments": comments,
                 "error": None
             }
+        except UpstreamUnavailable as e:
+            logger.warning("Response generation unavailable: %s", e)
+            return self._fallback(e.reason)
         except Exception as e:
-            logger.error(f"Response generation error: {str(e)}")
+            logger.error("Response generation error: %s", e)
             return {
                 "success": False,
                 "text": "",
                 "error": {"type": "response_error", "message": str(e)}
-            }
\ No newline at end of file
+            }
+
+    def _fallback(self, reason: str) -> Dict[str, Union[str, bool]]:
+        """上流を使えないときにローカルのコメント集から相づちを返す（キャッシュには入れない）"""
+        comments = self.bank.pick("audio", self.batch_size)
+        FALLBACK_COMMENTS.inc("audio", reason)
+        logger.info("Fallback comments (%s): %s", reason, comments, extra=SAMPLED)
+        return {
+            "success": True,
+            "text": comments[0],
+            "comments": comments,
+            "error": None,
+            "fallback": True
+        }
@@ -0,0 +1,48 @@
+import cv2
+import numpy as np
+from typing import Optional
+
+
+def compute_dhash(frame: np.ndarray, hash_size: int = 16) -> np.ndarray:
+    """縮小グレースケール画像の差分ハッシュ（dHash）を計算
+
+    (hash_size + 1) x hash_size に縮小し、隣り合う画素の大小関係を
+    hash_size * hash_size ビットの真偽値配列として返す。
+    """
+    if frame.ndim == 3:
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(frame, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    return (small[:, 1:] > small[:, :-1]).ravel()
+
+
+def hamming_distance(a: np.ndarray, b: np.ndarray) -> int:
+    return int(np.count_nonzero(a != b))
+
+
+class FrameChangeDetector:
+    """直前に解析したフレームとの差分からVision APIを呼ぶ必要があるかを判定"""
+
+    def __init__(self, threshold: int, hash_size: int = 16):
+        # threshold: 変化ありとみなすハミング距離（hash_size * hash_size ビット中）
+        self.threshold = threshold
+        self.hash_size = hash_size
+        self.reference_hash: Optional[np.ndarray] = None
+        # 変化した領域の切り出しに使う、基準フレームの縮小グレースケール画像
+        self.reference_thumbnail: Optional[np.ndarray] = None
+
+    def compute(self, frame: np.ndarray) -> np.ndarray:
+        return compute_dhash(frame, self.hash_size)
+
+    def is_changed(self, frame_hash: np.ndarray) -> bool:
+        if self.reference_hash is None or self.reference_hash.shape != frame_hash.shape:
+            return True
+        return hamming_distance(self.reference_hash, frame_hash) > self.threshold
+
+    def remember(self, frame_hash: np.ndarray, thumbnail: Optional[np.ndarray] = None):
+        """解析に成功したフレームを比較の基準として記録"""
+        self.reference_hash = frame_hash
+        self.reference_thumbnail = thumbnail
+
+    def reset(self):
+        self.reference_hash = None
+        self.reference_thumbnail = None
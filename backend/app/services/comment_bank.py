@@ -0,0 +1,149 @@
+import json
+import logging
+import os
+import random
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 組み込みのコメントを差し替え・追加するJSONファイル（{"screen": {"エディタ/コーディング": [...]}, ...}）
+COMMENT_BANK_PATH = os.getenv("COMMENT_BANK_PATH")
+
+# 上流を呼べないときに返すコメント。カテゴリは解析結果のscreen_type/user_action・scene_type/actionと同じ値を使い、
+# "*"はどのカテゴリにも当てはまるもの
+DEFAULT_BANK: Dict[str, Dict[str, Sequence[str]]] = {
+    "screen": {
+        "エディタ/コーディング": ["実装中か", "がんばれ", "そのコード読みやすい", "バグらないで", "いいリファクタ", "型大事"],
+        "エディタ/*": ["コード見てる", "ほう", "どこ直すの"],
+        "ブラウザ/閲覧": ["調べもの？", "それ気になる", "ドキュメント大事", "タブ多くない？"],
+        "ターミナル/コマンド実行": ["通れ", "ビルド待ち", "ログ流れてる", "エラー出ないで🙏"],
+        "ターミナル/*": ["黒い画面だ", "コマンドかっこいい"],
+        "*/*": ["おお", "なるほど", "いいね", "ふむふむ", "それな", "👀"],
+    },
+    "camera": {
+        "人物/動作中": ["動いてる", "元気そう", "いい動き", "なにしてるの"],
+        "人物/静止": ["こんにちは", "真剣な顔", "集中してる", "おつかれ"],
+        "風景/*": ["きれい", "いい景色", "どこ？"],
+        "物体/*": ["それなに？", "気になる", "いいね👍"],
+        "*/*": ["おお", "いいね", "見えてるよ", "👀"],
+    },
+    "audio": {
+        "*/*": ["うんうん", "なるほど", "わかる", "それな", "たしかに", "へえ", "草"],
+    },
+    "window": {
+        "*/*": ["おお", "なるほど", "いいね", "ふむふむ", "わかる"],
+    },
+}
+
+# 画像の統計から分かる状況に合わせたコメント（カテゴリのコメントに混ぜる）
+SIGNAL_COMMENTS: Dict[str, Sequence[str]] = {
+    "motion": ["めっちゃ動いてる", "展開早い", "おっ", "なにか起きた"],
+    "still": ["静かだ", "じっくり", "止まってる？"],
+    "dark": ["暗い", "夜っぽい", "見えにくい"],
+    "bright": ["まぶしい", "明るい"],
+    "text": ["文字多い", "読んでる", "細かい"],
+}
+
+# 画像の統計からシグナルを判定するしきい値
+MOTION_HIGH = 0.15
+MOTION_LOW = 0.005
+DARK_BRIGHTNESS = 0.2
+BRIGHT_BRIGHTNESS = 0.85
+TEXT_BLOCKS = 0.2
+
+
+def local_signals(stats: Dict[str, float]) -> List[str]:
+    """前処理で計算した統計（動き・明るさ・文字らしさ）から状況を表すシグナルを返す"""
+    signals = []
+    motion = stats.get("motion")
+    if motion is not None:
+        if motion >= MOTION_HIGH:
+            signals.append("motion")
+        elif motion <= MOTION_LOW:
+            signals.append("still")
+    brightness = stats.get("brightness")
+    if brightness is not None:
+        if brightness <= DARK_BRIGHTNESS:
+            signals.append("dark")
+        elif brightness >= BRIGHT_BRIGHTNESS:
+            signals.append("bright")
+    if stats.get("text_blocks", 0.0) >= TEXT_BLOCKS:
+        signals.append("text")
+    return signals
+
+
+class CommentBank:
+    """上流APIが使えないときにローカルで返すコメント集
+
+    起動時にカテゴリ・シグナルごとの候補をタプルにまとめておき、選ぶときは辞書の参照と乱数だけで済ませる。
+    """
+
+    def __init__(
+        self,
+        bank: Optional[Dict[str, Dict[str, Sequence[str]]]] = None,
+        signals: Optional[Dict[str, Sequence[str]]] = None,
+        rng: Optional[random.Random] = None,
+    ):
+        self.rng = rng or random.Random()
+        self.index: Dict[Tuple[str, str, str], Tuple[str, ...]] = {}
+        for source, categories in (bank or DEFAULT_BANK).items():
+            for key, comments in categories.items():
+                primary, _, secondary = key.partition("/")
+                self.index[(source, primary, secondary or "*")] = tuple(comments)
+        self.signals = {name: tuple(comments) for name, comments in (signals or SIGNAL_COMMENTS).items()}
+
+    @classmethod
+    def from_env(cls) -> "CommentBank":
+        bank = {source: dict(categories) for source, categories in DEFAULT_BANK.items()}
+        if COMMENT_BANK_PATH:
+            try:
+                with open(COMMENT_BANK_PATH, encoding="utf-8") as f:
+                    for source, categories in json.load(f).items():
+                        bank.setdefault(source, {}).update(categories)
+                logger.info("Loaded comment bank from %s", COMMENT_BANK_PATH)
+            except (OSError, ValueError) as e:
+                logger.error("Failed to load comment bank: %s", e)
+        return cls(bank)
+
+    def candidates(self, source: str, category: Optional[Tuple[str, str]] = None) -> Tuple[str, ...]:
+        """カテゴリに最も近い候補（完全一致 → 種類のみ一致 → 汎用の順）"""
+        primary, secondary = category or ("*", "*")
+        for key in ((source, primary, secondary), (source, primary, "*"), (source, "*", "*")):
+            comments = self.index.get(key)
+            if comments:
+                return comments
+        return self.index.get(("screen", "*", "*"), ())
+
+    def pick(
+        self,
+        source: str,
+        count: int,
+        category: Optional[Tuple[str, str]] = None,
+        signals: Iterable[str] = (),
+        avoid: Iterable[str] = (),
+    ) -> List[str]:
+        """count件のコメントを選ぶ（シグナルに合うものを先頭に、直近のコメントは避ける）"""
+        avoid = set(avoid)
+        picked: List[str] = []
+        for signal in signals:
+            options = [c for c in self.signals.get(signal, ()) if c not in avoid and c not in picked]
+            if options and len(picked) < count:
+                picked.append(self.rng.choice(options))
+        options = [c for c in self.candidates(source, category) if c not in avoid and c not in picked]
+        self.rng.shuffle(options)
+        picked.extend(options[:max(0, count - len(picked))])
+        if not picked:
+            # 候補をすべて使い切っていたら重複を許す
+            picked.append(self.rng.choice(self.candidates(source, category)))
+        return picked
+
+
+_default_bank: Optional[CommentBank] = None
+
+
+def get_comment_bank() -> CommentBank:
+    """プロセス内で共有するコメント集を取得"""
+    global _default_bank
+    if _default_bank is None:
+        _default_bank = CommentBank.from_env()
+    return _default_bank
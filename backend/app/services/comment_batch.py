@@ -0,0 +1,70 @@
+import os
+import re
+from typing import Awaitable, Callable, List, Optional
+
+import openai
+
+from .openai_client import create_chat_text
+
+# 1回の呼び出しでまとめて生成するコメントの件数（1なら従来どおり1件ずつ）
+COMMENT_BATCH_SIZE = int(os.getenv("COMMENT_BATCH_SIZE", "4"))
+# コメント1件あたりに見込むトークン数
+TOKENS_PER_COMMENT = 30
+
+# 行頭の箇条書きの記号や番号（「- 」「1. 」「(2) 」など）
+_LIST_MARKER = re.compile(r"^\s*(?:[-*・•]|[(（]?\d+[.)）．、:：])\s*")
+
+
+def batch_instruction(count: int) -> str:
+    """プロンプトの末尾に付ける出力形式の指示"""
+    if count <= 1:
+        return "コメントを1つだけ出力してください。"
+    return f"互いに異なるコメントを{count}個、1行に1つずつ出力してください。番号や記号は付けないでください。"
+
+
+def batch_max_tokens(count: int, per_comment: int = TOKENS_PER_COMMENT) -> int:
+    return per_comment * max(1, count)
+
+
+def split_comments(text: str, limit: int) -> List[str]:
+    """改行区切りで返されたコメントを分割する（番号・記号・引用符を除き、重複と空行は捨てる）"""
+    comments: List[str] = []
+    for line in text.splitlines():
+        comment = _LIST_MARKER.sub("", line).strip().strip("「」\"'").strip()
+        if comment and comment not in comments:
+            comments.append(comment)
+        if len(comments) >= limit:
+            break
+    return comments
+
+
+def join_comments(comments: List[str]) -> str:
+    """キャッシュに1つの文字列として保存するための形式"""
+    return "\n".join(comments)
+
+
+async def create_comment_batch(
+    client: openai.AsyncOpenAI,
+    count: int,
+    on_delta: Optional[Callable[[str], Awaitable[None]]] = None,
+    **kwargs,
+) -> List[str]:
+    """チャット補完でcount件のコメントをまとめて生成する
+
+    on_deltaが指定された場合は、1件目のコメント（最初の改行まで）だけを逐次送信する。
+    残りのコメントは呼び出し側で間隔を空けて送る想定。
+    """
+    first_line_open = True
+
+    async def first_line_only(delta: str):
+        nonlocal first_line_open
+        if not first_line_open:
+            return
+        head, newline, _ = delta.partition("\n")
+        if newline:
+            first_line_open = False
+        if head:
+            await on_delta(head)
+
+    text = await create_chat_text(client, first_line_only if on_delta else None, **kwargs)
+    return split_comments(text, count)
@@ -0,0 +1,368 @@
+import asyncio
+import base64
+import logging
+import os
+import struct
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Tuple, Union
+
+import cv2
+import numpy as np
+
+from .change_detector import compute_dhash
+from ..metrics import STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# 画像の前処理を実行するプールの種類（thread / process）とワーカー数
+IMAGE_EXECUTOR = os.getenv("IMAGE_EXECUTOR", "thread")
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "0")) or None
+# 画像の内容に応じて解像度・JPEG品質・detailを選ぶかどうか
+IMAGE_ADAPTIVE = os.getenv("IMAGE_ADAPTIVE", "true").lower() == "true"
+
+# 縮小デコードのフラグ（縮小率の大きい順）
+_REDUCED_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+# JPEGのSOFマーカー（DHT/JPG/DACを除く）
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+# 変化領域の切り出しと画像の統計に使う縮小グレースケール画像の幅
+THUMBNAIL_WIDTH = 160
+# 縮小画像で輝度がこの値以上変わった画素を「変化した」とみなす
+CHANGE_PIXEL_THRESHOLD = 24
+# 変化した領域がフレームのこの割合未満のときだけ切り出す（大きく変わったときは全体を送る）
+CROP_MAX_AREA = 0.5
+# 切り出す領域の周囲に付ける余白（縮小画像の画素数）と、切り出し後の最小サイズ（元画像に対する割合）
+CROP_MARGIN = 6
+CROP_MIN_FRACTION = 0.3
+
+
+@dataclass(frozen=True)
+class ImageProfile:
+    """Vision APIに送る画像の解像度（長辺）・JPEG品質・detail"""
+    name: str
+    target_size: int
+    jpeg_quality: int
+    detail: str
+
+
+# 文字の多い画面は高解像度・detail=highで読めるように、平坦な映像は小さく粗く送る
+# （detail=lowは512px四方に縮小されて固定の少ないトークン数になる）
+PROFILES = {
+    "text": ImageProfile("text", 1024, 80, "high"),
+    "default": ImageProfile("default", 512, 80, "low"),
+    "flat": ImageProfile("flat", 384, 65, "low"),
+}
+# Vision APIに送る画像のdata URLの先頭
+DATA_URL_PREFIX = b"data:image/jpeg;base64,"
+# 文字らしいブロックの割合・エッジ密度のしきい値
+TEXT_BLOCK_RATIO = 0.2
+FLAT_EDGE_DENSITY = 0.02
+
+
+@dataclass
+class PreparedFrame:
+    """Vision APIに送る準備ができたフレーム"""
+    # リクエストにそのまま入れるdata URL（data:image/jpeg;base64,...）
+    image_url: str
+    frame_hash: np.ndarray
+    width: int
+    height: int
+    timings: Dict[str, float] = field(default_factory=dict)
+    detail: str = "auto"
+    profile: str = "fixed"
+    # 変化した領域を切り出した場合のデコード後の画像上の (x, y, w, h)
+    crop: Optional[Tuple[int, int, int, int]] = None
+    thumbnail: Optional[np.ndarray] = None
+    stats: Dict[str, float] = field(default_factory=dict)
+
+
+def probe_dimensions(data: bytes) -> Optional[Tuple[int, int]]:
+    """PNG/JPEG/WebPのヘッダーから画像サイズ (width, height) を読み取る"""
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and len(data) >= 24:
+        width, height = struct.unpack(">II", data[16:24])
+        return width, height
+    if data[:2] == b"\xff\xd8":
+        pos = 2
+        length = len(data)
+        while pos + 9 < length:
+            if data[pos] != 0xFF:
+                pos += 1
+                continue
+            marker = data[pos + 1]
+            if marker in _JPEG_SOF_MARKERS:
+                height, width = struct.unpack(">HH", data[pos + 5:pos + 9])
+                return width, height
+            if marker == 0xFF:
+                pos += 1
+                continue
+            if marker == 0xDA:  # SOSより後ろにSOFは現れない
+                break
+            if 0xD0 <= marker <= 0xD9:
+                pos += 2
+                continue
+            segment_length = struct.unpack(">H", data[pos + 2:pos + 4])[0]
+            pos += 2 + segment_length
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP" and len(data) >= 30:
+        chunk = data[12:16]
+        if chunk == b"VP8X":  # 拡張形式: 24ビットの (幅 - 1), (高さ - 1)
+            width = int.from_bytes(data[24:27], "little") + 1
+            height = int.from_bytes(data[27:30], "little") + 1
+            return width, height
+        if chunk == b"VP8 ":  # 非可逆: キーフレームのヘッダーに14ビットの幅・高さ
+            width, height = struct.unpack("<HH", data[26:30])
+            return width & 0x3FFF, height & 0x3FFF
+        if chunk == b"VP8L":  # 可逆: 14ビットずつ (幅 - 1), (高さ - 1)
+            bits = int.from_bytes(data[21:25], "little")
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    return None
+
+
+def select_decode_flag(data: bytes, target_size: int) -> int:
+    """長辺がtarget_sizeを下回らない範囲で最も縮小率の大きいデコードフラグを選ぶ"""
+    dimensions = probe_dimensions(data)
+    if dimensions is None:
+        return cv2.IMREAD_COLOR
+    long_side = max(dimensions)
+    for factor, flag in _REDUCED_FLAGS:
+        if long_side // factor >= target_size:
+            return flag
+    return cv2.IMREAD_COLOR
+
+
+def fit_within(frame: np.ndarray, target_size: int) -> np.ndarray:
+    """アスペクト比を保ったまま長辺がtarget_size以下になるように縮小"""
+    height, width = frame.shape[:2]
+    scale = target_size / max(height, width)
+    if scale >= 1.0:
+        return frame
+    new_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return cv2.resize(frame, new_size, interpolation=cv2.INTER_AREA)
+
+
+def make_thumbnail(frame: np.ndarray) -> np.ndarray:
+    """統計・差分用の縮小グレースケール画像（幅THUMBNAIL_WIDTH、アスペクト比維持）"""
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+    height, width = gray.shape[:2]
+    size = (THUMBNAIL_WIDTH, max(1, round(height * THUMBNAIL_WIDTH / width)))
+    return cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+
+
+def image_statistics(thumbnail: np.ndarray) -> Dict[str, float]:
+    """エッジ密度・文字らしさ（エッジの詰まった小ブロックの割合）・明るさ"""
+    edges = cv2.Canny(thumbnail, 50, 150) > 0
+    edge_density = float(edges.mean())
+    brightness = float(thumbnail.mean()) / 255
+    # 8x8ブロックごとのエッジ密度。文字の行はエッジが細かく詰まったブロックが横に並ぶ
+    height, width = (dim - dim % 8 for dim in edges.shape)
+    if height == 0 or width == 0:
+        return {"edge_density": edge_density, "text_blocks": 0.0, "brightness": brightness}
+    blocks = edges[:height, :width].reshape(height // 8, 8, width // 8, 8).mean(axis=(1, 3))
+    text_blocks = float(((blocks > 0.15) & (blocks < 0.6)).mean())
+    return {"edge_density": edge_density, "text_blocks": text_blocks, "brightness": brightness}
+
+
+def select_profile(stats: Dict[str, float]) -> ImageProfile:
+    if stats["text_blocks"] >= TEXT_BLOCK_RATIO:
+        return PROFILES["text"]
+    if stats["edge_density"] < FLAT_EDGE_DENSITY:
+        return PROFILES["flat"]
+    return PROFILES["default"]
+
+
+def changed_region(
+    thumbnail: np.ndarray, previous: Optional[np.ndarray]
+) -> Optional[Tuple[int, int, int, int]]:
+    """前回の縮小画像から変化した画素を囲む矩形 (x, y, w, h)（縮小画像の座標）
+
+    比較できない場合や変化が広すぎる・ない場合はNone。
+    """
+    if previous is None or previous.shape != thumbnail.shape:
+        return None
+    changed = cv2.absdiff(thumbnail, previous) > CHANGE_PIXEL_THRESHOLD
+    points = cv2.findNonZero(changed.astype(np.uint8))
+    if points is None:
+        return None
+    x, y, w, h = cv2.boundingRect(points)
+    height, width = thumbnail.shape[:2]
+    x0, y0 = max(0, x - CROP_MARGIN), max(0, y - CROP_MARGIN)
+    x1, y1 = min(width, x + w + CROP_MARGIN), min(height, y + h + CROP_MARGIN)
+    # 小さすぎる切り出しは何をしているか分からなくなるので最小サイズまで広げる
+    min_w, min_h = round(width * CROP_MIN_FRACTION), round(height * CROP_MIN_FRACTION)
+    if x1 - x0 < min_w:
+        x0 = max(0, min(x0 - (min_w - (x1 - x0)) // 2, width - min_w))
+        x1 = x0 + min_w
+    if y1 - y0 < min_h:
+        y0 = max(0, min(y0 - (min_h - (y1 - y0)) // 2, height - min_h))
+        y1 = y0 + min_h
+    if (x1 - x0) * (y1 - y0) >= CROP_MAX_AREA * width * height:
+        return None
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def prepare_frame(
+    data: Union[bytes, memoryview],
+    target_size: int = 512,
+    jpeg_quality: int = 85,
+    hash_size: int = 16,
+    adaptive: bool = False,
+    previous_thumbnail: Optional[np.ndarray] = None,
+    crop_changes: bool = False,
+) -> Optional[PreparedFrame]:
+    """デコード → 変化検出用ハッシュ → （内容に応じた設定の選択・変化領域の切り出し）→ リサイズ → JPEGエンコード → base64
+
+    adaptive=Trueの場合はtarget_size・jpeg_qualityの代わりに画像の統計から選んだPROFILESを使う。
+    crop_changes=Trueの場合はprevious_thumbnailとの差分が小さければその領域だけを切り出す。
+    プロセスプールからも呼べるようにモジュールレベルの関数にしている。
+    デコードに失敗した場合はNoneを返す。
+    """
+    timings = {}
+    profile = ImageProfile("fixed", target_size, jpeg_quality, "auto")
+
+    start = time.perf_counter()
+    decode_size = max(p.target_size for p in PROFILES.values()) if adaptive else target_size
+    frame = cv2.imdecode(np.frombuffer(data, np.uint8), select_decode_flag(data, decode_size))
+    timings["decode"] = time.perf_counter() - start
+    if frame is None:
+        return None
+
+    start = time.perf_counter()
+    frame_hash = compute_dhash(frame, hash_size)
+    timings["hash"] = time.perf_counter() - start
+
+    stats = {}
+    crop = None
+    thumbnail = None
+    if adaptive or crop_changes:
+        start = time.perf_counter()
+        thumbnail = make_thumbnail(frame)
+        if adaptive:
+            stats = image_statistics(thumbnail)
+            profile = select_profile(stats)
+            if previous_thumbnail is not None and previous_thumbnail.shape == thumbnail.shape:
+                # 前回解析したフレームから変化した画素の割合（上流を使えないときのコメント選びに使う）
+                stats["motion"] = float((cv2.absdiff(thumbnail, previous_thumbnail) > CHANGE_PIXEL_THRESHOLD).mean())
+        if crop_changes:
+            region = changed_region(thumbnail, previous_thumbnail)
+            if region is not None:
+                # 縮小画像の座標を元画像の座標に戻して切り出す
+                scale = frame.shape[1] / thumbnail.shape[1]
+                x, y, w, h = (round(v * scale) for v in region)
+                frame = frame[y:y + h, x:x + w]
+                crop = (x, y, w, h)
+        timings["analyze"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    process_frame = fit_within(frame, profile.target_size)
+    timings["resize"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ok, encoded = cv2.imencode(".jpg", process_frame, [cv2.IMWRITE_JPEG_QUALITY, profile.jpeg_quality])
+    timings["encode"] = time.perf_counter() - start
+    if not ok:
+        return None
+
+    start = time.perf_counter()
+    # エンコード結果のバッファから直接base64にし、data URLの文字列はここで1回だけ作る
+    image_url = (DATA_URL_PREFIX + base64.b64encode(encoded)).decode("ascii")
+    timings["base64"] = time.perf_counter() - start
+
+    height, width = process_frame.shape[:2]
+    return PreparedFrame(
+        image_url, frame_hash, width, height, timings,
+        detail=profile.detail, profile=profile.name, crop=crop, thumbnail=thumbnail, stats=stats,
+    )
+
+
+class ImagePreprocessor:
+    """画像の前処理をイベントループ外（スレッド/プロセスプール）で実行"""
+
+    def __init__(self, executor_kind: str = IMAGE_EXECUTOR, max_workers: Optional[int] = IMAGE_WORKERS):
+        self.executor_kind = executor_kind
+        self.max_workers = max_workers
+        self._executor: Optional[Executor] = None
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            if self.executor_kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="image")
+            logger.info("Image preprocessing executor started: %s", self.executor_kind)
+        return self._executor
+
+    async def prepare(self, data: Union[bytes, memoryview], **kwargs) -> Optional[PreparedFrame]:
+        loop = asyncio.get_running_loop()
+        submitted = time.perf_counter()
+        if self.executor_kind == "process" and isinstance(data, memoryview):
+            # memoryviewはpickleできないので、プロセスプールに渡すときだけコピーする
+            data = bytes(data)
+        prepared = await loop.run_in_executor(self.executor, _prepare_frame_call, data, kwargs)
+        if prepared is not None:
+            # プールの待ち時間も含めた合計時間
+            prepared.timings["total"] = time.perf_counter() - submitted
+            for stage, seconds in prepared.timings.items():
+                STAGE_SECONDS.observe(seconds, f"image_{stage}")
+            if logger.isEnabledFor(logging.DEBUG):
+                # 内訳の文字列を作るのはデバッグ時だけ
+                logger.debug(
+                    "Frame prepared (%s, %dx%d, %d bytes of data URL, crop=%s): %s",
+                    prepared.profile, prepared.width, prepared.height, len(prepared.image_url), prepared.crop,
+                    ", ".join(f"{stage}={seconds * 1000:.1f}ms" for stage, seconds in prepared.timings.items()),
+                )
+        return prepared
+
+    async def warm_up(self) -> int:
+        """プールのワーカーを起動し、各ワーカーでPNG/JPEG/WebPのデコードとエンコードを一度ずつ行う
+
+        初回のフレームでコーデックの初期化やプロセスの起動を待たないようにする。処理したフレーム数を返す。
+        """
+        loop = asyncio.get_running_loop()
+        workers = self.max_workers or min(32, (os.cpu_count() or 1) + 4)
+        samples = _codec_samples()
+        calls = [
+            loop.run_in_executor(self.executor, _prepare_frame_call, sample, {"adaptive": True})
+            for _ in range(workers if self.executor_kind == "process" else 1)
+            for sample in samples
+        ]
+        results = await asyncio.gather(*calls)
+        return sum(result is not None for result in results)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+def _codec_samples() -> Tuple[bytes, ...]:
+    """コーデックの初期化に使う小さな画像（クライアントが送ってくる形式）"""
+    frame = np.zeros((64, 96, 3), np.uint8)
+    cv2.putText(frame, "warm", (4, 40), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 1)
+    samples = []
+    for ext in (".png", ".jpg", ".webp"):
+        ok, encoded = cv2.imencode(ext, frame)
+        if ok:
+            samples.append(encoded.tobytes())
+    return tuple(samples)
+
+
+def _prepare_frame_call(data: bytes, kwargs: dict) -> Optional[PreparedFrame]:
+    return prepare_frame(data, **kwargs)
+
+
+_default_preprocessor: Optional[ImagePreprocessor] = None
+
+
+def get_image_preprocessor() -> ImagePreprocessor:
+    """プロセス内で共有する前処理プールを取得"""
+    global _default_preprocessor
+    if _default_preprocessor is None:
+        _default_preprocessor = ImagePreprocessor()
+    return _default_preprocessor
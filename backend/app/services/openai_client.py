@@ -0,0 +1,178 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import httpx
+import openai
+
+logger = logging.getLogger(__name__)
+
+# 用途ごとのデフォルトのタイムアウト（秒）
+DEFAULT_TIMEOUTS = {
+    "vision": 20.0,
+    "chat": 10.0,
+    "transcription": 30.0,
+}
+
+
+class OpenAIClientRegistry:
+    """アプリ全体で共有するOpenAIクライアント
+
+    接続プールとTLSセッションを使い回すため、クライアントはアプリ起動時に1つだけ作成し、
+    各サービスには用途別（vision / chat / transcription）のタイムアウトを設定したビューを渡す。
+    base_urlを差し替えればローカルのスタブサーバーに向けることもできる。
+    """
+
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        base_url: Optional[str] = None,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 30.0,
+        connect_timeout: float = 5.0,
+        timeouts: Optional[Dict[str, float]] = None,
+        max_retries: int = 2,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.connect_timeout = connect_timeout
+        self.timeouts = {**DEFAULT_TIMEOUTS, **(timeouts or {})}
+        self.max_retries = max_retries
+        # httpxのトランスポート（リプレイなどでスタブのASGIアプリに直接つなぐ場合に指定）
+        self.transport = transport
+        self._client: Optional[openai.AsyncOpenAI] = None
+        self._http_client: Optional[httpx.AsyncClient] = None
+        self._views: Dict[str, openai.AsyncOpenAI] = {}
+
+    @classmethod
+    def from_env(cls) -> "OpenAIClientRegistry":
+        return cls(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            base_url=os.getenv("OPENAI_BASE_URL") or None,
+            max_connections=int(os.getenv("OPENAI_MAX_CONNECTIONS", "100")),
+            max_keepalive_connections=int(os.getenv("OPENAI_MAX_KEEPALIVE", "20")),
+            keepalive_expiry=float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "30")),
+            connect_timeout=float(os.getenv("OPENAI_CONNECT_TIMEOUT", "5")),
+            timeouts={
+                kind: float(os.getenv(f"OPENAI_TIMEOUT_{kind.upper()}", default))
+                for kind, default in DEFAULT_TIMEOUTS.items()
+            },
+            max_retries=int(os.getenv("OPENAI_MAX_RETRIES", "2")),
+        )
+
+    async def start(self):
+        """接続プールを作成（FastAPIのstartupで呼ぶ）"""
+        if self._client is not None:
+            return
+        self._http_client = openai.DefaultAsyncHttpxClient(
+            limits=self.limits,
+            timeout=httpx.Timeout(max(self.timeouts.values()), connect=self.connect_timeout),
+            transport=self.transport,
+        )
+        self._client = openai.AsyncOpenAI(
+            api_key=self.api_key,
+            base_url=self.base_url,
+            http_client=self._http_client,
+            max_retries=self.max_retries,
+        )
+        logger.info(
+            "OpenAI client pool started (base_url=%s, max_connections=%s)",
+            self._client.base_url, self.limits.max_connections,
+        )
+
+    async def preconnect(self, connections: int = 2) -> int:
+        """上流へのTCP/TLS接続を事前に張って接続プールに残す（APIは呼ばない）
+
+        応答のステータスは問わない。接続できた数を返す。
+        """
+        url = str(self.client.base_url)
+
+        async def connect() -> bool:
+            try:
+                await self._http_client.head(url, timeout=self.connect_timeout)
+                return True
+            except Exception as e:
+                logger.warning("Preconnect to %s failed: %s", url, e)
+                return False
+
+        results = await asyncio.gather(*(connect() for _ in range(connections)))
+        return sum(results)
+
+    async def close(self):
+        """接続プールを閉じる（FastAPIのshutdownで呼ぶ）"""
+        if self._client is not None:
+            await self._client.close()
+        self._client = None
+        self._http_client = None
+        self._views = {}
+
+    @property
+    def client(self) -> openai.AsyncOpenAI:
+        if self._client is None:
+            raise RuntimeError("OpenAIClientRegistry is not started")
+        return self._client
+
+    def get(self, kind: str) -> openai.AsyncOpenAI:
+        """用途別のタイムアウトを設定したクライアント（接続プールは共有）"""
+        view = self._views.get(kind)
+        if view is None:
+            view = self.client.with_options(timeout=self.timeouts.get(kind, self.timeouts["chat"]))
+            self._views[kind] = view
+        return view
+
+
+async def create_chat_text(
+    client: openai.AsyncOpenAI,
+    on_delta: Optional[Callable[[str], Awaitable[None]]] = None,
+    **kwargs,
+) -> str:
+    """チャット補完を実行して本文を返す
+
+    on_deltaが指定された場合はストリーミングで受信し、差分を受け取るたびにコールバックする。
+    """
+    if on_delta is None:
+        response = await client.chat.completions.create(**kwargs)
+        return response.choices[0].message.content or ""
+
+    parts = []
+    stream = await client.chat.completions.create(stream=True, **kwargs)
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            parts.append(delta)
+            await on_delta(delta)
+    return "".join(parts)
+
+
+async def create_structured(
+    client: openai.AsyncOpenAI,
+    name: str,
+    schema: Dict[str, Any],
+    **kwargs,
+) -> Dict[str, Any]:
+    """JSONスキーマを指定した構造化出力でチャット補完を実行し、辞書として返す
+
+    マークダウンの```jsonを取り除くような後処理は不要になる。
+    """
+    response = await client.chat.completions.create(
+        response_format={
+            "type": "json_schema",
+            "json_schema": {"name": name, "strict": True, "schema": schema},
+        },
+        **kwargs,
+    )
+    message = response.choices[0].message
+    if getattr(message, "refusal", None):
+        raise ValueError(f"Structured output refused: {message.refusal}")
+    return json.loads(message.content)
@@ -0,0 +1,204 @@
+import asyncio
+import itertools
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, List, Optional
+
+import openai
+
+from ..metrics import STAGE_SECONDS, UPSTREAM_ERRORS
+
+logger = logging.getLogger(__name__)
+
+# 優先度（小さいほど優先）。音声への返答を画面・カメラより先に通す
+PRIORITY_AUDIO = 0
+PRIORITY_SCREEN = 1
+PRIORITY_CAMERA = 2
+
+# 混雑度がこの値以上になったら、その優先度の新しい解析を受け付けない（音声は常に受け付ける）
+SHED_THRESHOLDS = {
+    PRIORITY_AUDIO: None,
+    PRIORITY_SCREEN: 0.75,
+    PRIORITY_CAMERA: 0.5,
+}
+
+
+class _Waiter:
+    __slots__ = ("priority", "session_id", "seq", "future")
+
+    def __init__(self, priority: int, session_id: str, seq: int, future: asyncio.Future):
+        self.priority = priority
+        self.session_id = session_id
+        self.seq = seq
+        self.future = future
+
+
+class RateGovernor:
+    """プロセス全体で共有する上流APIのレート制御（トークンバケット + 同時実行数）
+
+    待機中のリクエストは優先度順に、同じ優先度の中では実行中・処理済みの件数が少ないセッションから通す。
+    上流からレート制限エラーが返ったら流量を半分に絞り、成功するたびに少しずつ戻す。
+    """
+
+    def __init__(
+        self,
+        rate: float = 10.0,
+        burst: int = 20,
+        max_concurrency: int = 16,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.clock = clock
+
+        self.tokens = float(burst)
+        self.updated_at = clock()
+        self.inflight = 0
+        self.inflight_by_session: Dict[str, int] = {}
+        # 待機中のリクエストがあるセッションに割り当てた件数（公平性の判定用）
+        self.served_by_session: Dict[str, int] = {}
+        self.waiters: List[_Waiter] = []
+        self._seq = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self.rate_limited_count = 0
+
+    @classmethod
+    def from_env(cls) -> "RateGovernor":
+        return cls(
+            rate=float(os.getenv("UPSTREAM_RATE", "10")),
+            burst=int(os.getenv("UPSTREAM_BURST", "20")),
+            max_concurrency=int(os.getenv("UPSTREAM_CONCURRENCY", "16")),
+        )
+
+    def pressure(self) -> float:
+        """混雑度（0.0〜1.0）。待機数と、レート制限で絞った流量の割合の大きい方"""
+        queued = len(self.waiters) / max(1, self.max_concurrency)
+        throttled = 1.0 - self.rate / self.base_rate
+        return min(1.0, max(queued, throttled))
+
+    def admit(self, priority: int) -> bool:
+        """混雑時に低優先度の解析を上流へ送る前に断るかどうか"""
+        threshold = SHED_THRESHOLDS.get(priority)
+        return threshold is None or self.pressure() < threshold
+
+    @asynccontextmanager
+    async def slot(self, priority: int, session_id: str, stage: Optional[str] = None):
+        """上流APIを1回呼ぶ間、枠を確保する
+
+        stageを指定すると、枠の待ち時間と呼び出し自体の所要時間をメトリクスに記録する。
+        """
+        started = time.perf_counter()
+        await self._acquire(priority, session_id)
+        acquired = time.perf_counter()
+        if stage is not None:
+            STAGE_SECONDS.observe(acquired - started, "upstream_wait")
+        try:
+            yield
+        except openai.RateLimitError:
+            UPSTREAM_ERRORS.inc("RateLimitError")
+            self._on_rate_limited()
+            raise
+        except Exception as e:
+            UPSTREAM_ERRORS.inc(type(e).__name__)
+            raise
+        else:
+            self._on_success()
+        finally:
+            if stage is not None:
+                STAGE_SECONDS.observe(time.perf_counter() - acquired, stage)
+            self._release(session_id)
+
+    async def _acquire(self, priority: int, session_id: str):
+        self._refill()
+        if not self.waiters and self._can_grant():
+            self._grant(session_id)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append(_Waiter(priority, session_id, next(self._seq), future))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 枠を割り当てられた直後にキャンセルされた場合は返却する
+                self._release(session_id)
+            else:
+                self.waiters = [w for w in self.waiters if w.future is not future]
+            raise
+
+    def _can_grant(self) -> bool:
+        return self.inflight < self.max_concurrency and self.tokens >= 1.0
+
+    def _grant(self, session_id: str):
+        self.tokens -= 1.0
+        self.inflight += 1
+        self.inflight_by_session[session_id] = self.inflight_by_session.get(session_id, 0) + 1
+        self.served_by_session[session_id] = self.served_by_session.get(session_id, 0) + 1
+
+    def _release(self, session_id: str):
+        self.inflight -= 1
+        remaining = self.inflight_by_session.get(session_id, 1) - 1
+        if remaining > 0:
+            self.inflight_by_session[session_id] = remaining
+        else:
+            self.inflight_by_session.pop(session_id, None)
+            if not any(w.session_id == session_id for w in self.waiters):
+                self.served_by_session.pop(session_id, None)
+        self._dispatch()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def _dispatch(self):
+        self._refill()
+        while self.waiters and self._can_grant():
+            waiter = min(
+                self.waiters,
+                key=lambda w: (
+                    w.priority,
+                    self.inflight_by_session.get(w.session_id, 0),
+                    self.served_by_session.get(w.session_id, 0),
+                    w.seq,
+                ),
+            )
+            self.waiters.remove(waiter)
+            if waiter.future.done():
+                continue
+            self._grant(waiter.session_id)
+            waiter.future.set_result(None)
+
+        # トークン不足で待っている場合は補充されるタイミングで再度割り当てる
+        if self.waiters and self.tokens < 1.0 and self._timer is None:
+            delay = (1.0 - self.tokens) / self.rate
+            self._timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._dispatch()
+
+    def _on_rate_limited(self):
+        self.rate_limited_count += 1
+        self.rate = max(self.base_rate * 0.1, self.rate / 2)
+        logger.warning("Upstream rate limited, reducing rate to %.2f req/s", self.rate)
+
+    def _on_success(self):
+        if self.rate < self.base_rate:
+            self.rate = min(self.base_rate, self.rate + self.base_rate * 0.05)
+
+
+_default_governor: Optional[RateGovernor] = None
+
+
+def get_rate_governor() -> RateGovernor:
+    """プロセス内で共有するレート制御を取得"""
+    global _default_governor
+    if _default_governor is None:
+        _default_governor = RateGovernor.from_env()
+    return _default_governor
@@ -0,0 +1,126 @@
+import os
+import random
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Protocol
+
+import numpy as np
+
+# 正規化時に取り除く記号・空白
+_PUNCTUATION = re.compile(r"[\s、。，．,.!?！？…・「」『』（）()\[\]〜~]+")
+
+
+def normalize_text(text: str) -> str:
+    """書き起こしテキストをキャッシュキー用に正規化（全角半角・大小文字・記号の揺れを吸収）"""
+    return _PUNCTUATION.sub("", unicodedata.normalize("NFKC", text).lower())
+
+
+def image_cache_key(analyzer: str, frame_hash: np.ndarray) -> str:
+    """知覚ハッシュと解析の種類からキャッシュキーを作る"""
+    return f"{analyzer}:{np.packbits(frame_hash).tobytes().hex()}"
+
+
+def transcript_cache_key(text: str) -> str:
+    return f"transcript:{normalize_text(text)}"
+
+
+class CacheBackend(Protocol):
+    """サービスが利用するキャッシュのインターフェース（別実装に差し替え可能）"""
+
+    def get(self, key: str) -> Optional[str]: ...
+
+    def put(self, key: str, value: str) -> None: ...
+
+    def stats(self) -> Dict[str, int]: ...
+
+
+class _Entry:
+    __slots__ = ("variants", "expires_at", "last_served", "puts")
+
+    def __init__(self, expires_at: float):
+        self.variants: List[str] = []
+        self.puts = 0
+        self.expires_at = expires_at
+        self.last_served: Optional[str] = None
+
+
+class ResultCache:
+    """件数上限付きLRU + TTLのインメモリキャッシュ
+
+    1つのキーに最大max_variants件のコメントを保持し、min_variants件たまるまではミス扱いにして
+    新しいバリエーションを生成させる。ヒット時は直前に返したもの以外からランダムに選ぶ。
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl: float = 600.0,
+        max_variants: int = 3,
+        min_variants: int = 2,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_variants = max_variants
+        self.min_variants = min(min_variants, max_variants)
+        self.clock = clock
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_env(cls) -> "ResultCache":
+        return cls(
+            max_entries=int(os.getenv("CACHE_MAX_ENTRIES", "1024")),
+            ttl=float(os.getenv("CACHE_TTL", "600")),
+            max_variants=int(os.getenv("CACHE_MAX_VARIANTS", "3")),
+            min_variants=int(os.getenv("CACHE_MIN_VARIANTS", "2")),
+        )
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at <= self.clock():
+            del self._entries[key]
+            entry = None
+        # 同じ結果しか返ってこない場合もmax_variants回生成したらヒット扱いにする
+        if entry is None or (len(entry.variants) < self.min_variants and entry.puts < self.max_variants):
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        candidates = [v for v in entry.variants if v != entry.last_served] or entry.variants
+        entry.last_served = random.choice(candidates)
+        return entry.last_served
+
+    def put(self, key: str, value: str) -> None:
+        now = self.clock()
+        entry = self._entries.get(key)
+        if entry is None or entry.expires_at <= now:
+            entry = _Entry(now + self.ttl)
+            self._entries[key] = entry
+        self._entries.move_to_end(key)
+
+        entry.puts += 1
+        if value not in entry.variants:
+            entry.variants.append(value)
+            if len(entry.variants) > self.max_variants:
+                entry.variants.pop(0)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def clear(self):
+        self._entries.clear()
@@ -1,145 +1,374 @@
-import cv2
-import numpy as np
-from typing import Dict, Union, Any
+from typing import Awaitable, Callable, Dict, List, Union, Any, Optional
 import logging
-import openai
+import os
+from .openai_client import OpenAIClientRegistry, create_structured
+from .comment_batch import (
+    COMMENT_BATCH_SIZE,
+    batch_instruction,
+    batch_max_tokens,
+    create_comment_batch,
+    join_comments,
+    split_comments,
+)
+from .image_processing import IMAGE_ADAPTIVE, ImagePreprocessor, PreparedFrame, get_image_preprocessor
+from .comment_bank import CommentBank, get_comment_bank, local_signals
+from .result_cache import CacheBackend, image_cache_key
+from .rate_governor import PRIORITY_SCREEN, RateGovernor, get_rate_governor
+from .upstream_guard import UpstreamGuard, UpstreamUnavailable, get_upstream_guard
+from ..logging_config import SAMPLED
+from ..metrics import FALLBACK_COMMENTS
+from ..session import COMMENT_HISTORY_SIZE, AnalyzerState
 import time
-import base64
 import json
 
 logger = logging.getLogger(__name__)
 
+# 解析モード（chain: 画像認識とコメント生成を2回に分けて呼ぶ / fused: 1回の呼び出しで生成）
+ANALYZER_MODE = os.getenv("ANALYZER_MODE", "chain")
+
+# fusedモードで使う構造化出力のスキーマ
+FUSED_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "screen_type": {"type": "string", "enum": ["エディタ", "ブラウザ", "ターミナル", "その他"]},
+        "user_action": {"type": "string", "enum": ["コーディング", "閲覧", "コマンド実行", "その他"]},
+        "comments": {"type": "array", "items": {"type": "string"}},
+    },
+    "required": ["screen_type", "user_action", "comments"],
+    "additionalProperties": False,
+}
+
+FUSED_SYSTEM_PROMPT = """
+あなたは映像（画面共有）に対してリアクションを返すAIです。
+画像を見てscreen_typeとuser_actionを判定し、視聴者としてのコメントをcommentsに指定された件数だけ入れてください。
+コメントは自然な日本語で、5文字以下の短文が8割以上ですが、長めのコメントもごくたまに含まれます。
+反応のバリエーションを増やし、面白い・共感・驚き・ツッコミなど多様なトーンを持たせてください。
+カジュアルな表現やスラングがほとんどです。句点は付けず、絵文字もたまに加えてください。
+直前のコメントと同じ内容は避けてください。
+"""
+
 class ScreenAnalyzer:
-    def __init__(self):
-        self.comment_history = []
-        self.max_history_size = 10
-        self.cleanup_counter = 0
-        
-    async def cleanup_old_data(self):
-        self.cleanup_counter += 1
-        if self.cleanup_counter > 100:  # 100フレームごとにクリーンアップ
-            self.comment_history = self.comment_history[-self.max_history_size:]
-            self.cleanup_counter = 0
-        
-    async def analyze_frame(self, frame_data: bytes) -> Dict[str, Union[str, bool, Dict[str, str]]]:
+    # dHash（256ビット）のハミング距離がこの値以下なら変化なしとみなす
+    CHANGE_THRESHOLD = 6
+    # Vision APIに送る画像の長辺（px）。adaptiveの場合は画像の内容から選ぶ
+    TARGET_SIZE = 512
+    # 編集中の行など、変化した領域だけを切り出して送る
+    CROP_TO_CHANGES = True
+    # 画像認識とコメント生成に使うモデル（サーキットブレーカーはモデルごと）
+    VISION_MODEL = "gpt-4o-mini"
+    COMMENT_MODEL = "gpt-3.5-turbo"
+
+    def __init__(
+        self,
+        clients: OpenAIClientRegistry,
+        preprocessor: Optional[ImagePreprocessor] = None,
+        mode: str = ANALYZER_MODE,
+        cache: Optional[CacheBackend] = None,
+        governor: Optional[RateGovernor] = None,
+        adaptive: bool = IMAGE_ADAPTIVE,
+        batch_size: int = COMMENT_BATCH_SIZE,
+        guard: Optional[UpstreamGuard] = None,
+        bank: Optional[CommentBank] = None,
+    ):
+        # アプリ全体で共有するOpenAIクライアント
+        self.clients = clients
+        self.adaptive = adaptive
+        # 1回の呼び出しで生成するコメントの件数（送信の間隔はパイプライン側で調整する）
+        self.batch_size = batch_size
+        self.mode = mode
+        # 同じ画面（知覚ハッシュが一致）に対するコメントを使い回すキャッシュ
+        self.cache = cache
+        # デコード・リサイズ・エンコードはイベントループ外で実行する
+        self.preprocessor = preprocessor or get_image_preprocessor()
+        # 上流APIの呼び出しは全サービス共通のレート制御を通す
+        self.governor = governor or get_rate_governor()
+        # 上流の呼び出しの締め切りとサーキットブレーカー、障害時に使うローカルのコメント集
+        self.guard = guard or get_upstream_guard()
+        self.bank = bank or get_comment_bank()
+
+    def new_state(self) -> AnalyzerState:
+        """セッションごとの状態を作成（解析器自体は状態を持たず、全接続で共有する）"""
+        return AnalyzerState(self.CHANGE_THRESHOLD)
+
+    async def analyze_frame(
+        self,
+        frame_data: bytes,
+        state: AnalyzerState,
+        on_delta: Optional[Callable[[str], Awaitable[None]]] = None,
+    ) -> Dict[str, Union[str, bool, Dict[str, str]]]:
         try:
-            # 定期的なクリーンアップを実行
-            await self.cleanup_old_data()
-            
-            # キャッシュ用の変数
-            self.last_analysis_time = getattr(self, 'last_analysis_time', 0)
             current_time = time.time()
             
             # 最小間隔（秒）を設定
             MIN_ANALYSIS_INTERVAL = 1.0
             
-            if current_time - self.last_analysis_time < MIN_ANALYSIS_INTERVAL:
-                return self.last_result if hasattr(self, 'last_result') else {
+            if current_time - state.last_analysis_time < MIN_ANALYSIS_INTERVAL:
+                return state.last_result or {
                     "success": False,
                     "text": "",
                     "error": {"type": "too_frequent", "message": "解析間隔が短すぎます"}
                 }
             
-            # バイナリデータをnumpy配列（画像）に変換
-            nparr = np.frombuffer(frame_data, np.uint8)
-            frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+            # デコード・縮小・JPEGエンコードをプールで実行（アスペクト比は維持）
+            prepared = await self.preprocessor.prepare(
+                frame_data,
+                target_size=self.TARGET_SIZE,
+                hash_size=state.change_detector.hash_size,
+                adaptive=self.adaptive,
+                previous_thumbnail=state.change_detector.reference_thumbnail,
+                crop_changes=self.CROP_TO_CHANGES,
+            )
             
-            if frame is None:
+            if prepared is None:
                 return {
                     "success": False,
                     "text": "",
                     "error": {"type": "invalid_frame", "message": "画像データの読み込みに失敗しました"}
                 }
             
-            # 処理用に小さいサイズにリサイズ
-            process_frame = cv2.resize(frame, (512, 512))  # Vision APIの推奨サイズ
-            
+            # 前回解析時から変化がなければ解析をスキップ
+            frame_hash = prepared.frame_hash
+            if not state.change_detector.is_changed(frame_hash):
+                return {
+                    "success": False,
+                    "text": "",
+                    "error": {"type": "unchanged", "message": "画面に変化がありません"}
+                }
+
+            # 以前に見た画面と同じならキャッシュ済みのコメントを返す
+            cache_key = image_cache_key("screen", frame_hash)
+            if self.cache is not None:
+                cached_comment = self.cache.get(cache_key)
+                if cached_comment is not None:
+                    comments = split_comments(cached_comment, self.batch_size)
+                    cached_result = {
+                        "success": True,
+                        "text": comments[0],
+                        "comments": comments,
+                        "error": None
+                    }
+                    state.change_detector.remember(frame_hash, prepared.thumbnail)
+                    state.record_result(cached_result, current_time)
+                    return cached_result
+
+            # 上流の障害中は呼び出しを待たずにローカルのコメント集から返す
+            if self.guard.is_open(self.VISION_MODEL) or (self.mode != "fused" and self.guard.is_open(self.COMMENT_MODEL)):
+                return self._fallback(prepared, state, current_time, "circuit_open")
+
+            # 上流が混雑している間は低優先度の解析をアップロード前に断る
+            if not self.governor.admit(PRIORITY_SCREEN):
+                return {
+                    "success": False,
+                    "text": "",
+                    "error": {"type": "throttled", "message": "混雑のため解析を見送りました"}
+                }
+
+            if self.mode == "fused":
+                # 画像認識とコメント生成を1回のAPI呼び出しで行う
+                try:
+                    result = await self.analyze_fused(prepared, state)
+                except UpstreamUnavailable as e:
+                    logger.warning("Vision API unavailable: %s", e)
+                    return self._fallback(prepared, state, current_time, e.reason)
+                if result["success"]:
+                    if self.cache is not None:
+                        self.cache.put(cache_key, join_comments(result["comments"]))
+                    state.change_detector.remember(frame_hash, prepared.thumbnail)
+                state.record_result(result, current_time)
+                return result
+
             # 画面内容の認識（Vision APIを使用）
-            encoded_image = cv2.imencode('.jpg', process_frame)[1].tobytes()
-            vision_client = openai.AsyncOpenAI()
+            vision_client = self.clients.get("vision")
             
             try:
-                response = await vision_client.chat.completions.create(
-                    model="gpt-4o-mini",
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": [
-                                {"type": "text", "text": """
-                                この画面について以下の形式で情報を返してください。
-                                必ず以下のJSONフォーマットで返してください：
+                async with self.guard.call(
+                        self.VISION_MODEL, "vision_call",
+                        self.governor.slot(PRIORITY_SCREEN, state.session_id, stage="vision_call"),
+                ):
+                    response = await vision_client.chat.completions.create(
+                        model=self.VISION_MODEL,
+                        messages=[
+                            {
+                                "role": "user",
+                                "content": [
+                                    {"type": "text", "text": """
+                                    この画面について以下の形式で情報を返してください。
+                                    必ず以下のJSONフォーマットで返してください：
                                 
-                                {
-                                    "screen_type": "画面の種類（エディタ/ブラウザ/ターミナル/その他）",
-                                    "user_action": "ユーザーの行動（コーディング/閲覧/コマンド実行/その他）",
-                                    "content": "あなたは映像に対してリアクションを返すAIです。\
-                        コメントは自然な日本語で、5文字以下の短文が8割以上ですが、長めのコメントもごくたまに含まれます。\
-                        反応のバリエーションを増やし、面白い・共感・驚き・ツッコミなど多様なトーンを持たせてください。\
-                        カジュアルな表現やスラングがほとんどです。句点を付けたコメントは、コメントとして違和感があるのでしないでください。絵文字もたまに加えるように。"
-                                }
+                                    {
+                                        "screen_type": "画面の種類（エディタ/ブラウザ/ターミナル/その他）",
+                                        "user_action": "ユーザーの行動（コーディング/閲覧/コマンド実行/その他）",
+                                        "content": "あなたは映像に対してリアクションを返すAIです。\
+                            コメントは自然な日本語で、5文字以下の短文が8割以上ですが、長めのコメントもごくたまに含まれます。\
+                            反応のバリエーションを増やし、面白い・共感・驚き・ツッコミなど多様なトーンを持たせてください。\
+                            カジュアルな表現やスラングがほとんどです。句点を付けたコメントは、コメントとして違和感があるのでしないでください。絵文字もたまに加えるように。"
+                                    }
                                 
-                                他の文章は含めず、JSONのみを返してください。
-                                """},
-                                {
-                                    "type": "image_url",
-                                    "image_url": {
-                                        "url": f"data:image/jpeg;base64,{base64.b64encode(encoded_image).decode()}",
-                                        "detail": "auto"
+                                    他の文章は含めず、JSONのみを返してください。
+                                    """},
+                                    {
+                                        "type": "image_url",
+                                        "image_url": {
+                                            "url": prepared.image_url,
+                                            "detail": prepared.detail
+                                        }
                                     }
-                                }
-                            ]
-                        }
-                    ],
-                    max_tokens=150,
-                    temperature=0.3
-                )
+                                ]
+                            }
+                        ],
+                        max_tokens=150,
+                        temperature=0.3
+                    )
                 
                 try:
                     content = response.choices[0].message.content.strip()
                     # ```json と ``` を削除
                     content = content.replace('```json', '').replace('```', '').strip()
                     screen_content = json.loads(content)
+                    state.last_category = (screen_content.get("screen_type", "*"), screen_content.get("user_action", "*"))
                     
                     # コメントを生成
-                    comment = await self.generate_comment(screen_content)
+                    comments = await self.generate_comment(screen_content, state, on_delta)
                     
                     result = {
                         "success": True,
-                        "text": comment,
+                        "text": comments[0],
+                        "comments": comments,
                         "error": None
                     }
+                    state.change_detector.remember(frame_hash, prepared.thumbnail)
+                    if self.cache is not None and comments != ["..."]:
+                        self.cache.put(cache_key, join_comments(comments))
                     
                 except json.JSONDecodeError:
-                    logger.error(f"JSON parse error. Response: {content}")
+                    logger.error("JSON parse error. Response: %s", content)
                     result = {
                         "success": False,
                         "text": "",
                         #"error": {"type": "parse_error", "message": "画面解析に失敗しました"}
                     }
                     
+            except UpstreamUnavailable as e:
+                logger.warning("Upstream unavailable: %s", e)
+                return self._fallback(prepared, state, current_time, e.reason)
             except Exception as e:
-                logger.error(f"Vision API error: {str(e)}")
+                logger.error("Vision API error: %s", e)
                 result = {
                     "success": False,
                     "text": "",
                     "error": {"type": "api_error", "message": str(e)}
                 }
             
-            self.last_result = result
-            self.last_analysis_time = current_time
+            state.record_result(result, current_time)
             return result
             
         except Exception as e:
-            logger.error(f"Frame analysis error: {str(e)}")
+            logger.error("Frame analysis error: %s", e)
             return {
                 "success": False,
                 "text": "",
                 "error": {"type": "analysis_error", "message": str(e)}
             }
 
-    async def generate_comment(self, analysis_result: Dict[str, Any]) -> str:
+    def _fallback(
+        self, prepared: PreparedFrame, state: AnalyzerState, current_time: float, reason: str
+    ) -> Dict[str, Union[str, bool, Dict[str, str]]]:
+        """上流を使えないときに、直前に分かったカテゴリと画像の統計からローカルのコメント集で返す（キャッシュには入れない）"""
+        comments = self.bank.pick(
+            "screen",
+            self.batch_size,
+            category=state.last_category,
+            signals=local_signals(prepared.stats),
+            avoid=state.recent_comments(COMMENT_HISTORY_SIZE),
+        )
+        FALLBACK_COMMENTS.inc("screen", reason)
+        logger.info("Fallback comments (%s): %s", reason, comments, extra=SAMPLED)
+        for comment in comments:
+            state.add_comment(comment)
+        state.change_detector.remember(prepared.frame_hash, prepared.thumbnail)
+        result = {
+            "success": True,
+            "text": comments[0],
+            "comments": comments,
+            "error": None,
+            "fallback": True
+        }
+        state.record_result(result, current_time)
+        return result
+
+    async def analyze_fused(self, prepared: PreparedFrame, state: AnalyzerState) -> Dict[str, Union[str, bool, Dict[str, str]]]:
+        """画面の認識とコメント生成を構造化出力の1回の呼び出しで行う"""
+        recent_comments = " / ".join(state.recent_comments(3)) or "なし"
         try:
-            client = openai.AsyncOpenAI()
+            async with self.guard.call(
+                    self.VISION_MODEL, "fused_call",
+                    self.governor.slot(PRIORITY_SCREEN, state.session_id, stage="fused_call"),
+            ):
+                analysis = await create_structured(
+                    self.clients.get("vision"),
+                    "screen_comment",
+                    FUSED_SCHEMA,
+                    model=self.VISION_MODEL,
+                    messages=[
+                        {"role": "system", "content": FUSED_SYSTEM_PROMPT},
+                        {
+                            "role": "user",
+                            "content": [
+                                {"type": "text", "text": f"直前のコメント: {recent_comments}\n{batch_instruction(self.batch_size)}"},
+                                {
+                                    "type": "image_url",
+                                    "image_url": {
+                                        "url": prepared.image_url,
+                                        "detail": prepared.detail
+                                    }
+                                }
+                            ]
+                        }
+                    ],
+                    max_tokens=40 + batch_max_tokens(self.batch_size),
+                    temperature=0.7
+                )
+        except UpstreamUnavailable:
+            raise
+        except Exception as e:
+            logger.error("Vision API error: %s", e)
+            return {
+                "success": False,
+                "text": "",
+                "error": {"type": "api_error", "message": str(e)}
+            }
+
+        state.last_category = (analysis["screen_type"], analysis["user_action"])
+        comments = split_comments("\n".join(analysis["comments"]), self.batch_size)
+        if not comments:
+            return {
+                "success": False,
+                "text": "",
+                "error": {"type": "api_error", "message": "コメントが生成されませんでした"}
+            }
+        logger.info("Fused analysis: %s/%s -> %s", analysis["screen_type"], analysis["user_action"], comments, extra=SAMPLED)
+        for comment in comments:
+            state.add_comment(comment)
+
+        return {
+            "success": True,
+            "text": comments[0],
+            "comments": comments,
+            "error": None
+        }
+
+    async def generate_comment(
+        self,
+        analysis_result: Dict[str, Any],
+        state: AnalyzerState,
+        on_delta: Optional[Callable[[str], Awaitable[None]]] = None,
+    ) -> List[str]:
+        """解析結果からコメントをまとめて生成する
+
+        上流を使えない場合はUpstreamUnavailableを送出し、その他の失敗時は["..."]を返す。
+        """
+        try:
+            client = self.clients.get("chat")
             
             prompt = f"""
             あなたは面白いコメントを生成するAIです。コメントは5文字以下の短めがほとんどで、長めのコメントはごくわずかです。
@@ -147,25 +376,35 @@ class ScreenAnalyzer:
             {analysis_result["screen_type"]}で{analysis_result["user_action"]}中
             内容：{analysis_result["content"]}
             
-            直前のコメント: {self.comment_history[-1] if self.comment_history else "なし"}
+            直前のコメント: {state.last_comment()}
+            {batch_instruction(self.batch_size)}
             """
             
-            response = await client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "短いコメントのみを生成するAIです。余計な説明は含めません。"},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=50
-            )
-            
-            comment = response.choices[0].message.content.strip()
-            self.comment_history.append(comment)
-            if len(self.comment_history) > 10:
-                self.comment_history = self.comment_history[-10:]
+            # on_deltaが指定されていれば1件目のコメントをストリーミングで逐次送信する
+            async with self.guard.call(
+                    self.COMMENT_MODEL, "comment_call",
+                    self.governor.slot(PRIORITY_SCREEN, state.session_id, stage="comment_call"),
+            ):
+                comments = await create_comment_batch(
+                    client,
+                    self.batch_size,
+                    on_delta,
+                    model=self.COMMENT_MODEL,
+                    messages=[
+                        {"role": "system", "content": "短いコメントのみを生成するAIです。余計な説明は含めません。"},
+                        {"role": "user", "content": prompt}
+                    ],
+                    max_tokens=batch_max_tokens(self.batch_size)
+                )
+            if not comments:
+                return ["..."]
+            for comment in comments:
+                state.add_comment(comment)
                 
-            return comment
+            return comments
             
+        except UpstreamUnavailable:
+            raise
         except Exception as e:
-            logger.error(f"Comment generation error: {str(e)}")
-            return "..." 
\ No newline at end of file
+            logger.error("Comment generation error: %s", e)
+            return ["..."] 
\ No newline at end of file
@@ -0,0 +1,204 @@
+import asyncio
+import logging
+import os
+import time
+from contextlib import AbstractAsyncContextManager, asynccontextmanager, nullcontext
+from typing import Callable, Dict, Optional
+
+import openai
+
+from ..metrics import UPSTREAM_ERRORS
+
+logger = logging.getLogger(__name__)
+
+# ステージごとの締め切り（秒）。レート制御の枠を確保してからの時間で、超えたら打ち切ってフォールバックする
+# （枠を待つ時間も同じ秒数で打ち切るが、上流の障害ではないのでブレーカーには数えない）
+DEFAULT_DEADLINES = {
+    "vision_call": 6.0,
+    "fused_call": 6.0,
+    "comment_call": 3.0,
+    "response_call": 4.0,
+    "window_call": 8.0,
+    "whisper_call": 12.0,
+}
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+# メトリクスで出力するときの値
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class UpstreamUnavailable(Exception):
+    """サーキットブレーカーが開いている・締め切りを過ぎた・上流が障害を返したため、上流の結果を得られなかった"""
+
+    def __init__(self, model: str, reason: str):
+        self.model = model
+        self.reason = reason
+        super().__init__(f"{model} is unavailable ({reason})")
+
+
+def is_upstream_failure(error: BaseException) -> bool:
+    """上流の障害とみなすエラー（リクエスト内容の誤りによる4xxは数えない）"""
+    if isinstance(error, (asyncio.TimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code >= 500 or error.status_code == 429
+    return False
+
+
+class CircuitBreaker:
+    """モデルごとのサーキットブレーカー
+
+    連続してfailure_threshold回失敗したら開き、cooldown秒は呼び出しを断る。
+    cooldown後は1件だけ試しに通し（half_open）、成功すれば閉じ、失敗すればまた開く。
+    """
+
+    def __init__(self, model: str, failure_threshold: int = 3, cooldown: float = 15.0, clock: Callable[[], float] = time.monotonic):
+        self.model = model
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def is_open(self) -> bool:
+        """呼び出しても断られる状態か（状態は変えない）"""
+        if self.state == OPEN:
+            return self.clock() - self.opened_at < self.cooldown
+        return self.state == HALF_OPEN and self._probing
+
+    def allow(self) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            if self.clock() - self.opened_at < self.cooldown:
+                return False
+            self.state = HALF_OPEN
+            logger.info("Circuit half-open for %s", self.model)
+        if self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def record_success(self):
+        if self.state != CLOSED:
+            logger.info("Circuit closed for %s", self.model)
+        self.state = CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != OPEN:
+                logger.warning("Circuit opened for %s after %s failures", self.model, self.failures)
+            self.state = OPEN
+            self.opened_at = self.clock()
+
+    def release_probe(self):
+        """試しの呼び出しが結果を出さずに中断された"""
+        self._probing = False
+
+
+class UpstreamGuard:
+    """上流APIの呼び出しに締め切りとモデルごとのサーキットブレーカーをかける
+
+        async with guard.call("gpt-4o-mini", "vision_call", governor.slot(...)):
+            response = await client.chat.completions.create(...)
+
+    ブレーカーが開いている場合、締め切りを過ぎた場合、上流の障害とみなすエラーの場合はUpstreamUnavailableを送出する。
+    呼び出し側はこれを受けてローカルのフォールバックに切り替える。
+    slotを渡すと締め切りは枠を確保してから数え始める。枠を待つ間に締め切りと同じ時間が過ぎた場合は
+    reason="local_wait"で送出し、プロセス内の混雑なのでブレーカーには失敗として数えない。
+    """
+
+    def __init__(
+        self,
+        deadlines: Optional[Dict[str, float]] = None,
+        failure_threshold: int = 3,
+        cooldown: float = 15.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.deadlines = {**DEFAULT_DEADLINES, **(deadlines or {})}
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.breakers: Dict[str, CircuitBreaker] = {}
+
+    @classmethod
+    def from_env(cls) -> "UpstreamGuard":
+        return cls(
+            deadlines={
+                stage: float(os.getenv(f"DEADLINE_{stage.upper()}", default))
+                for stage, default in DEFAULT_DEADLINES.items()
+            },
+            failure_threshold=int(os.getenv("BREAKER_FAILURE_THRESHOLD", "3")),
+            cooldown=float(os.getenv("BREAKER_COOLDOWN", "15")),
+        )
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        breaker = self.breakers.get(model)
+        if breaker is None:
+            breaker = CircuitBreaker(model, self.failure_threshold, self.cooldown, self.clock)
+            self.breakers[model] = breaker
+        return breaker
+
+    def is_open(self, model: str) -> bool:
+        breaker = self.breakers.get(model)
+        return breaker is not None and breaker.is_open()
+
+    def states(self) -> Dict[str, str]:
+        return {model: breaker.state for model, breaker in self.breakers.items()}
+
+    @asynccontextmanager
+    async def call(self, model: str, stage: str, slot: Optional[AbstractAsyncContextManager] = None):
+        breaker = self.breaker(model)
+        if not breaker.allow():
+            UPSTREAM_ERRORS.inc("CircuitOpen")
+            raise UpstreamUnavailable(model, "circuit_open")
+        deadline = self.deadlines.get(stage)
+        loop = asyncio.get_running_loop()
+        acquired = False
+        try:
+            async with asyncio.timeout(deadline) as timeout:
+                async with slot or nullcontext():
+                    acquired = True
+                    # 上流を呼ぶ時間だけを締め切りの対象にする
+                    timeout.reschedule(None if deadline is None else loop.time() + deadline)
+                    yield
+        except asyncio.TimeoutError as e:
+            if not acquired:
+                UPSTREAM_ERRORS.inc("LocalWaitExceeded")
+                breaker.release_probe()
+                logger.warning("%s waited %ss for a local slot", stage, deadline)
+                raise UpstreamUnavailable(model, "local_wait") from e
+            UPSTREAM_ERRORS.inc("DeadlineExceeded")
+            breaker.record_failure()
+            logger.warning("%s exceeded its deadline of %ss", stage, deadline)
+            raise UpstreamUnavailable(model, "deadline_exceeded") from e
+        except asyncio.CancelledError:
+            breaker.release_probe()
+            raise
+        except Exception as e:
+            if not is_upstream_failure(e):
+                breaker.release_probe()
+                raise
+            breaker.record_failure()
+            raise UpstreamUnavailable(model, type(e).__name__) from e
+        else:
+            breaker.record_success()
+
+
+_default_guard: Optional[UpstreamGuard] = None
+
+
+def get_upstream_guard() -> UpstreamGuard:
+    """プロセス内で共有する締め切り・サーキットブレーカーを取得"""
+    global _default_guard
+    if _default_guard is None:
+        _default_guard = UpstreamGuard.from_env()
+    return _default_guard
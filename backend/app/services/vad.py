@@ -0,0 +1,116 @@
+import math
+import os
+from dataclasses import dataclass, fields, replace
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+
+# クライアントから上書きできる項目の範囲（範囲外の値は端に丸める）
+OVERRIDE_RANGES = {
+    "frame_ms": (10, 100),
+    "energy_threshold_db": (-90.0, 0.0),
+    "noise_margin_db": (0.0, 40.0),
+    "unvoiced_margin_db": (0.0, 40.0),
+    "zcr_threshold": (0.0, 1.0),
+    "hangover_ms": (0, 2000),
+    "min_speech_ms": (0, 5000),
+    "padding_ms": (0, 1000),
+}
+
+
+@dataclass(frozen=True)
+class VADConfig:
+    """音声区間検出の設定（セッションごとに上書き可能）"""
+    enabled: bool = os.getenv("VAD_ENABLED", "true").lower() != "false"
+    frame_ms: int = 30
+    # 有声音とみなす最小のフレームエネルギー（dBFS）
+    energy_threshold_db: float = -45.0
+    # 推定ノイズフロアからこれだけ大きければ発話とみなす
+    noise_margin_db: float = 10.0
+    # 無声子音（サ行など）はエネルギーが低くゼロ交差率が高い
+    unvoiced_margin_db: float = 8.0
+    zcr_threshold: float = 0.25
+    # 発話終了後も発話中とみなし続ける時間
+    hangover_ms: int = 300
+    # 発話の合計がこれより短ければ無音として扱う
+    min_speech_ms: int = 250
+    # 切り出し時に前後へ残す余白
+    padding_ms: int = 150
+
+    def with_overrides(self, overrides: Dict[str, Any]) -> "VADConfig":
+        """クライアントから送られた設定のうち既知の項目だけを反映
+
+        数値はOVERRIDE_RANGESの範囲に丸める。frame_msが0以下・数値でない値はValueErrorを送出する。
+        """
+        known = {f.name for f in fields(self)}
+        values = {}
+        for key, value in overrides.items():
+            if key not in known:
+                continue
+            if key == "enabled":
+                values[key] = bool(value)
+                continue
+            # int(float("inf"))はOverflowErrorになるので、floatで有限か確かめてから項目の型にする
+            value = float(value)
+            if not math.isfinite(value):
+                raise ValueError(f"{key} must be finite")
+            value = type(getattr(self, key))(value)
+            if key == "frame_ms" and value <= 0:
+                raise ValueError("frame_ms must be positive")
+            lower, upper = OVERRIDE_RANGES[key]
+            values[key] = min(max(value, lower), upper)
+        return replace(self, **values)
+
+
+class VoiceActivityDetector:
+    """短時間エネルギーとゼロ交差率による音声区間検出（フレーム単位でベクトル化）"""
+
+    def __init__(self, config: Optional[VADConfig] = None):
+        self.config = config or VADConfig()
+
+    def speech_mask(self, pcm: np.ndarray, sample_rate: int) -> np.ndarray:
+        """フレームごとの発話判定（ハングオーバー適用済み）"""
+        return self._apply_hangover(self._classify_frames(pcm, sample_rate))
+
+    def _classify_frames(self, pcm: np.ndarray, sample_rate: int) -> np.ndarray:
+        config = self.config
+        frame_length = max(1, sample_rate * config.frame_ms // 1000)
+        num_frames = len(pcm) // frame_length
+        if num_frames == 0:
+            return np.zeros(0, dtype=bool)
+
+        frames = pcm[:num_frames * frame_length].reshape(num_frames, frame_length).astype(np.float32) / 32768.0
+
+        energy_db = 10.0 * np.log10(np.mean(frames * frames, axis=1) + 1e-10)
+        zero_crossings = np.mean(np.signbit(frames[:, 1:]) != np.signbit(frames[:, :-1]), axis=1)
+
+        # 環境ノイズに合わせて閾値を引き上げる（下位10%をノイズフロアとみなす）
+        noise_floor = np.percentile(energy_db, 10)
+        threshold = max(config.energy_threshold_db, noise_floor + config.noise_margin_db)
+
+        voiced = energy_db > threshold
+        unvoiced = (energy_db > threshold - config.unvoiced_margin_db) & (zero_crossings > config.zcr_threshold)
+        return voiced | unvoiced
+
+    def _apply_hangover(self, mask: np.ndarray) -> np.ndarray:
+        # 発話フレームの後ろhangover分も発話中とみなす
+        hangover = self.config.hangover_ms // self.config.frame_ms
+        if hangover <= 0 or not mask.any():
+            return mask
+        return np.convolve(mask, np.ones(hangover + 1, dtype=int))[:len(mask)] > 0
+
+    def trim(self, pcm: np.ndarray, sample_rate: int) -> Optional[np.ndarray]:
+        """前後の無音を取り除いた区間を返す（発話がなければNone）"""
+        config = self.config
+        raw_mask = self._classify_frames(pcm, sample_rate)
+        if np.count_nonzero(raw_mask) * config.frame_ms < config.min_speech_ms:
+            return None
+
+        speech_frames = np.flatnonzero(self._apply_hangover(raw_mask))
+
+        frame_length = max(1, sample_rate * config.frame_ms // 1000)
+        padding = sample_rate * config.padding_ms // 1000
+        start = max(0, speech_frames[0] * frame_length - padding)
+        end = min(len(pcm), (speech_frames[-1] + 1) * frame_length + padding)
+        return pcm[start:end]
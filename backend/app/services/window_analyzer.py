@@ -0,0 +1,226 @@
+from typing import Awaitable, Callable, Dict, List, Optional, Union
+import asyncio
+import logging
+import os
+import time
+from .openai_client import OpenAIClientRegistry
+from .comment_batch import COMMENT_BATCH_SIZE, batch_instruction, batch_max_tokens, create_comment_batch
+from .image_processing import IMAGE_ADAPTIVE, ImagePreprocessor, PreparedFrame, get_image_preprocessor
+from .comment_bank import CommentBank, get_comment_bank, local_signals
+from .rate_governor import PRIORITY_AUDIO, PRIORITY_SCREEN, RateGovernor, get_rate_governor
+from .upstream_guard import UpstreamGuard, UpstreamUnavailable, get_upstream_guard
+from ..logging_config import SAMPLED
+from ..metrics import FALLBACK_COMMENTS
+from ..session import COMMENT_HISTORY_SIZE, AnalyzerState, SessionState
+
+logger = logging.getLogger(__name__)
+
+# windowedモードで1回の解析にまとめる時間（秒）
+WINDOW_SECONDS = float(os.getenv("WINDOW_SECONDS", "4"))
+
+WINDOW_SYSTEM_PROMPT = """
+あなたは配信を見ている視聴者としてリアクションを返すAIです。
+直近の数秒間の画面共有・カメラ映像・配信者の発言がまとめて渡されるので、全体を踏まえたコメントを指定された件数だけ返してください。
+発言があればそれへの反応を優先し、画面やカメラの様子も自然に絡めてください。
+コメントは自然な日本語で、5文字以下の短文が8割以上ですが、長めのコメントもごくたまに含まれます。
+反応のバリエーションを増やし、面白い・共感・驚き・ツッコミなど多様なトーンを持たせてください。
+カジュアルな表現やスラングがほとんどです。句点は付けず、絵文字もたまに加えてください。
+直前のコメントと同じ内容は避けてください。コメント以外の説明は含めないでください。
+"""
+
+
+class WindowAnalyzer:
+    """一定時間内の最新の画面・最新のカメラ映像・書き起こしをまとめて、1回の呼び出しでコメントを生成
+
+    画面とカメラはセッションの変化検出を共有し、前回から変化のない画像は送らない。
+    """
+
+    # Vision APIに送る画像の長辺（px）
+    TARGET_SIZE = 512
+    MODEL = "gpt-4o-mini"
+
+    def __init__(
+        self,
+        clients: OpenAIClientRegistry,
+        preprocessor: Optional[ImagePreprocessor] = None,
+        governor: Optional[RateGovernor] = None,
+        adaptive: bool = IMAGE_ADAPTIVE,
+        batch_size: int = COMMENT_BATCH_SIZE,
+        guard: Optional[UpstreamGuard] = None,
+        bank: Optional[CommentBank] = None,
+    ):
+        self.clients = clients
+        self.adaptive = adaptive
+        self.batch_size = batch_size
+        self.preprocessor = preprocessor or get_image_preprocessor()
+        self.governor = governor or get_rate_governor()
+        self.guard = guard or get_upstream_guard()
+        self.bank = bank or get_comment_bank()
+
+    def new_state(self) -> AnalyzerState:
+        """セッションごとの状態（コメント履歴のみ使い、変化検出は画面・カメラの状態のものを使う）"""
+        return AnalyzerState(change_threshold=0)
+
+    async def _prepare_changed(self, data: Optional[bytes], state: AnalyzerState) -> Optional[PreparedFrame]:
+        if data is None:
+            return None
+        prepared = await self.preprocessor.prepare(
+            data,
+            target_size=self.TARGET_SIZE,
+            hash_size=state.change_detector.hash_size,
+            adaptive=self.adaptive,
+            previous_thumbnail=state.change_detector.reference_thumbnail,
+        )
+        if prepared is None or not state.change_detector.is_changed(prepared.frame_hash):
+            return None
+        return prepared
+
+    async def analyze_window(
+        self,
+        screen: Optional[bytes],
+        camera: Optional[bytes],
+        transcripts: List[str],
+        session: SessionState,
+        on_delta: Optional[Callable[[str], Awaitable[None]]] = None,
+    ) -> Dict[str, Union[str, bool, Dict[str, str]]]:
+        state = session.window
+        try:
+            screen_frame, camera_frame = await asyncio.gather(
+                self._prepare_changed(screen, session.screen),
+                self._prepare_changed(camera, session.camera),
+            )
+            if screen_frame is None and camera_frame is None and not transcripts:
+                return {
+                    "success": False,
+                    "text": "",
+                    "error": {"type": "unchanged", "message": "この区間に新しい内容がありません"}
+                }
+
+            # 上流の障害中は呼び出しを待たずにローカルのコメント集から返す
+            if self.guard.is_open(self.MODEL):
+                return self._fallback(session, screen_frame, camera_frame, "circuit_open")
+
+            # 発言を含む区間は音声と同じ優先度、映像のみなら混雑時に断る
+            priority = PRIORITY_AUDIO if transcripts else PRIORITY_SCREEN
+            if not self.governor.admit(priority):
+                return {
+                    "success": False,
+                    "text": "",
+                    "error": {"type": "throttled", "message": "混雑のため解析を見送りました"}
+                }
+
+            content = [{"type": "text", "text": self._describe(transcripts, state, self.batch_size)}]
+            for label, prepared in (("画面共有", screen_frame), ("カメラ映像", camera_frame)):
+                if prepared is None:
+                    continue
+                content.append({"type": "text", "text": f"{label}:"})
+                content.append({
+                    "type": "image_url",
+                    "image_url": {
+                        "url": prepared.image_url,
+                        "detail": prepared.detail
+                    }
+                })
+
+            try:
+                async with self.guard.call(
+                        self.MODEL, "window_call",
+                        self.governor.slot(priority, state.session_id, stage="window_call"),
+                ):
+                    comments = await create_comment_batch(
+                        self.clients.get("vision"),
+                        self.batch_size,
+                        on_delta,
+                        model=self.MODEL,
+                        messages=[
+                            {"role": "system", "content": WINDOW_SYSTEM_PROMPT},
+                            {"role": "user", "content": content}
+                        ],
+                        max_tokens=40 + batch_max_tokens(self.batch_size),
+                        temperature=0.7
+                    )
+            except UpstreamUnavailable as e:
+                logger.warning("Window analysis unavailable: %s", e)
+                return self._fallback(session, screen_frame, camera_frame, e.reason)
+
+            if not comments:
+                return {
+                    "success": False,
+                    "text": "",
+                    "error": {"type": "api_error", "message": "コメントが生成されませんでした"}
+                }
+            logger.info(
+                "Window analysis (screen=%s, camera=%s, transcripts=%d) -> %s",
+                screen_frame is not None, camera_frame is not None, len(transcripts), comments, extra=SAMPLED,
+            )
+            # 送った画像を次の区間の変化検出の基準にする
+            if screen_frame is not None:
+                session.screen.change_detector.remember(screen_frame.frame_hash, screen_frame.thumbnail)
+            if camera_frame is not None:
+                session.camera.change_detector.remember(camera_frame.frame_hash, camera_frame.thumbnail)
+            for comment in comments:
+                state.add_comment(comment)
+
+            result = {
+                "success": True,
+                "text": comments[0],
+                "comments": comments,
+                "error": None
+            }
+            state.record_result(result, time.time())
+            return result
+
+        except Exception as e:
+            logger.error("Window analysis error: %s", e)
+            return {
+                "success": False,
+                "text": "",
+                "error": {"type": "api_error", "message": str(e)}
+            }
+
+    def _fallback(
+        self,
+        session: SessionState,
+        screen_frame: Optional[PreparedFrame],
+        camera_frame: Optional[PreparedFrame],
+        reason: str,
+    ) -> Dict[str, Union[str, bool, Dict[str, str]]]:
+        """上流を使えないときに、画面の種類と画像の統計からローカルのコメント集で返す（送った画像は基準として覚える）"""
+        state = session.window
+        frame = screen_frame or camera_frame
+        stats = frame.stats if frame is not None else {}
+        comments = self.bank.pick(
+            "screen" if screen_frame is not None else "window",
+            self.batch_size,
+            category=session.screen.last_category,
+            signals=local_signals(stats),
+            avoid=state.recent_comments(COMMENT_HISTORY_SIZE),
+        )
+        FALLBACK_COMMENTS.inc("window", reason)
+        logger.info("Fallback comments (%s): %s", reason, comments, extra=SAMPLED)
+        for prepared, analyzer_state in ((screen_frame, session.screen), (camera_frame, session.camera)):
+            if prepared is not None:
+                analyzer_state.change_detector.remember(prepared.frame_hash, prepared.thumbnail)
+        for comment in comments:
+            state.add_comment(comment)
+        result = {
+            "success": True,
+            "text": comments[0],
+            "comments": comments,
+            "error": None,
+            "fallback": True
+        }
+        state.record_result(result, time.time())
+        return result
+
+    @staticmethod
+    def _describe(transcripts: List[str], state: AnalyzerState, batch_size: int) -> str:
+        lines = []
+        if transcripts:
+            lines.append("配信者の発言:")
+            lines.extend(f"- {text}" for text in transcripts)
+        else:
+            lines.append("配信者の発言: なし")
+        lines.append(f"直前のコメント: {' / '.join(state.recent_comments(3)) or 'なし'}")
+        lines.append(batch_instruction(batch_size))
+        return "\n".join(lines)
@@ -0,0 +1,91 @@
+import time
+import uuid
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from .services.audio_assembler import AudioAssembler
+from .services.change_detector import FrameChangeDetector
+from .services.vad import VADConfig
+
+# 1セッションが保持するコメント履歴の件数と1件あたりの最大文字数
+# （履歴・直前の結果・ハッシュのみを持つので、1セッションあたり数KBに収まる）
+COMMENT_HISTORY_SIZE = 10
+MAX_COMMENT_LENGTH = 200
+
+
+def _clip(text: str) -> str:
+    return text[:MAX_COMMENT_LENGTH]
+
+
+class AnalyzerState:
+    """画面・カメラ解析のセッションごとの状態（間引き・変化検出・コメント履歴）"""
+
+    __slots__ = ("session_id", "last_result", "last_analysis_time", "comment_history", "change_detector", "last_category")
+
+    def __init__(self, change_threshold: int, session_id: str = "default"):
+        # 上流APIの枠をセッション間で公平に割り当てるためのID
+        self.session_id = session_id
+        self.last_result: Optional[Dict[str, Any]] = None
+        self.last_analysis_time = 0.0
+        self.comment_history: Deque[str] = deque(maxlen=COMMENT_HISTORY_SIZE)
+        self.change_detector = FrameChangeDetector(threshold=change_threshold)
+        # 直前の解析で分かった画面・映像の種類（上流の障害時にローカルのコメントを選ぶのに使う）
+        self.last_category: Optional[Tuple[str, str]] = None
+
+    def add_comment(self, comment: str):
+        self.comment_history.append(_clip(comment))
+
+    def last_comment(self) -> str:
+        return self.comment_history[-1] if self.comment_history else "なし"
+
+    def recent_comments(self, count: int) -> list[str]:
+        return list(self.comment_history)[-count:]
+
+    def record_result(self, result: Dict[str, Any], analysis_time: float):
+        if result.get("text"):
+            result = {**result, "text": _clip(result["text"])}
+        self.last_result = result
+        self.last_analysis_time = analysis_time
+
+    def clear(self):
+        self.last_result = None
+        self.comment_history.clear()
+        self.change_detector.reset()
+        self.last_category = None
+
+
+class SessionState:
+    """1接続分の状態。websocket_endpointで作成し、切断時に解放する"""
+
+    __slots__ = ("session_id", "created_at", "screen", "camera", "window", "audio", "vad_config", "streaming")
+
+    def __init__(
+        self,
+        screen: AnalyzerState,
+        camera: AnalyzerState,
+        vad_config: VADConfig,
+        window: Optional[AnalyzerState] = None,
+        audio: Optional[AudioAssembler] = None,
+    ):
+        self.session_id = uuid.uuid4().hex
+        self.created_at = time.time()
+        self.screen = screen
+        self.camera = camera
+        # windowedモードでまとめて解析する場合のコメント履歴
+        self.window = window
+        for state in (screen, camera, window):
+            if state is not None:
+                state.session_id = self.session_id
+        # 受信した音声セグメントをつなげて発話ごとに区切るバッファ（Noneならセグメントごとに書き起こす）
+        self.audio = audio
+        # 音声区間検出の設定とストリーミングの有無（クライアントからのconfigメッセージで変更可能）
+        self.vad_config = vad_config
+        self.streaming = False
+
+    def release(self):
+        self.screen.clear()
+        self.camera.clear()
+        if self.window is not None:
+            self.window.clear()
+        if self.audio is not None:
+            self.audio.reset()
@@ -0,0 +1,6 @@
+"""オフラインで性能を測定するためのベンチマーク一式
+
+- mock_upstream: OpenAI互換のモックサーバー（遅延・ゆらぎ・エラー率を設定可能）
+- generators: 合成の音声（WebM）・画面（PNG）・カメラ（JPEG）データ
+- loadgen: 複数のWebSocket接続から実際の送信間隔でデータを送り、レイテンシとスループットを計測
+"""
@@ -0,0 +1,145 @@
+"""ベンチマーク用の合成データ（NumPyでベクトル化して生成）
+
+- 音声: 音節ごとに振幅が変わる倍音付きの波形を16bit PCMで生成し、ffmpegでWebM(Opus)に変換
+- 画面: エディタ風の行ブロックとカーソル位置がフレームごとに変わるPNG / WebP
+- カメラ: 背景のグラデーションの上を楕円が移動するJPEG
+"""
+import subprocess
+from typing import Optional
+
+import cv2
+import numpy as np
+
+AUDIO_SAMPLE_RATE = 48000
+
+
+def sine_wave(frequency: float, duration: float, sample_rate: int = AUDIO_SAMPLE_RATE, amplitude: float = 1.0) -> np.ndarray:
+    """正弦波（float32, -1.0〜1.0）"""
+    t = np.arange(int(duration * sample_rate), dtype=np.float32) / sample_rate
+    return (amplitude * np.sin(2 * np.pi * frequency * t)).astype(np.float32)
+
+
+def speech_like(
+    duration: float,
+    sample_rate: int = AUDIO_SAMPLE_RATE,
+    pitch: float = 160.0,
+    syllable_rate: float = 4.0,
+    leading_silence: float = 0.3,
+    seed: Optional[int] = None,
+) -> np.ndarray:
+    """発話に似た波形（基本周波数 + 倍音を音節ごとの包絡で変調し、前後に無音を付ける）
+
+    音声区間検出で発話と判定されるよう、音量とゼロ交差率を発話に近づけている。
+    """
+    rng = np.random.default_rng(seed)
+    n = int(duration * sample_rate)
+    t = np.arange(n, dtype=np.float32) / sample_rate
+
+    # 抑揚: 基本周波数をゆっくり揺らし、位相は周波数の累積和で求める
+    f0 = pitch * (1.0 + 0.1 * np.sin(2 * np.pi * 0.7 * t))
+    phase = 2 * np.pi * np.cumsum(f0) / sample_rate
+    harmonics = np.arange(1, 6, dtype=np.float32)[:, None]
+    voiced = (np.sin(harmonics * phase) / harmonics).sum(axis=0)
+
+    # 音節ごとの包絡（ハン窓）と、子音に相当する少量のノイズ
+    envelope = np.clip(np.sin(np.pi * syllable_rate * t), 0.0, None) ** 2
+    signal = 0.4 * voiced * envelope + 0.02 * rng.standard_normal(n).astype(np.float32) * envelope
+
+    silence = np.zeros(int(leading_silence * sample_rate), dtype=np.float32)
+    return np.concatenate([silence, signal.astype(np.float32), silence])
+
+
+def to_pcm16(samples: np.ndarray) -> np.ndarray:
+    return (np.clip(samples, -1.0, 1.0) * 32767).astype("<i2")
+
+
+def encode_webm(samples: np.ndarray, sample_rate: int = AUDIO_SAMPLE_RATE, bitrate: str = "32k") -> bytes:
+    """PCMをffmpegのパイプでWebM(Opus)にエンコード"""
+    process = subprocess.run(
+        [
+            "ffmpeg", "-hide_banner", "-loglevel", "error",
+            "-f", "s16le", "-ar", str(sample_rate), "-ac", "1", "-i", "pipe:0",
+            "-c:a", "libopus", "-b:a", bitrate, "-f", "webm", "pipe:1",
+        ],
+        input=to_pcm16(samples).tobytes(),
+        capture_output=True,
+        check=True,
+    )
+    return process.stdout
+
+
+def audio_segment(duration: float = 3.0, seed: Optional[int] = None) -> bytes:
+    """フロントエンドのMediaRecorderが送るのと同じWebM音声セグメント"""
+    rng = np.random.default_rng(seed)
+    samples = speech_like(duration, pitch=float(rng.uniform(110, 240)), seed=seed)
+    return encode_webm(samples)
+
+
+def screen_frame(
+    index: int,
+    width: int = 1920,
+    height: int = 1080,
+    line_height: int = 24,
+    codec: str = "png",
+    quality: int = 80,
+) -> bytes:
+    """エディタ風の画面（PNG / WebP / JPEG）。indexごとに行の内容とカーソル行が変わる"""
+    rng = np.random.default_rng(index)
+    frame = np.full((height, width, 3), (30, 30, 30), dtype=np.uint8)
+
+    # 行ごとの長さ・インデント・色をまとめて決め、行ブロックをマスクで描く
+    rows = height // line_height
+    lengths = rng.integers(10, 90, rows) * 12
+    indents = rng.integers(0, 4, rows) * 48
+    colors = rng.integers(120, 230, (rows, 3), dtype=np.uint8)
+    x = np.arange(width)
+    row_index = np.minimum(np.arange(height) // line_height, rows - 1)
+    in_text = (np.arange(height) % line_height >= 4) & (np.arange(height) % line_height < line_height - 6)
+    mask = (
+        in_text[:, None]
+        & (x[None, :] >= 60 + indents[row_index][:, None])
+        & (x[None, :] < 60 + indents[row_index][:, None] + lengths[row_index][:, None])
+    )
+    frame[mask] = colors[row_index][:, None, :].repeat(width, axis=1)[mask]
+
+    # 行番号の余白とカーソル行のハイライト
+    frame[:, :48] = (45, 45, 45)
+    cursor = (index * 3) % rows
+    frame[cursor * line_height:(cursor + 1) * line_height, 48:] //= 2
+    frame[cursor * line_height:(cursor + 1) * line_height, 48:] += 40
+
+    return encode_image(frame, codec, quality)
+
+
+def encode_image(frame: np.ndarray, codec: str, quality: int = 80) -> bytes:
+    if codec == "png":
+        ok, encoded = cv2.imencode(".png", frame, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    elif codec == "webp":
+        ok, encoded = cv2.imencode(".webp", frame, [cv2.IMWRITE_WEBP_QUALITY, quality])
+    else:
+        ok, encoded = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise RuntimeError(f"{codec} encode failed")
+    return encoded.tobytes()
+
+
+def camera_frame(index: int, width: int = 1280, height: int = 720, quality: int = 80) -> bytes:
+    """カメラ風の映像（JPEG）。背景のグラデーションの上を楕円（人物に相当）が移動する"""
+    rng = np.random.default_rng(index)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    background = np.stack([
+        80 + 60 * x / width,
+        90 + 50 * y / height,
+        100 + 40 * (x + y) / (width + height),
+    ], axis=-1)
+
+    # 楕円の中心を円軌道で動かす
+    angle = index * 0.35
+    cx = width / 2 + width * 0.2 * np.cos(angle)
+    cy = height / 2 + height * 0.15 * np.sin(angle)
+    inside = ((x - cx) / (width * 0.12)) ** 2 + ((y - cy) / (height * 0.3)) ** 2 <= 1.0
+    background[inside] = (150, 170, 200)
+
+    noise = 6 * rng.standard_normal(background.shape, dtype=np.float32)
+    frame = np.clip(background + noise, 0, 255).astype(np.uint8)
+    return encode_image(frame, "jpeg", quality)
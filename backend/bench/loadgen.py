@@ -0,0 +1,414 @@
+"""複数接続の負荷生成とレイテンシ計測
+
+N本のWebSocket接続を開き、フロントエンドと同じ間隔で画面（WebP/PNG）・カメラ（JPEG）・音声（WebM）を
+封筒付き（app/protocol.py）で送信する。ストリーミングを有効にして返ってくるメッセージIDからモダリティを、
+seqから元の送信を判別し、送信から最初のdelta・最終メッセージまでの時間をモダリティごとに集計してJSONに保存する。
+
+    # モック上流とバックエンドを起動して計測
+    python -m bench.loadgen --spawn --connections 20 --duration 60 --output results.json
+    # 既に起動しているバックエンドに対して計測し、前回の結果と比較
+    python -m bench.loadgen --url ws://localhost:8000/ws --baseline results.json
+
+--raw で封筒なしのデータを送った場合、レイテンシは「未応答の送信のうち最も古いもの」から測るため、
+古いフレームが破棄されたときは長めに出る。
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from collections import deque
+from dataclasses import asdict, dataclass, field
+from typing import Deque, Dict, List, Optional
+
+import numpy as np
+import websockets
+
+from app.protocol import encode_envelope
+
+from . import generators
+
+MODALITIES = ("screen", "camera", "audio")
+CODECS = {"camera": "jpeg", "audio": "webm"}
+
+
+@dataclass
+class Cadence:
+    """各モダリティの送信間隔（秒）。サーバーからのcontrolメッセージで画面・カメラは変わる"""
+    screen: float = 2.0
+    camera: float = 3.0
+    audio: float = 5.0
+
+
+@dataclass
+class ModalityStats:
+    sent: int = 0
+    replies: int = 0
+    errors: int = 0
+    latencies: List[float] = field(default_factory=list)
+    first_delta: List[float] = field(default_factory=list)
+
+
+class Recorder:
+    """全接続の計測結果"""
+
+    def __init__(self):
+        self.stats: Dict[str, ModalityStats] = {m: ModalityStats() for m in MODALITIES}
+        self.unattributed_errors = 0
+        self.control_messages = 0
+        self.connect_failures = 0
+        self.disconnects = 0
+
+    def summary(self, elapsed: float) -> Dict[str, object]:
+        modalities = {}
+        for modality, stats in self.stats.items():
+            modalities[modality] = {
+                "sent": stats.sent,
+                "replies": stats.replies,
+                "errors": stats.errors,
+                "throughput": stats.replies / elapsed if elapsed else 0.0,
+                "latency": percentiles(stats.latencies),
+                "first_delta": percentiles(stats.first_delta),
+            }
+        replies = sum(s.replies for s in self.stats.values())
+        return {
+            "elapsed": elapsed,
+            "throughput": replies / elapsed if elapsed else 0.0,
+            "replies": replies,
+            "errors": sum(s.errors for s in self.stats.values()) + self.unattributed_errors,
+            "control_messages": self.control_messages,
+            "connect_failures": self.connect_failures,
+            "disconnects": self.disconnects,
+            "modalities": modalities,
+        }
+
+
+def percentiles(values: List[float]) -> Optional[Dict[str, float]]:
+    if not values:
+        return None
+    array = np.asarray(values)
+    p50, p95, p99 = np.percentile(array, [50, 95, 99])
+    return {
+        "count": len(values),
+        "mean": float(array.mean()),
+        "p50": float(p50),
+        "p95": float(p95),
+        "p99": float(p99),
+        "max": float(array.max()),
+    }
+
+
+class MediaPool:
+    """事前に生成した送信データ（計測中にエンコードのCPUを使わないようにする）"""
+
+    def __init__(self, frames: int = 8, audio_clips: int = 4, audio_duration: float = 3.0, screen_codec: str = "webp"):
+        self.codecs = {**CODECS, "screen": screen_codec}
+        self.screen = [generators.screen_frame(i, codec=screen_codec) for i in range(frames)]
+        self.camera = [generators.camera_frame(i) for i in range(frames)]
+        self.audio = [generators.audio_segment(audio_duration, seed=i) for i in range(audio_clips)]
+
+    def get(self, modality: str, index: int) -> bytes:
+        items = getattr(self, modality)
+        return items[index % len(items)]
+
+
+class Client:
+    """1接続分の送受信"""
+
+    def __init__(
+        self, index: int, url: str, media: MediaPool, cadence: Cadence, recorder: Recorder, envelope: bool = True
+    ):
+        self.index = index
+        self.url = url
+        self.media = media
+        self.cadence = Cadence(**asdict(cadence))
+        self.recorder = recorder
+        self.envelope = envelope
+        # 未応答の送信 (シーケンス番号, 送信時刻)
+        self.pending: Dict[str, Deque[tuple]] = {m: deque() for m in MODALITIES}
+        # メッセージIDごとの送信時刻（最初のdeltaを受け取った時点で対応付ける）
+        self.started: Dict[str, float] = {}
+
+    async def run(self, deadline: float):
+        try:
+            async with websockets.connect(self.url, max_size=None) as websocket:
+                await websocket.send(json.dumps({"type": "config", "stream": True}))
+                senders = [asyncio.create_task(self._send_loop(websocket, m, deadline)) for m in MODALITIES]
+                receiver = asyncio.create_task(self._receive_loop(websocket))
+                await asyncio.gather(*senders)
+                # 最後に送った分の応答を少し待つ
+                await asyncio.sleep(min(5.0, max(0.0, deadline + 5.0 - time.monotonic())))
+                receiver.cancel()
+                await asyncio.gather(receiver, return_exceptions=True)
+        except (OSError, websockets.exceptions.InvalidHandshake):
+            self.recorder.connect_failures += 1
+        except websockets.exceptions.ConnectionClosed:
+            self.recorder.disconnects += 1
+
+    async def _send_loop(self, websocket, modality: str, deadline: float):
+        # 接続ごとに送信タイミングをずらす
+        await asyncio.sleep(random.uniform(0, getattr(self.cadence, modality)))
+        count = 0
+        while time.monotonic() < deadline:
+            payload = self.media.get(modality, self.index + count)
+            if self.envelope:
+                payload = encode_envelope(modality, self.media.codecs[modality], payload, sequence=count)
+            await websocket.send(payload)
+            self.pending[modality].append((count, time.monotonic()))
+            self.recorder.stats[modality].sent += 1
+            count += 1
+            await asyncio.sleep(getattr(self.cadence, modality))
+
+    def _claim(self, modality: str, message_id: str, sequence: Optional[int]) -> Optional[float]:
+        sent_at = self.started.get(message_id)
+        pending = self.pending[modality]
+        if sent_at is not None or not pending:
+            return sent_at
+        if sequence is not None:
+            # seqが一致する送信を探す。画面・カメラはそれより前の送信を破棄されたものとみなす
+            matched = next((t for s, t in pending if s == sequence), None)
+            if matched is None:
+                return None
+            sent_at = matched
+            if modality == "audio":
+                self.pending[modality] = deque((s, t) for s, t in pending if s != sequence)
+            else:
+                self.pending[modality] = deque((s, t) for s, t in pending if s > sequence)
+        elif modality == "audio":
+            sent_at = pending.popleft()[1]
+        else:
+            # 画面・カメラは最新フレームのみ処理されるので、それまでの送信は応答済みとみなす
+            sent_at = pending[0][1]
+            pending.clear()
+        self.started[message_id] = sent_at
+        return sent_at
+
+    async def _receive_loop(self, websocket):
+        async for raw in websocket:
+            now = time.monotonic()
+            if raw == "ping":
+                continue
+            message = json.loads(raw)
+            kind = message.get("type")
+            if kind == "control":
+                self.recorder.control_messages += 1
+                self.cadence.screen = message.get("screen_interval_ms", self.cadence.screen * 1000) / 1000
+                self.cadence.camera = message.get("camera_interval_ms", self.cadence.camera * 1000) / 1000
+                continue
+
+            message_id = message.get("id")
+            if message_id is None:
+                if kind == "error":
+                    self.recorder.unattributed_errors += 1
+                continue
+            modality = message_id.split("-", 1)[0]
+            if modality not in self.pending:
+                continue
+            is_new = message_id not in self.started
+            sent_at = self._claim(modality, message_id, message.get("seq"))
+            if sent_at is None:
+                continue
+            stats = self.recorder.stats[modality]
+            if kind == "delta":
+                if is_new:
+                    stats.first_delta.append(now - sent_at)
+                continue
+            self.started.pop(message_id, None)
+            if kind == "error":
+                stats.errors += 1
+            else:
+                stats.replies += 1
+                stats.latencies.append(now - sent_at)
+
+
+async def run_load(
+    url: str,
+    connections: int,
+    duration: float,
+    cadence: Cadence,
+    media: MediaPool,
+    ramp_up: float,
+    envelope: bool = True,
+) -> Dict[str, object]:
+    recorder = Recorder()
+    start = time.monotonic()
+    deadline = start + duration
+    tasks = []
+    for index in range(connections):
+        client = Client(index, url, media, cadence, recorder, envelope)
+        tasks.append(asyncio.create_task(client.run(deadline)))
+        if ramp_up:
+            await asyncio.sleep(ramp_up / connections)
+    await asyncio.gather(*tasks)
+    return recorder.summary(time.monotonic() - start)
+
+
+def compare(current: Dict[str, object], baseline: Dict[str, object], tolerance: float) -> List[str]:
+    """前回の結果と比べて、p95レイテンシの悪化・スループットの低下をリストアップ"""
+    regressions = []
+    base_result, result = baseline["result"], current["result"]
+    if result["throughput"] < base_result["throughput"] * (1 - tolerance):
+        regressions.append(f"throughput {base_result['throughput']:.2f} -> {result['throughput']:.2f} msg/s")
+    for modality in MODALITIES:
+        before = base_result["modalities"][modality]["latency"]
+        after = result["modalities"][modality]["latency"]
+        if before and after and after["p95"] > before["p95"] * (1 + tolerance):
+            regressions.append(f"{modality} p95 {before['p95'] * 1000:.0f} -> {after['p95'] * 1000:.0f} ms")
+    return regressions
+
+
+def print_report(result: Dict[str, object]):
+    print(f"elapsed {result['elapsed']:.1f}s, replies {result['replies']}, "
+          f"throughput {result['throughput']:.2f} msg/s, errors {result['errors']}")
+    for modality, stats in result["modalities"].items():
+        latency = stats["latency"]
+        first = stats["first_delta"]
+        line = f"  {modality:<6} sent {stats['sent']:>5} replies {stats['replies']:>5} errors {stats['errors']:>3}"
+        if latency:
+            line += f"  p50 {latency['p50'] * 1000:7.0f}ms p95 {latency['p95'] * 1000:7.0f}ms p99 {latency['p99'] * 1000:7.0f}ms"
+        if first:
+            line += f"  first-delta p50 {first['p50'] * 1000:6.0f}ms"
+        print(line)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for_port(port: int, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server on port {port} did not start")
+
+
+def _wait_for_ready(port: int, timeout: float = 30.0):
+    """ウォームアップが終わるまで/readyzを確認する（起動直後の遅い接続を計測に含めない）"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/readyz", timeout=1.0):
+                return
+        except (OSError, urllib.error.HTTPError):
+            time.sleep(0.2)
+    raise RuntimeError(f"Server on port {port} did not become ready")
+
+
+def spawn_servers(args) -> tuple:
+    """モック上流とバックエンドを別プロセスで起動し、(WebSocket URL, プロセス一覧) を返す"""
+    backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    mock_port, app_port = _free_port(), _free_port()
+    mock = subprocess.Popen(
+        [
+            sys.executable, "-m", "bench.mock_upstream", "--port", str(mock_port),
+            "--latency", str(args.mock_latency), "--jitter", str(args.mock_jitter),
+            "--error-rate", str(args.mock_error_rate), "--rate-limit-rate", str(args.mock_rate_limit_rate),
+        ],
+        cwd=backend_dir,
+    )
+    env = {
+        **os.environ,
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{mock_port}/v1",
+        "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY", "mock"),
+    }
+    app = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(app_port), "--log-level", "warning"],
+        cwd=backend_dir,
+        env=env,
+    )
+    processes = [mock, app]
+    try:
+        _wait_for_port(mock_port)
+        _wait_for_port(app_port)
+        _wait_for_ready(app_port)
+    except RuntimeError:
+        stop_servers(processes)
+        raise
+    return f"ws://127.0.0.1:{app_port}/ws", processes
+
+
+def stop_servers(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="WebSocket load generator")
+    parser.add_argument("--url", default="ws://localhost:8000/ws")
+    parser.add_argument("--connections", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--ramp-up", type=float, default=2.0, help="全接続を開くまでの秒数")
+    parser.add_argument("--screen-interval", type=float, default=2.0)
+    parser.add_argument("--camera-interval", type=float, default=3.0)
+    parser.add_argument("--audio-interval", type=float, default=5.0)
+    parser.add_argument("--audio-duration", type=float, default=3.0)
+    parser.add_argument("--frames", type=int, default=8, help="事前生成する画面・カメラフレームの枚数")
+    parser.add_argument("--screen-codec", choices=("webp", "png", "jpeg"), default="webp")
+    parser.add_argument("--raw", action="store_true", help="封筒なしで送る（先頭バイトによる判別）")
+    parser.add_argument("--output", help="結果を保存するJSONファイル")
+    parser.add_argument("--baseline", help="比較する前回の結果JSON")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="悪化とみなす割合")
+    parser.add_argument("--spawn", action="store_true", help="モック上流とバックエンドを起動して計測")
+    parser.add_argument("--mock-latency", type=float, default=0.3)
+    parser.add_argument("--mock-jitter", type=float, default=0.1)
+    parser.add_argument("--mock-error-rate", type=float, default=0.0)
+    parser.add_argument("--mock-rate-limit-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    cadence = Cadence(args.screen_interval, args.camera_interval, args.audio_interval)
+    print("Generating media...")
+    screen_codec = "png" if args.raw else args.screen_codec
+    media = MediaPool(frames=args.frames, audio_duration=args.audio_duration, screen_codec=screen_codec)
+
+    url, processes = args.url, []
+    if args.spawn:
+        url, processes = spawn_servers(args)
+    try:
+        print(f"Running {args.connections} connections for {args.duration:.0f}s against {url}")
+        result = asyncio.run(
+            run_load(url, args.connections, args.duration, cadence, media, args.ramp_up, not args.raw)
+        )
+    finally:
+        stop_servers(processes)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "result": result,
+    }
+    print_report(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"Saved results to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print("Regressions:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("No regressions against baseline")
+
+
+if __name__ == "__main__":
+    main()
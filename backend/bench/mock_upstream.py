@@ -0,0 +1,208 @@
+"""OpenAI互換のモック上流サーバー
+
+チャット補完（通常・ストリーミング・構造化出力）と音声認識のエンドポイントを実装し、
+応答までの遅延・ゆらぎ・エラー率を設定できる。バックエンドは OPENAI_BASE_URL で向け先を切り替える。
+
+    python -m bench.mock_upstream --port 9000 --latency 0.4 --jitter 0.1 --error-rate 0.01
+    OPENAI_BASE_URL=http://127.0.0.1:9000/v1 OPENAI_API_KEY=dummy uvicorn app.main:app
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# 書き起こし・コメントとして返す文言（同じ文言が繰り返されるとキャッシュにも当たる）
+TRANSCRIPTS = [
+    "こんにちは", "今日は何を作ってるの", "それすごいね", "もう一回見せて", "なるほど",
+    "そのエラー何", "コーヒー飲んでる", "いい感じ", "次はどうするの", "おつかれさま",
+]
+COMMENTS = ["いいね", "草", "なるほど", "すごい", "それな", "わかる", "えっ", "かわいい", "天才か", "おお"]
+
+
+@dataclass
+class MockSettings:
+    # 応答までの遅延（秒）と、その標準偏差
+    latency: float = 0.3
+    jitter: float = 0.1
+    # ストリーミング時のトークン間隔（秒）
+    token_interval: float = 0.02
+    # 500 / 429 を返す確率
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    # 音声認識は別の遅延を設定できる（Noneならlatencyと同じ）
+    transcription_latency: Optional[float] = None
+    seed: Optional[int] = None
+
+
+def _error(status: int, error_type: str, message: str) -> JSONResponse:
+    return JSONResponse(
+        status_code=status,
+        content={"error": {"message": message, "type": error_type, "param": None, "code": None}},
+    )
+
+
+def _fill_schema(schema: Dict[str, Any], rng: random.Random) -> Any:
+    """JSONスキーマを満たす値を作る（構造化出力の応答用）"""
+    if "enum" in schema:
+        return rng.choice(schema["enum"])
+    kind = schema.get("type")
+    if kind == "object":
+        return {name: _fill_schema(prop, rng) for name, prop in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [_fill_schema(schema.get("items", {}), rng)]
+    if kind in ("integer", "number"):
+        return 0
+    if kind == "boolean":
+        return False
+    return rng.choice(COMMENTS)
+
+
+def _has_image(messages) -> bool:
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list) and any(part.get("type") == "image_url" for part in content):
+            return True
+    return False
+
+
+def create_app(settings: MockSettings) -> FastAPI:
+    app = FastAPI()
+    rng = random.Random(settings.seed)
+    ids = itertools.count(1)
+    app.state.settings = settings
+    app.state.requests = {"chat": 0, "transcription": 0, "errors": 0}
+
+    async def delay(base: float):
+        await asyncio.sleep(max(0.0, rng.gauss(base, settings.jitter)))
+
+    def injected_error() -> Optional[JSONResponse]:
+        roll = rng.random()
+        if roll < settings.rate_limit_rate:
+            app.state.requests["errors"] += 1
+            return _error(429, "rate_limit_exceeded", "Rate limit reached (mock)")
+        if roll < settings.rate_limit_rate + settings.error_rate:
+            app.state.requests["errors"] += 1
+            return _error(500, "server_error", "Internal error (mock)")
+        return None
+
+    def chat_content(body: Dict[str, Any]) -> str:
+        response_format = body.get("response_format") or {}
+        if response_format.get("type") == "json_schema":
+            schema = response_format["json_schema"]["schema"]
+            return json.dumps(_fill_schema(schema, rng), ensure_ascii=False)
+        if _has_image(body.get("messages", [])):
+            # 画面・カメラ解析のチェーンモードで1段目に返すJSON
+            return json.dumps({
+                "screen_type": "エディタ",
+                "user_action": "コーディング",
+                "scene_type": "人物",
+                "action": "静止",
+                "content": rng.choice(COMMENTS),
+            }, ensure_ascii=False)
+        # コメントはまとめて生成される（1行に1件）
+        return "\n".join(rng.sample(COMMENTS, 4))
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        app.state.requests["chat"] += 1
+        await delay(settings.latency)
+        error = injected_error()
+        if error is not None:
+            return error
+
+        completion_id = f"chatcmpl-mock-{next(ids)}"
+        created = int(time.time())
+        model = body.get("model", "mock")
+        content = chat_content(body)
+
+        if not body.get("stream"):
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content, "refusal": None},
+                    "finish_reason": "stop",
+                }],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(content), "total_tokens": len(content)},
+            }
+
+        async def events():
+            def chunk(delta: Dict[str, Any], finish_reason: Optional[str] = None) -> str:
+                payload = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+                }
+                return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+            yield chunk({"role": "assistant", "content": ""})
+            for char in content:
+                await asyncio.sleep(settings.token_interval)
+                yield chunk({"content": char})
+            yield chunk({}, "stop")
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.post("/v1/audio/transcriptions")
+    async def transcriptions(request: Request):
+        form = await request.form()
+        app.state.requests["transcription"] += 1
+        await delay(settings.latency if settings.transcription_latency is None else settings.transcription_latency)
+        error = injected_error()
+        if error is not None:
+            return error
+        text = rng.choice(TRANSCRIPTS)
+        if form.get("response_format") == "text":
+            return StreamingResponse(iter([text]), media_type="text/plain")
+        return {"text": text}
+
+    @app.get("/mock/stats")
+    async def stats():
+        return app.state.requests
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI-compatible mock upstream")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--token-interval", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--transcription-latency", type=float, default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    import uvicorn
+
+    settings = MockSettings(
+        latency=args.latency,
+        jitter=args.jitter,
+        token_interval=args.token_interval,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        transcription_latency=args.transcription_latency,
+        seed=args.seed,
+    )
+    uvicorn.run(create_app(settings), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""記録したセッションの再生とステージごとの計測
+
+SESSION_RECORD_DIRを設定したバックエンドが記録した受信データ（app/recorder.py）を、
+同じプロセス内で組み立てた本物のパイプライン（ServiceRegistry → SessionPipeline）に記録時と同じ間隔で流す。
+上流はモック（bench/mock_upstream.py）をASGIのトランスポートで直接呼ぶので、ネットワークもAPIキーも不要。
+
+    # 記録時と同じ速さ・4倍速・待たずに流す
+    python -m bench.replay records/<session_id> --speed 1
+    python -m bench.replay records/<session_id> --speed 4 --output replay.json
+    python -m bench.replay records/<session_id> --speed 0 --baseline replay.json
+
+結果はアプリのメトリクス（ステージごとの所要時間・受信から結果までの時間・破棄/スキップ件数）から集計する。
+封筒付きのデータはキャプチャ時刻を再生時の時刻に書き換えて流すので、受信から結果までの時間は再生時の値になる。
+速さを上げても解析器の間引き間隔などの時間は変わらないので、スキップが増えるのは実際の挙動どおり。
+"""
+import argparse
+import asyncio
+import json
+import struct
+import sys
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from app.connections import ConnectionManager
+from app.metrics import CAPTURE_TO_RESULT, FRAMES_DROPPED, FRAMES_RECEIVED, FRAMES_SKIPPED, STAGE_SECONDS
+from app.protocol import ENVELOPE_MAGIC
+from app.recorder import Recording
+from app.registry import ServiceRegistry
+from app.services.openai_client import OpenAIClientRegistry
+
+from .mock_upstream import MockSettings, create_app
+
+# 封筒のキャプチャ時刻の位置（app/protocol.pyのヘッダーを参照）
+CAPTURED_AT = struct.Struct(">d")
+CAPTURED_AT_OFFSET = 12
+# 再生後、この秒数だけ新しいメッセージが出なければ処理が終わったとみなす（最大drain秒まで待つ）
+SETTLE_SECONDS = 1.0
+
+
+class ReplaySocket:
+    """パイプラインが送るメッセージを数えるだけのWebSocketの代わり"""
+
+    def __init__(self):
+        self.messages: Counter = Counter()
+        self.last_message = time.monotonic()
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text: str):
+        self.messages[text] += 1
+        self.last_message = time.monotonic()
+
+    async def send_json(self, message: Dict[str, Any]):
+        self.messages[message.get("type", "unknown")] += 1
+        self.last_message = time.monotonic()
+
+    async def close(self, code: int = 1000):
+        pass
+
+
+def restamp(data: bytes) -> bytes:
+    """封筒付きのデータのキャプチャ時刻を現在時刻に書き換える（封筒なしのデータはそのまま）"""
+    if data[:2] != ENVELOPE_MAGIC or len(data) < CAPTURED_AT_OFFSET + CAPTURED_AT.size:
+        return data
+    buffer = bytearray(data)
+    CAPTURED_AT.pack_into(buffer, CAPTURED_AT_OFFSET, time.time() * 1000)
+    return bytes(buffer)
+
+
+def histogram_summary(histogram, labels: tuple) -> Optional[Dict[str, float]]:
+    """ヒストグラムの件数・平均と、バケットから求めた分位点（バケットの上限値）"""
+    data = histogram.values.get(labels)
+    if data is None or not data.count:
+        return None
+    summary = {"count": data.count, "mean": data.total / data.count}
+    for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+        cumulative, target = 0, q * data.count
+        for bound, bucket_count in zip(histogram.buckets + (float("inf"),), data.counts):
+            cumulative += bucket_count
+            if cumulative >= target:
+                summary[name] = bound
+                break
+    return summary
+
+
+def collect(elapsed: float, socket: ReplaySocket, mock_app) -> Dict[str, object]:
+    stages = {labels[0]: histogram_summary(STAGE_SECONDS, labels) for labels in STAGE_SECONDS.values}
+    latency = {labels[0]: histogram_summary(CAPTURE_TO_RESULT, labels) for labels in CAPTURE_TO_RESULT.values}
+    frames: Dict[str, Dict[str, Any]] = {}
+    for (modality,), count in FRAMES_RECEIVED.values.items():
+        frames.setdefault(modality, {})["received"] = int(count)
+    for (modality,), count in FRAMES_DROPPED.values.items():
+        frames.setdefault(modality, {})["dropped"] = int(count)
+    for (modality, reason), count in FRAMES_SKIPPED.values.items():
+        frames.setdefault(modality, {}).setdefault("skipped", {})[reason] = int(count)
+    return {
+        "elapsed": elapsed,
+        "stages": stages,
+        "capture_to_result": latency,
+        "frames": frames,
+        "messages": dict(socket.messages),
+        "upstream_requests": dict(mock_app.state.requests),
+    }
+
+
+async def replay(
+    path: str,
+    speed: float,
+    settings: MockSettings,
+    drain: float,
+    limit: Optional[int] = None,
+) -> Dict[str, object]:
+    mock_app = create_app(settings)
+    services = ServiceRegistry()
+    services.provide("openai_clients", OpenAIClientRegistry(
+        api_key="replay", base_url="http://mock-upstream/v1", transport=httpx.ASGITransport(app=mock_app),
+    ))
+    await services.ensure_ready()
+
+    manager = ConnectionManager()
+    socket = ReplaySocket()
+    session = services.new_session()
+    connection = await manager.connect(socket, session.session_id)
+    pipeline = services.new_pipeline(connection, session)
+    pipeline.start()
+
+    loop = asyncio.get_running_loop()
+    with Recording(path) as recording:
+        count = len(recording) if limit is None else min(limit, len(recording))
+        print(f"Replaying {count} messages ({recording.duration:.1f}s recorded) at "
+              f"{'max' if speed <= 0 else f'{speed:g}x'} speed")
+        start = loop.time()
+        for index in range(count):
+            entry = recording[index]
+            if speed > 0:
+                await asyncio.sleep(max(0.0, start + entry.arrival / speed - loop.time()))
+            data = recording.payload(entry)
+            if entry.kind == "text":
+                pipeline.handle_text(data.decode("utf-8", errors="replace"))
+            else:
+                await pipeline.submit(restamp(data))
+            if speed <= 0:
+                # 受信ループと同じく、他のタスクに順番を譲る
+                await asyncio.sleep(0)
+
+    # キューが空になり、しばらく新しいメッセージが出なくなるまで待つ
+    deadline = loop.time() + drain
+    while loop.time() < deadline:
+        busy = (
+            pipeline.screen_queue.qsize() or pipeline.camera_queue.qsize() or pipeline.audio_queue.qsize()
+            or connection.outbound.qsize() or (pipeline.pacer is not None and pipeline.pacer.pending())
+        )
+        if not busy and time.monotonic() - socket.last_message >= SETTLE_SECONDS:
+            break
+        await asyncio.sleep(0.1)
+    elapsed = loop.time() - start
+
+    await pipeline.close()
+    await manager.disconnect(session.session_id)
+    await services.close()
+    return collect(elapsed, socket, mock_app)
+
+
+def compare(current: Dict[str, object], baseline: Dict[str, object], tolerance: float) -> List[str]:
+    """前回の結果と比べて、ステージ・受信から結果までの平均時間の悪化をリストアップ"""
+    regressions = []
+    for section in ("stages", "capture_to_result"):
+        for name, after in current["result"][section].items():
+            before = baseline["result"][section].get(name)
+            if before and after and after["mean"] > before["mean"] * (1 + tolerance):
+                regressions.append(f"{section} {name} mean {before['mean'] * 1000:.1f} -> {after['mean'] * 1000:.1f} ms")
+    return regressions
+
+
+def print_report(result: Dict[str, object]):
+    print(f"elapsed {result['elapsed']:.1f}s, messages {result['messages']}, upstream {result['upstream_requests']}")
+    for section in ("stages", "capture_to_result"):
+        print(f"{section}:")
+        for name, stats in sorted(result[section].items()):
+            if stats:
+                print(f"  {name:<28} n {stats['count']:>5}  mean {stats['mean'] * 1000:8.1f}ms  "
+                      f"p50 <= {stats['p50'] * 1000:7.0f}ms  p95 <= {stats['p95'] * 1000:7.0f}ms")
+    print("frames:")
+    for modality, stats in sorted(result["frames"].items()):
+        print(f"  {modality:<8} {stats}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded session through the pipeline")
+    parser.add_argument("recording", help="記録のパス（拡張子なし、または.rec/.idx）")
+    parser.add_argument("--speed", type=float, default=1.0, help="再生速度の倍率（0以下なら待たずに流す）")
+    parser.add_argument("--limit", type=int, default=None, help="先頭から再生する件数")
+    parser.add_argument("--drain", type=float, default=30.0, help="再生後に処理の完了を待つ最大秒数")
+    parser.add_argument("--output", help="結果を保存するJSONファイル")
+    parser.add_argument("--baseline", help="比較する前回の結果JSON")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="悪化とみなす割合")
+    parser.add_argument("--mock-latency", type=float, default=0.3)
+    parser.add_argument("--mock-jitter", type=float, default=0.1)
+    parser.add_argument("--mock-token-interval", type=float, default=0.02)
+    parser.add_argument("--mock-error-rate", type=float, default=0.0)
+    parser.add_argument("--mock-rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    settings = MockSettings(
+        latency=args.mock_latency,
+        jitter=args.mock_jitter,
+        token_interval=args.mock_token_interval,
+        error_rate=args.mock_error_rate,
+        rate_limit_rate=args.mock_rate_limit_rate,
+        seed=args.seed,
+    )
+    result = asyncio.run(replay(args.recording, args.speed, settings, args.drain, args.limit))
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "result": result,
+    }
+    print_report(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"Saved results to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print("Regressions:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("No regressions against baseline")
+
+
+if __name__ == "__main__":
+    main()
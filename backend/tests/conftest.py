@@ -0,0 +1,5 @@
+import os
+import sys
+
+# backend/ をimportパスに入れる（python -m pytest をどこから実行しても app を読めるように）
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,82 @@
+import numpy as np
+
+from app.services.audio_assembler import AudioAssembler, Utterance, strip_overlap
+from app.services.vad import VADConfig
+
+SAMPLE_RATE = 16000
+VAD = VADConfig()
+
+
+def silence(ms: int, seed: int = 0) -> np.ndarray:
+    return (np.random.RandomState(seed).randn(SAMPLE_RATE * ms // 1000) * 30).astype(np.int16)
+
+
+def speech(ms: int) -> np.ndarray:
+    t = np.arange(SAMPLE_RATE * ms // 1000) / SAMPLE_RATE
+    return (np.sin(2 * np.pi * 220 * t) * 8000 * np.abs(np.sin(2 * np.pi * 2.5 * t))).astype(np.int16)
+
+
+def seconds(utterance: Utterance) -> float:
+    return len(utterance.pcm) / SAMPLE_RATE
+
+
+def test_cuts_at_pause_across_segments():
+    assembler = AudioAssembler(min_utterance_ms=0)
+    # 発話の途中でセグメントが区切られても1つの発話として扱う
+    pcm = np.concatenate([silence(300), speech(2000), silence(1200, seed=1)])
+    utterances = assembler.push(pcm[:SAMPLE_RATE], VAD) + assembler.push(pcm[SAMPLE_RATE:], VAD)
+    assert len(utterances) == 1
+    assert 1.8 <= seconds(utterances[0]) <= 2.6
+    assert not utterances[0].overlaps_previous
+    # 末尾の無音しか残っていない
+    assert assembler.flush(VAD) == []
+
+
+def test_forced_cut_overlaps_next_utterance():
+    assembler = AudioAssembler(min_utterance_ms=0, max_utterance_ms=3000, overlap_ms=300)
+    utterances = assembler.push(np.concatenate([silence(200), speech(4000)]), VAD)
+    assert len(utterances) == 1 and not utterances[0].overlaps_previous
+    assert seconds(utterances[0]) <= 3.0
+
+    rest = assembler.flush(VAD)
+    assert len(rest) == 1 and rest[0].overlaps_previous
+
+
+def test_short_utterances_are_coalesced():
+    assembler = AudioAssembler(min_utterance_ms=1500, max_hold_ms=10000)
+    pcm = np.concatenate([speech(800), silence(1000, seed=1), speech(800), silence(1000, seed=2)])
+    utterances = assembler.push(pcm, VAD)
+    assert len(utterances) == 1
+    assert utterances[0].fragments == 2
+
+
+def test_short_utterance_is_released_after_max_hold():
+    assembler = AudioAssembler(min_utterance_ms=1500, max_hold_ms=1000)
+    assert assembler.push(np.concatenate([speech(800), silence(1000)]), VAD) == []
+    utterances = assembler.push(silence(1200, seed=1), VAD)
+    assert len(utterances) == 1 and utterances[0].fragments == 1
+
+
+def test_flush_returns_buffered_speech():
+    assembler = AudioAssembler(min_utterance_ms=0)
+    assert assembler.push(np.concatenate([silence(200), speech(1500)]), VAD) == []
+    assert assembler.buffered_ms > 0
+    utterances = assembler.flush(VAD)
+    assert len(utterances) == 1
+    assert assembler.buffered_ms == 0
+
+
+def test_strip_overlap():
+    assert strip_overlap("今日はいい天気です", "天気です。明日も晴れ") == "明日も晴れ"
+    assert strip_overlap("hello world", "world, again") == "again"
+    # 1文字だけの一致は重なりとみなさない
+    assert strip_overlap("abc", "cde") == "cde"
+
+
+def test_dedupe_only_strips_overlapping_utterances():
+    assembler = AudioAssembler()
+    pcm = np.zeros(1, dtype=np.int16)
+    assert assembler.dedupe("今日はいい天気です", Utterance(pcm)) == "今日はいい天気です"
+    assert assembler.dedupe("天気ですね", Utterance(pcm)) == "天気ですね"
+    assert assembler.dedupe("ですね、本当に", Utterance(pcm, overlaps_previous=True)) == "本当に"
+    assert assembler.last_text == "本当に"
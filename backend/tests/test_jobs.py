@@ -0,0 +1,181 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import pytest
+
+from app import jobs
+from app.jobs import JobError, JobManager, jpeg_length
+
+
+def encode_jpeg(seed: int = 0) -> bytes:
+    image = np.random.RandomState(seed).randint(0, 256, (48, 64, 3), dtype=np.uint8)
+    ok, encoded = cv2.imencode(".jpg", image)
+    assert ok
+    return encoded.tobytes()
+
+
+def test_jpeg_length_finds_end_of_image():
+    first, second = encode_jpeg(0), encode_jpeg(1)
+    assert jpeg_length(bytearray(first + second)) == len(first)
+
+
+def test_jpeg_length_waits_for_truncated_image():
+    data = encode_jpeg()
+    for size in (2, 100, len(data) - 1):
+        assert jpeg_length(bytearray(data[:size])) == 0
+
+
+def test_jpeg_length_rejects_garbage():
+    with pytest.raises(JobError):
+        jpeg_length(bytearray(b"not a jpeg"))
+    with pytest.raises(JobError):
+        jpeg_length(bytearray(b"\xff\xd8\x00\x00\x00\x00"))
+
+
+class FakeAnalyzer:
+    """画面1枚ごとの解析結果を返す（responsesは時刻 -> 1回目の結果。2回目以降は成功する）"""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.calls = []
+
+    def new_state(self):
+        return SimpleNamespace(session_id=None, last_analysis_time=0.0)
+
+    async def analyze_frame(self, frame, state):
+        t = float(frame.decode())
+        self.calls.append(t)
+        response = self.responses.pop(t, {"success": True, "text": f"comment {t:g}"})
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+class FakeServices:
+    def __init__(self, analyzer):
+        self.screen_analyzer = analyzer
+
+    async def ensure_ready(self):
+        pass
+
+
+@pytest.fixture
+def media(tmp_path, monkeypatch):
+    source = tmp_path / "media" / "video.mp4"
+    source.parent.mkdir()
+    source.write_bytes(b"")
+    monkeypatch.setattr(jobs, "JOB_MEDIA_ROOT", str(source.parent))
+    monkeypatch.setattr(jobs, "JOB_THROTTLE_DELAY", 0.0)
+
+    async def probe_media(path):
+        return 300.0, True, False
+
+    async def extract_frames(path, start, length, interval):
+        # 画面の代わりに時刻を渡す（区間の長さはJOB_CHUNK_SECONDSの120秒なので、10秒ごとに間引く）
+        for t in np.arange(start, start + length, 10.0):
+            yield float(t), f"{t:g}".encode()
+
+    monkeypatch.setattr(jobs, "probe_media", probe_media)
+    monkeypatch.setattr(jobs, "extract_frames", extract_frames)
+    return source
+
+
+def submit_and_wait(manager: JobManager, submit):
+    async def scenario():
+        job = submit()
+        await manager.tasks[job.job_id]
+        return job
+    return asyncio.run(scenario())
+
+
+def read_timeline(manager: JobManager, job_id: str):
+    with open(manager.timeline_path(job_id)) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_job_writes_timeline_in_chunk_order(tmp_path, media):
+    analyzer = FakeAnalyzer({
+        130.0: {"success": False, "text": "", "error": {"type": "throttled", "message": ""}},
+    })
+    manager = JobManager(FakeServices(analyzer), root=str(tmp_path / "jobs"), concurrency=2)
+    job = submit_and_wait(manager, lambda: manager.submit_path("video.mp4", audio=False))
+
+    assert job.status == "completed"
+    assert (job.chunks_total, sorted(job.chunks_done)) == (3, [0, 1, 2])
+    timeline = read_timeline(manager, job.job_id)
+    assert [entry["t"] for entry in timeline] == [float(t) for t in range(0, 300, 10)]
+    # 混雑で見送られた画面は再試行する
+    assert analyzer.calls.count(130.0) == 2
+    assert job.stats == {"comments": 30}
+
+
+def test_result_without_error_does_not_fail_job(tmp_path, media):
+    # JSONの解析に失敗した結果はerrorを持たない
+    analyzer = FakeAnalyzer({20.0: {"success": False, "text": "```"}})
+    manager = JobManager(FakeServices(analyzer), root=str(tmp_path / "jobs"))
+    job = submit_and_wait(manager, lambda: manager.submit_path("video.mp4", audio=False))
+    assert job.status == "completed"
+    assert job.stats["unknown"] == 1
+
+
+def test_resume_skips_finished_chunks(tmp_path, media):
+    analyzer = FakeAnalyzer({130.0: RuntimeError("boom")})
+    manager = JobManager(FakeServices(analyzer), root=str(tmp_path / "jobs"), concurrency=1)
+    job = submit_and_wait(manager, lambda: manager.submit_path("video.mp4", audio=False))
+    assert job.status == "failed"
+    assert job.chunks_done == [0]
+
+    analyzer.calls.clear()
+    job = submit_and_wait(manager, lambda: manager.resume(job.job_id))
+    assert job.status == "completed"
+    assert min(analyzer.calls) == 120.0
+    assert len(read_timeline(manager, job.job_id)) == 30
+
+    # 保存した状態から読み直しても同じ
+    reloaded = JobManager(FakeServices(analyzer), root=str(tmp_path / "jobs")).get(job.job_id)
+    assert (reloaded.status, sorted(reloaded.chunks_done)) == ("completed", [0, 1, 2])
+
+
+class FakeUpload:
+    def __init__(self, data: bytes, filename: str = "video.mp4"):
+        self.data = data
+        self.filename = filename
+        self.offset = 0
+
+    async def read(self, size: int) -> bytes:
+        block = self.data[self.offset:self.offset + size]
+        self.offset += len(block)
+        return block
+
+
+def test_upload_is_saved_and_processed(tmp_path, media):
+    manager = JobManager(FakeServices(FakeAnalyzer({})), root=str(tmp_path / "jobs"))
+    data = bytes(range(256)) * 10000
+
+    async def scenario():
+        job = await manager.submit_upload(FakeUpload(data), audio=False)
+        await manager.tasks[job.job_id]
+        return job
+
+    job = asyncio.run(scenario())
+    assert job.source.endswith("source.mp4")
+    with open(job.source, "rb") as f:
+        assert f.read() == data
+    assert job.status == "completed"
+
+
+def test_oversized_upload_is_removed(tmp_path, media, monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_MAX_UPLOAD_BYTES", 1024 * 1024)
+    manager = JobManager(FakeServices(FakeAnalyzer({})), root=str(tmp_path / "jobs"))
+
+    async def scenario():
+        with pytest.raises(JobError) as info:
+            await manager.submit_upload(FakeUpload(b"\0" * (3 * 1024 * 1024)))
+        return info.value.error_type
+
+    assert asyncio.run(scenario()) == "too_large"
+    assert manager.list_jobs() == []
+    assert not any((tmp_path / "jobs").iterdir())
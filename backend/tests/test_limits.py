@@ -0,0 +1,48 @@
+from app.limits import ByteBudget
+
+
+def test_acquire_up_to_limit():
+    budget = ByteBudget(100)
+    assert budget.try_acquire(60)
+    assert not budget.try_acquire(41)
+    assert budget.try_acquire(40)
+    assert budget.used == 100
+
+
+def test_release_is_clamped_to_used():
+    budget = ByteBudget(100)
+    budget.try_acquire(30)
+    budget.release(50)
+    assert budget.used == 0
+
+
+def test_child_counts_against_parent():
+    parent = ByteBudget(100)
+    first = ByteBudget(80, parent)
+    second = ByteBudget(80, parent)
+    assert first.try_acquire(70)
+    # 自分の上限には収まっても、親の上限を超える分は断る（親にも数えない）
+    assert not second.try_acquire(40)
+    assert (second.used, parent.used) == (0, 70)
+    assert second.try_acquire(30)
+    assert parent.used == 100
+
+    first.release(20)
+    assert (first.used, parent.used) == (50, 80)
+
+
+def test_child_limit_is_checked_before_parent():
+    parent = ByteBudget(100)
+    child = ByteBudget(10, parent)
+    assert not child.try_acquire(20)
+    assert parent.used == 0
+
+
+def test_close_returns_everything_to_parent():
+    parent = ByteBudget(100)
+    child = ByteBudget(80, parent)
+    other = ByteBudget(80, parent)
+    child.try_acquire(50)
+    other.try_acquire(10)
+    child.close()
+    assert (child.used, parent.used) == (0, 10)
@@ -0,0 +1,129 @@
+import asyncio
+import selectors
+import time
+
+import numpy as np
+import pytest
+
+from app import pipeline as pipeline_module
+from app.pipeline import SessionPipeline
+from app.protocol import Frame, encode_envelope
+from app.services.audio_assembler import AudioAssembler
+from app.services.rate_governor import RateGovernor
+from app.services.vad import VADConfig
+from app.session import AnalyzerState, SessionState
+
+JPEG = b"\xff\xd8\xff\xe0" + b"\x00" * 32
+
+
+class FakeConnection:
+    def __init__(self):
+        self.outbound: asyncio.Queue = asyncio.Queue()
+
+    async def send(self, message):
+        await self.outbound.put(message)
+
+
+def make_pipeline(audio_service=None, assembler=None) -> SessionPipeline:
+    session = SessionState(AnalyzerState(6), AnalyzerState(6), VADConfig(), audio=assembler)
+    return SessionPipeline(FakeConnection(), session, audio_service, None, None, RateGovernor(), pacing=False)
+
+
+@pytest.mark.parametrize("skew", [-30.0, 30.0])
+def test_capture_latency_corrects_client_clock_skew(skew, monkeypatch):
+    observed = []
+    monkeypatch.setattr(pipeline_module.CAPTURE_TO_RESULT, "observe", lambda value, *labels: observed.append(value))
+
+    async def scenario():
+        pipeline = make_pipeline()
+        # クライアントの時計はサーバーよりskew秒進んでいる（負なら遅れている）
+        client_now = (time.time() + skew) * 1000
+        await pipeline.submit(encode_envelope("camera", "jpeg", JPEG, sequence=1, captured_at=client_now))
+        pipeline._observe_latency(Frame("camera", "jpeg", JPEG, sequence=2, captured_at=client_now - 500))
+        await pipeline.close()
+
+    asyncio.run(scenario())
+    assert observed == [pytest.approx(0.5, abs=0.1)]
+
+
+class _VirtualSelector(selectors.DefaultSelector):
+    """待つ代わりにイベントループの時計を進める"""
+
+    def __init__(self, loop: "VirtualClockLoop"):
+        super().__init__()
+        self.loop = loop
+
+    def select(self, timeout=None):
+        events = super().select(0)
+        if not events and timeout:
+            self.loop.now += timeout
+        return events
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    """asyncio.sleep・wait_forのタイムアウトを実時間を待たずに進めるイベントループ"""
+
+    def __init__(self):
+        self.now = 0.0
+        super().__init__(_VirtualSelector(self))
+
+    def time(self) -> float:
+        return self.now
+
+
+SAMPLE_RATE = 16000
+WEBM_MAGIC = b"\x1a\x45\xdf\xa3"
+
+
+def silence(ms: int, seed: int = 0) -> np.ndarray:
+    return (np.random.RandomState(seed).randn(SAMPLE_RATE * ms // 1000) * 30).astype(np.int16)
+
+
+def speech(ms: int) -> np.ndarray:
+    t = np.arange(SAMPLE_RATE * ms // 1000) / SAMPLE_RATE
+    return (np.sin(2 * np.pi * 220 * t) * 8000 * np.abs(np.sin(2 * np.pi * 2.5 * t))).astype(np.int16)
+
+
+class FakeAudioService:
+    """WebMの代わりにマジックの後ろにPCMをそのまま載せたセグメントを受け取る"""
+
+    def __init__(self):
+        self.transcribed = []
+
+    async def assemble(self, audio_data, assembler, vad_config):
+        pcm = np.frombuffer(bytes(audio_data)[len(WEBM_MAGIC):], dtype=np.int16)
+        return assembler.push(pcm, vad_config)
+
+    async def transcribe_audio(self, utterance, vad_config, on_delta=None, session_id=None, assembler=None):
+        self.transcribed.append(len(utterance.pcm) / SAMPLE_RATE)
+        return {"success": True, "text": f"utterance {len(self.transcribed)}"}
+
+
+def test_utterance_spanning_segments_is_transcribed_once():
+    audio_service = FakeAudioService()
+    # フロントエンドと同じく10秒ごとにセグメントを送り、2つ目の途中まで続く発話を1つ目の末尾で始める
+    segments = [
+        np.concatenate([silence(7000), speech(3000)]),
+        np.concatenate([speech(2000), silence(8000, seed=1)]),
+        silence(10000, seed=2),
+    ]
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        pipeline = make_pipeline(audio_service, AudioAssembler(min_utterance_ms=0))
+        worker = asyncio.create_task(pipeline._audio_worker())
+        for segment in segments:
+            await asyncio.sleep(10.0)
+            await pipeline.submit(WEBM_MAGIC + segment.tobytes())
+        await asyncio.sleep(60.0)
+        worker.cancel()
+        await pipeline.close()
+        return loop.time(), pipeline.segment_interval
+
+    with asyncio.Runner(loop_factory=VirtualClockLoop) as runner:
+        elapsed, interval = runner.run(scenario())
+
+    assert elapsed >= 90.0
+    assert interval == pytest.approx(10.0)
+    assert len(audio_service.transcribed) == 1
+    assert 4.5 <= audio_service.transcribed[0] <= 6.0
@@ -0,0 +1,79 @@
+import struct
+
+import pytest
+
+from app.protocol import (
+    HEADER_SIZE,
+    ProtocolError,
+    detect_modality,
+    encode_envelope,
+    parse_frame,
+    sniff_codec,
+)
+
+JPEG = b"\xff\xd8\xff\xe0" + b"\x00" * 16
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 16
+WEBM = b"\x1a\x45\xdf\xa3" + b"\x00" * 16
+WEBP = b"RIFF\x00\x00\x00\x00WEBP" + b"\x00" * 8
+
+
+def test_envelope_round_trip():
+    data = encode_envelope("screen", "png", PNG, stream_id=7, sequence=42, captured_at=1234.5)
+    frame = parse_frame(data)
+    assert (frame.modality, frame.codec, frame.stream_id, frame.sequence, frame.captured_at) == (
+        "screen", "png", 7, 42, 1234.5,
+    )
+    assert bytes(frame.payload) == PNG
+
+
+def test_envelope_modality_overrides_codec():
+    # 封筒があればコーデックに関係なくヘッダーのモダリティを使う
+    frame = parse_frame(encode_envelope("camera", "png", PNG))
+    assert frame.modality == "camera"
+
+
+def test_truncated_envelope_is_rejected():
+    data = encode_envelope("audio", "webm", WEBM)
+    with pytest.raises(ProtocolError):
+        parse_frame(data[:HEADER_SIZE - 1])
+
+
+def test_unknown_version_is_rejected():
+    data = bytearray(encode_envelope("audio", "webm", WEBM))
+    data[2] = 99
+    with pytest.raises(ProtocolError):
+        parse_frame(bytes(data))
+
+
+def test_unknown_modality_is_rejected():
+    data = bytearray(encode_envelope("audio", "webm", WEBM))
+    struct.pack_into(">B", data, 3, 9)
+    with pytest.raises(ProtocolError):
+        parse_frame(bytes(data))
+
+
+@pytest.mark.parametrize("data, codec, modality", [
+    (JPEG, "jpeg", "camera"),
+    (PNG, "png", "screen"),
+    (WEBM, "webm", "audio"),
+    (WEBP, "webp", "screen"),
+])
+def test_legacy_sniffing(data, codec, modality):
+    assert sniff_codec(data) == codec
+    assert detect_modality(data) == modality
+    frame = parse_frame(data)
+    assert (frame.modality, frame.codec, frame.sequence, frame.captured_at) == (modality, codec, None, None)
+
+
+def test_unknown_data_is_none():
+    assert parse_frame(b"hello world") is None
+    assert parse_frame(b"") is None
+
+
+def test_envelope_payload_is_not_copied():
+    data = encode_envelope("camera", "jpeg", JPEG)
+    frame = parse_frame(data)
+    assert isinstance(frame.payload, memoryview)
+    assert frame.payload.obj is data
+
+
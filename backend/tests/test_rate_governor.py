@@ -0,0 +1,145 @@
+import asyncio
+
+import openai
+
+from app.services.rate_governor import PRIORITY_AUDIO, PRIORITY_CAMERA, PRIORITY_SCREEN, RateGovernor
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_token_bucket_refills_at_rate():
+    clock = FakeClock()
+    governor = RateGovernor(rate=2.0, burst=3, clock=clock)
+    for _ in range(3):
+        assert governor._can_grant()
+        governor._grant("s")
+        governor.inflight -= 1
+    assert not governor._can_grant()
+    clock.now = 0.5
+    governor._refill()
+    assert governor._can_grant()
+    clock.now = 100.0
+    governor._refill()
+    # バーストを超えては溜まらない
+    assert governor.tokens == 3
+
+
+def test_concurrency_limit():
+    async def scenario():
+        governor = RateGovernor(rate=1000.0, burst=1000, max_concurrency=2)
+        running, peak = 0, 0
+
+        async def call():
+            nonlocal running, peak
+            async with governor.slot(PRIORITY_AUDIO, "s"):
+                running += 1
+                peak = max(peak, running)
+                await asyncio.sleep(0.01)
+                running -= 1
+
+        await asyncio.gather(*(call() for _ in range(6)))
+        return peak, governor.inflight
+
+    assert asyncio.run(scenario()) == (2, 0)
+
+
+async def _order_of_grants(requests):
+    """同時実行数1の枠を1件占有したまま、requests [(priority, session)] を待たせ、通った順を返す"""
+    governor = RateGovernor(rate=1000.0, burst=1000, max_concurrency=1)
+    order = []
+    release = asyncio.Event()
+
+    async def hold():
+        async with governor.slot(PRIORITY_AUDIO, "holder"):
+            await release.wait()
+
+    async def call(priority, session_id, label):
+        async with governor.slot(priority, session_id):
+            order.append(label)
+
+    holder = asyncio.create_task(hold())
+    await asyncio.sleep(0)
+    tasks = []
+    for label, (priority, session_id) in enumerate(requests):
+        tasks.append(asyncio.create_task(call(priority, session_id, label)))
+        await asyncio.sleep(0)
+    release.set()
+    await asyncio.gather(holder, *tasks)
+    return order
+
+
+def test_higher_priority_is_served_first():
+    order = asyncio.run(_order_of_grants([(PRIORITY_CAMERA, "a"), (PRIORITY_SCREEN, "b"), (PRIORITY_AUDIO, "c")]))
+    assert order == [2, 1, 0]
+
+
+def test_sessions_are_served_fairly_within_a_priority():
+    # aが3件先に並んでも、bの1件目はaの2件目より先に通る
+    order = asyncio.run(_order_of_grants([(PRIORITY_SCREEN, "a")] * 3 + [(PRIORITY_SCREEN, "b")]))
+    assert order.index(3) < order.index(1)
+
+
+def test_cancelled_waiter_is_removed():
+    async def scenario():
+        governor = RateGovernor(rate=1000.0, burst=1000, max_concurrency=1)
+        release = asyncio.Event()
+
+        async def hold():
+            async with governor.slot(PRIORITY_AUDIO, "holder"):
+                await release.wait()
+
+        async def wait():
+            async with governor.slot(PRIORITY_SCREEN, "s"):
+                pass
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(wait())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        release.set()
+        await holder
+        return len(governor.waiters), governor.inflight
+
+    assert asyncio.run(scenario()) == (0, 0)
+
+
+def _rate_limit_error() -> openai.RateLimitError:
+    import httpx
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    return openai.RateLimitError("rate limited", response=httpx.Response(429, request=request), body=None)
+
+
+def test_rate_limit_halves_rate_and_success_restores_it():
+    async def scenario():
+        governor = RateGovernor(rate=10.0, burst=100)
+        try:
+            async with governor.slot(PRIORITY_AUDIO, "s"):
+                raise _rate_limit_error()
+        except openai.RateLimitError:
+            pass
+        reduced = governor.rate
+        pressure = governor.pressure()
+        for _ in range(20):
+            async with governor.slot(PRIORITY_AUDIO, "s"):
+                pass
+        return reduced, pressure, governor.rate
+
+    reduced, pressure, restored = asyncio.run(scenario())
+    assert reduced == 5.0
+    assert pressure == 0.5
+    assert restored == 10.0
+
+
+def test_rate_never_drops_below_a_tenth():
+    governor = RateGovernor(rate=10.0)
+    for _ in range(10):
+        governor._on_rate_limited()
+    assert governor.rate == 1.0
@@ -0,0 +1,65 @@
+import pytest
+
+from app.protocol import encode_envelope
+from app.recorder import ENTRY_SIZE, FILE_HEADER_SIZE, Recording, RecordingError, SessionRecorder
+
+JPEG = b"\xff\xd8\xff\xe0" + b"\x00" * 32
+
+
+def record(path, messages, max_bytes=1024 * 1024):
+    recorder = SessionRecorder(str(path), max_bytes=max_bytes)
+    for data, kind in messages:
+        recorder.append(data, kind)
+    recorder.close()
+    return recorder
+
+
+def test_round_trip(tmp_path):
+    frame = encode_envelope("camera", "jpeg", JPEG, sequence=1)
+    config = b'{"type": "config"}'
+    record(tmp_path / "s", [(frame, "camera"), (config, "text")])
+
+    with Recording(str(tmp_path / "s.rec")) as recording:
+        entries = list(recording)
+        assert len(recording) == 2
+        assert [entry.kind for entry in entries] == ["camera", "text"]
+        assert recording.payload(entries[0]) == frame
+        assert recording.payload(recording[-1]) == config
+        assert recording.duration == entries[-1].arrival >= entries[0].arrival
+
+
+def test_max_bytes_stops_recording(tmp_path):
+    recorder = record(tmp_path / "s", [(b"a" * 60, "audio"), (b"b" * 60, "audio"), (b"c", "audio")], max_bytes=100)
+    assert recorder.entries == 1
+    with Recording(str(tmp_path / "s")) as recording:
+        assert len(recording) == 1
+
+
+def test_truncated_data_drops_trailing_entries(tmp_path):
+    record(tmp_path / "s", [(b"a" * 10, "audio"), (b"b" * 10, "audio"), (b"c" * 10, "audio")])
+    # 書き込み途中で終了した場合（.recの末尾のデータが欠けている）
+    data = (tmp_path / "s.rec").read_bytes()
+    (tmp_path / "s.rec").write_bytes(data[:-15])
+
+    with Recording(str(tmp_path / "s")) as recording:
+        assert len(recording) == 1
+        assert recording.payload(recording[0]) == b"a" * 10
+        with pytest.raises(IndexError):
+            recording[1]
+
+
+def test_partial_index_entry_is_ignored(tmp_path):
+    record(tmp_path / "s", [(b"a" * 10, "audio"), (b"b" * 10, "audio")])
+    index = (tmp_path / "s.idx").read_bytes()
+    assert len(index) == FILE_HEADER_SIZE + 2 * ENTRY_SIZE
+    (tmp_path / "s.idx").write_bytes(index[:-ENTRY_SIZE // 2])
+
+    with Recording(str(tmp_path / "s")) as recording:
+        assert [recording.payload(entry) for entry in recording] == [b"a" * 10]
+
+
+def test_invalid_header_raises(tmp_path):
+    record(tmp_path / "s", [])
+    (tmp_path / "s.rec").write_bytes(b"JUNK" + b"\x00" * 12)
+    with pytest.raises(RecordingError):
+        Recording(str(tmp_path / "s"))
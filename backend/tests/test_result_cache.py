@@ -0,0 +1,88 @@
+import numpy as np
+
+from app.services.result_cache import ResultCache, image_cache_key, normalize_text, transcript_cache_key
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_miss_until_min_variants():
+    cache = ResultCache(min_variants=2, max_variants=3)
+    cache.put("k", "a")
+    assert cache.get("k") is None
+    cache.put("k", "b")
+    assert cache.get("k") in ("a", "b")
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+
+def test_identical_results_hit_after_max_variants_puts():
+    # 同じ結果しか返ってこなくても、max_variants回生成したらヒットにする
+    cache = ResultCache(min_variants=2, max_variants=3)
+    for _ in range(2):
+        cache.put("k", "a")
+    assert cache.get("k") is None
+    cache.put("k", "a")
+    assert cache.get("k") == "a"
+
+
+def test_does_not_repeat_last_served_variant():
+    cache = ResultCache(min_variants=2, max_variants=3)
+    cache.put("k", "a")
+    cache.put("k", "b")
+    served = [cache.get("k") for _ in range(10)]
+    assert all(x != y for x, y in zip(served, served[1:]))
+
+
+def test_oldest_variant_is_dropped():
+    cache = ResultCache(min_variants=1, max_variants=2)
+    for value in ("a", "b", "c"):
+        cache.put("k", value)
+    assert {cache.get("k") for _ in range(10)} == {"b", "c"}
+
+
+def test_entries_expire_after_ttl():
+    clock = FakeClock()
+    cache = ResultCache(ttl=10.0, min_variants=1, clock=clock)
+    cache.put("k", "a")
+    clock.now = 9.9
+    assert cache.get("k") == "a"
+    clock.now = 10.0
+    assert cache.get("k") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_put_after_expiry_starts_a_new_entry():
+    clock = FakeClock()
+    cache = ResultCache(ttl=10.0, min_variants=2, max_variants=3, clock=clock)
+    cache.put("k", "a")
+    clock.now = 20.0
+    cache.put("k", "b")
+    # 期限切れの"a"は引き継がない
+    assert cache.get("k") is None
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResultCache(max_entries=2, min_variants=1)
+    cache.put("a", "1")
+    cache.put("b", "2")
+    assert cache.get("a") == "1"
+    cache.put("c", "3")
+    assert cache.get("b") is None
+    assert cache.get("a") == "1" and cache.get("c") == "3"
+    assert cache.stats()["evictions"] == 1
+
+
+def test_transcript_keys_ignore_width_case_and_punctuation():
+    assert normalize_text("Ｈｅｌｌｏ、 World！") == normalize_text("hello world")
+    assert transcript_cache_key("すごい！") == transcript_cache_key("すごい。")
+
+
+def test_image_keys_are_per_analyzer():
+    frame_hash = np.array([True, False] * 128)
+    assert image_cache_key("screen", frame_hash) != image_cache_key("camera", frame_hash)
+    assert image_cache_key("screen", frame_hash) == image_cache_key("screen", frame_hash.copy())
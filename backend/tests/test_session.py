@@ -0,0 +1,36 @@
+from app.services.vad import VADConfig
+from app.session import COMMENT_HISTORY_SIZE, MAX_COMMENT_LENGTH, AnalyzerState, SessionState
+
+
+def test_comment_history_is_bounded_and_clipped():
+    state = AnalyzerState(change_threshold=6)
+    for i in range(COMMENT_HISTORY_SIZE + 5):
+        state.add_comment(f"{i}" + "あ" * MAX_COMMENT_LENGTH)
+    assert len(state.comment_history) == COMMENT_HISTORY_SIZE
+    assert all(len(comment) == MAX_COMMENT_LENGTH for comment in state.comment_history)
+    assert state.last_comment().startswith(str(COMMENT_HISTORY_SIZE + 4))
+
+
+def test_record_result_clips_text():
+    state = AnalyzerState(change_threshold=6)
+    state.record_result({"success": True, "text": "x" * 1000}, 12.0)
+    assert len(state.last_result["text"]) == MAX_COMMENT_LENGTH
+    assert state.last_analysis_time == 12.0
+
+
+def test_sessions_do_not_share_state():
+    first = SessionState(AnalyzerState(6), AnalyzerState(6), VADConfig())
+    second = SessionState(AnalyzerState(6), AnalyzerState(6), VADConfig())
+    first.screen.add_comment("hello")
+    assert second.screen.last_comment() == "なし"
+    assert first.session_id != second.session_id
+    assert first.screen.session_id == first.session_id
+
+
+def test_release_clears_state():
+    session = SessionState(AnalyzerState(6), AnalyzerState(6), VADConfig())
+    session.camera.add_comment("hello")
+    session.camera.record_result({"success": True, "text": "hello"}, 1.0)
+    session.release()
+    assert session.camera.last_result is None
+    assert not session.camera.comment_history
@@ -0,0 +1,143 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import httpx
+import openai
+import pytest
+
+from app.services.rate_governor import PRIORITY_SCREEN, RateGovernor
+from app.services.upstream_guard import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, UpstreamGuard, UpstreamUnavailable
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_breaker_opens_after_threshold_and_half_opens_after_cooldown():
+    clock = FakeClock()
+    breaker = CircuitBreaker("m", failure_threshold=3, cooldown=10.0, clock=clock)
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.state == CLOSED and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN and breaker.is_open() and not breaker.allow()
+
+    clock.now = 10.0
+    assert not breaker.is_open()
+    assert breaker.allow() and breaker.state == HALF_OPEN
+    # 試しの呼び出しは1件だけ
+    assert not breaker.allow() and breaker.is_open()
+    breaker.record_success()
+    assert breaker.state == CLOSED and breaker.failures == 0
+
+
+def test_failed_probe_reopens():
+    clock = FakeClock()
+    breaker = CircuitBreaker("m", failure_threshold=1, cooldown=5.0, clock=clock)
+    breaker.record_failure()
+    clock.now = 5.0
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN and breaker.opened_at == 5.0
+
+
+def test_released_probe_allows_another():
+    clock = FakeClock()
+    breaker = CircuitBreaker("m", failure_threshold=1, cooldown=5.0, clock=clock)
+    breaker.record_failure()
+    clock.now = 5.0
+    assert breaker.allow()
+    breaker.release_probe()
+    assert breaker.allow()
+
+
+def test_success_resets_consecutive_failures():
+    breaker = CircuitBreaker("m", failure_threshold=2)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+
+
+@asynccontextmanager
+async def slow_slot(seconds: float):
+    # プロセス内のレート制御で枠を待つ時間
+    await asyncio.sleep(seconds)
+    yield
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_local_wait_does_not_count_against_the_deadline():
+    async def scenario():
+        guard = UpstreamGuard(deadlines={"vision_call": 0.1}, failure_threshold=1)
+        async with guard.call("m", "vision_call", slow_slot(0.06)):
+            await asyncio.sleep(0.06)
+        return guard.breaker("m").state
+
+    assert run(scenario()) == CLOSED
+
+
+def test_local_wait_timeout_does_not_trip_the_breaker():
+    async def scenario():
+        guard = UpstreamGuard(deadlines={"vision_call": 0.05}, failure_threshold=1)
+        with pytest.raises(UpstreamUnavailable) as info:
+            async with guard.call("m", "vision_call", slow_slot(1.0)):
+                pass
+        return info.value.reason, guard.breaker("m").state
+
+    assert run(scenario()) == ("local_wait", CLOSED)
+
+
+def test_upstream_deadline_trips_the_breaker():
+    async def scenario():
+        guard = UpstreamGuard(deadlines={"vision_call": 0.05}, failure_threshold=1)
+        with pytest.raises(UpstreamUnavailable) as info:
+            async with guard.call("m", "vision_call", slow_slot(0.0)):
+                await asyncio.sleep(1.0)
+        return info.value.reason, guard.breaker("m").state
+
+    assert run(scenario()) == ("deadline_exceeded", OPEN)
+
+
+def test_open_circuit_fails_fast():
+    async def scenario():
+        guard = UpstreamGuard(failure_threshold=1)
+        guard.breaker("m").record_failure()
+        with pytest.raises(UpstreamUnavailable) as info:
+            async with guard.call("m", "vision_call"):
+                pass
+        return info.value.reason
+
+    assert run(scenario()) == "circuit_open"
+
+
+def test_request_errors_are_not_upstream_failures():
+    async def scenario():
+        guard = UpstreamGuard(failure_threshold=1)
+        with pytest.raises(ValueError):
+            async with guard.call("m", "vision_call"):
+                raise ValueError("bad request")
+        return guard.breaker("m").state
+
+    assert run(scenario()) == CLOSED
+
+
+def test_rate_limit_reaches_governor_and_counts_as_upstream_failure():
+    async def scenario():
+        governor = RateGovernor(rate=10.0, burst=100)
+        guard = UpstreamGuard(failure_threshold=1)
+        request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+        error = openai.RateLimitError("rate limited", response=httpx.Response(429, request=request), body=None)
+        with pytest.raises(UpstreamUnavailable) as info:
+            async with guard.call("m", "vision_call", governor.slot(PRIORITY_SCREEN, "s")):
+                raise error
+        return info.value.reason, governor.rate, guard.breaker("m").state
+
+    assert run(scenario()) == ("RateLimitError", 5.0, OPEN)
@@ -0,0 +1,74 @@
+import json
+
+import numpy as np
+import pytest
+
+from app.services.vad import OVERRIDE_RANGES, VADConfig, VoiceActivityDetector
+
+SAMPLE_RATE = 16000
+
+
+def silence(ms: int, seed: int = 0) -> np.ndarray:
+    return (np.random.RandomState(seed).randn(SAMPLE_RATE * ms // 1000) * 30).astype(np.int16)
+
+
+def speech(ms: int) -> np.ndarray:
+    # 音節のように振幅が揺れる声（一定の純音だとノイズフロアの推定に紛れる）
+    t = np.arange(SAMPLE_RATE * ms // 1000) / SAMPLE_RATE
+    return (np.sin(2 * np.pi * 220 * t) * 8000 * np.abs(np.sin(2 * np.pi * 2.5 * t))).astype(np.int16)
+
+
+def test_overrides_cast_known_fields_and_ignore_others():
+    config = VADConfig().with_overrides({"hangover_ms": "400", "enabled": 0, "unknown": 1})
+    assert config.hangover_ms == 400
+    assert config.enabled is False
+
+
+@pytest.mark.parametrize("frame_ms", [0, -30])
+def test_non_positive_frame_ms_is_rejected(frame_ms):
+    with pytest.raises(ValueError):
+        VADConfig().with_overrides({"frame_ms": frame_ms})
+
+
+@pytest.mark.parametrize("key", ["zcr_threshold", "noise_margin_db"])
+def test_non_finite_values_are_rejected(key):
+    with pytest.raises(ValueError):
+        VADConfig().with_overrides({key: float("nan")})
+
+
+@pytest.mark.parametrize("key", ["frame_ms", "hangover_ms"])
+def test_infinite_int_values_are_rejected(key):
+    # JSONのInfinityはfloat("inf")になる（int()に渡すとOverflowError）
+    message = json.loads('{"type": "config", "vad": {"%s": Infinity}}' % key)
+    with pytest.raises(ValueError):
+        VADConfig().with_overrides(message["vad"])
+
+
+def test_non_numeric_values_are_rejected():
+    with pytest.raises(ValueError):
+        VADConfig().with_overrides({"hangover_ms": "long"})
+
+
+@pytest.mark.parametrize("key", sorted(OVERRIDE_RANGES))
+def test_values_are_clamped_to_range(key):
+    lower, upper = OVERRIDE_RANGES[key]
+    assert getattr(VADConfig().with_overrides({key: upper * 10 + 1000}), key) == upper
+    if key != "frame_ms":
+        assert getattr(VADConfig().with_overrides({key: lower - 1000}), key) == lower
+
+
+def test_extreme_overrides_still_trim():
+    config = VADConfig().with_overrides({"frame_ms": 1, "hangover_ms": -5, "padding_ms": 10 ** 9})
+    pcm = np.concatenate([silence(500), speech(1000), silence(500)])
+    assert VoiceActivityDetector(config).trim(pcm, SAMPLE_RATE) is not None
+
+
+def test_trim_removes_leading_and_trailing_silence():
+    pcm = np.concatenate([silence(1000), speech(1000), silence(1000)])
+    trimmed = VoiceActivityDetector(VADConfig()).trim(pcm, SAMPLE_RATE)
+    assert trimmed is not None
+    assert len(speech(1000)) <= len(trimmed) < len(pcm) * 0.6
+
+
+def test_silence_is_none():
+    assert VoiceActivityDetector(VADConfig()).trim(silence(2000), SAMPLE_RATE) is None
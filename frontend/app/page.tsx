@@ -12,17 +12,51 @@ export default function Home() {
   const wsManager = WebSocketManager.getInstance();
 
   useEffect(() => {
+    const currentTimestamp = () => new Date().toLocaleTimeString([], {
+      hour: '2-digit',
+      minute: '2-digit'
+    });
+
     const handleMessage = (data: WebSocketMessage) => {
-      if (data.type === 'message' && data.text) {
-        const newComment: Comment = {
-          id: Date.now(),
-          text: data.text,
-          timestamp: new Date().toLocaleTimeString([], { 
-            hour: '2-digit', 
-            minute: '2-digit' 
-          })
-        };
-        setComments(prev => [...prev, newComment]);
+      if (data.type === 'delta' && data.id && data.text) {
+        // 生成途中のコメントに差分を追記する
+        const delta = data.text;
+        setComments(prev => {
+          const index = prev.findIndex(comment => comment.messageId === data.id);
+          if (index === -1) {
+            return [...prev, {
+              id: Date.now(),
+              text: delta,
+              timestamp: currentTimestamp(),
+              messageId: data.id,
+              streaming: true
+            }];
+          }
+          const next = [...prev];
+          next[index] = { ...next[index], text: next[index].text + delta };
+          return next;
+        });
+      } else if (data.type === 'message' && data.text) {
+        const text = data.text;
+        setComments(prev => {
+          // ストリーミング済みのコメントは最終テキストで置き換える
+          const index = data.id ? prev.findIndex(comment => comment.messageId === data.id) : -1;
+          if (index !== -1) {
+            const next = [...prev];
+            next[index] = { ...next[index], text, streaming: false };
+            return next;
+          }
+          const newComment: Comment = {
+            id: Date.now(),
+            text,
+            timestamp: currentTimestamp(),
+            messageId: data.id
+          };
+          return [...prev, newComment];
+        });
+      } else if (data.type === 'error' && data.id) {
+        // 生成途中で失敗したコメントは取り除く
+        setComments(prev => prev.filter(comment => comment.messageId !== data.id));
       }
     };
 
@@ -31,7 +31,7 @@ export default function AudioRecorder() {
         recorder.ondataavailable = (event) => {
             if (event.data.size > 0) {
                 console.log("Received segment, size:", event.data.size);
-                wsManager.sendMessage(event.data);
+                wsManager.sendMessage(event.data, 'audio');
             }
         };
         recorder.onerror = (event) => {
@@ -63,6 +63,7 @@ export default function AudioRecorder() {
                 },
             });
             streamRef.current = stream;
+            wsManager.startStream('audio');
 
             // 新しい MediaRecorder を作成して開始
             const recorder = createNewRecorder(stream);
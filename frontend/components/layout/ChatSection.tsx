@@ -24,6 +24,17 @@ interface ChatSectionProps {
 
 export default function ChatSection({ comments }: ChatSectionProps) {
   const chatEndRef = useRef<HTMLDivElement>(null);
+  // ストリーミングで再描画されても名前と色が変わらないようにコメントごとに保持する
+  const authorsRef = useRef<Map<number, { name: string; color: string }>>(new Map());
+
+  const getAuthor = (commentId: number) => {
+    let author = authorsRef.current.get(commentId);
+    if (!author) {
+      author = { name: generateRandomName(), color: generateRandomColor() };
+      authorsRef.current.set(commentId, author);
+    }
+    return author;
+  };
 
   // 新しいコメントが追加されたら自動スクロール
   useEffect(() => {
@@ -42,10 +53,8 @@ export default function ChatSection({ comments }: ChatSectionProps) {
 
       <div className="h-[calc(100%-4rem)] overflow-y-auto space-y-4 pr-2">
         {comments.map((comment) => {
-          // ランダムな名前を生成
-          const randomName = generateRandomName();
-          // ランダムな色を生成
-          const randomColor = generateRandomColor();
+          // ランダムな名前と色（コメントごとに固定）
+          const { name: randomName, color: randomColor } = getAuthor(comment.id);
 
           return (
             <div key={comment.id} className="flex items-start space-x-2 hover:bg-gray-700/50 p-2 rounded">
@@ -60,7 +69,10 @@ export default function ChatSection({ comments }: ChatSectionProps) {
                   <span className="text-sm font-semibold">{randomName}</span>
                   <span className="text-xs text-gray-400">{comment.timestamp}</span>
                 </div>
-                <p className="text-sm mt-1">{comment.text}</p>
+                <p className="text-sm mt-1">
+                  {comment.text}
+                  {comment.streaming && <span className="animate-pulse text-gray-400">▍</span>}
+                </p>
               </div>
             </div>
           );
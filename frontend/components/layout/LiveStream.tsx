@@ -16,6 +16,9 @@ export default function LiveStream() {
     error?: { message: string };
   } | null>(null);
   const wsManager = WebSocketManager.getInstance();
+  // キャプチャ間隔（サーバーからのcontrolメッセージで混雑時に延長される）
+  const screenIntervalRef = useRef<number>(2000);
+  const cameraIntervalRef = useRef<number>(3000);
 
   const startCameraStream = async () => {
     if (mediaStream) {
@@ -68,9 +71,11 @@ export default function LiveStream() {
     const canvas = document.createElement('canvas');
     const ctx = canvas.getContext('2d');
     const video = videoRef.current;
-    let intervalId: NodeJS.Timeout;
+    let timeoutId: NodeJS.Timeout | null = null;
+    let stopped = false;
+    wsManager.startStream('screen');
 
-    intervalId = setInterval(() => {
+    const capture = () => {
       if (video && ctx) {
         // キャプチャサイズを制限して転送データを削減
         const maxWidth = 1280;
@@ -78,17 +83,25 @@ export default function LiveStream() {
         canvas.width = video.videoWidth * scale;
         canvas.height = video.videoHeight * scale;
         ctx.drawImage(video, 0, 0, canvas.width, canvas.height);
+        const capturedAt = Date.now();
+        // PNGは1280pxだと大きすぎるのでWebPで送る（非対応のブラウザではPNGになり、blob.typeで判別される）
         canvas.toBlob((blob) => {
           if (blob) {
-            wsManager.sendMessage(blob);
+            wsManager.sendMessage(blob, 'screen', capturedAt);
           }
-        }, 'image/png', 0.8);  // 品質を80%に設定
+        }, 'image/webp', 0.8);  // 品質を80%に設定
       }
-    }, 2000); // 2秒ごとにキャプチャ
+      // 次のキャプチャは現在の間隔で予約（既定は2秒ごと）
+      if (!stopped) {
+        timeoutId = setTimeout(capture, screenIntervalRef.current);
+      }
+    };
+    timeoutId = setTimeout(capture, screenIntervalRef.current);
 
     return () => {
-      if (intervalId) {
-        clearInterval(intervalId);
+      stopped = true;
+      if (timeoutId) {
+        clearTimeout(timeoutId);
       }
     };
   };
@@ -97,9 +110,11 @@ export default function LiveStream() {
     const canvas = document.createElement('canvas');
     const ctx = canvas.getContext('2d');
     const video = videoRef.current;
-    let intervalId: NodeJS.Timeout;
+    let timeoutId: NodeJS.Timeout | null = null;
+    let stopped = false;
+    wsManager.startStream('camera');
 
-    intervalId = setInterval(() => {
+    const capture = () => {
       if (video && ctx) {
         // キャプチャサイズを制限して転送データを削減
         const maxWidth = 640;  // カメラ映像は小さめに
@@ -107,17 +122,24 @@ export default function LiveStream() {
         canvas.width = video.videoWidth * scale;
         canvas.height = video.videoHeight * scale;
         ctx.drawImage(video, 0, 0, canvas.width, canvas.height);
+        const capturedAt = Date.now();
         canvas.toBlob((blob) => {
           if (blob) {
-            wsManager.sendMessage(blob);
+            wsManager.sendMessage(blob, 'camera', capturedAt);
           }
         }, 'image/jpeg', 0.7);  // JPEGで品質70%
       }
-    }, 3000); // 3秒ごとにキャプチャ
+      // 次のキャプチャは現在の間隔で予約（既定は3秒ごと）
+      if (!stopped) {
+        timeoutId = setTimeout(capture, cameraIntervalRef.current);
+      }
+    };
+    timeoutId = setTimeout(capture, cameraIntervalRef.current);
 
     return () => {
-      if (intervalId) {
-        clearInterval(intervalId);
+      stopped = true;
+      if (timeoutId) {
+        clearTimeout(timeoutId);
       }
     };
   };
@@ -151,6 +173,14 @@ export default function LiveStream() {
       // 画面解析とカメラ解析の結果を処理
       if (data.type === 'screen_analysis' || data.type === 'camera_analysis') {
         setAnalysisResult(data.data);
+      } else if (data.type === 'control' && data.action === 'capture_interval') {
+        // サーバーが混雑しているときは送信頻度を下げる
+        if (data.screen_interval_ms) {
+          screenIntervalRef.current = data.screen_interval_ms;
+        }
+        if (data.camera_interval_ms) {
+          cameraIntervalRef.current = data.camera_interval_ms;
+        }
       }
     };
     
@@ -1,6 +1,15 @@
 export type WebSocketMessage = {
-    type: 'message' | 'error' | 'screen_analysis';
+    type: 'message' | 'delta' | 'control' | 'error' | 'screen_analysis';
     text?: string;
+    // ストリーミング時にdeltaと最終メッセージを対応付けるID
+    id?: string;
+    final?: boolean;
+    // 封筒付きで送ったデータに対する結果の場合、そのシーケンス番号
+    seq?: number;
+    // サーバーの混雑時に送られるキャプチャ間隔の変更指示
+    action?: 'capture_interval';
+    screen_interval_ms?: number;
+    camera_interval_ms?: number;
     error?: {
         type: string;
         message: string;
@@ -19,4 +28,7 @@ export type Comment = {
   id: number;
   text: string;
   timestamp: string;
+  // ストリーミング中のコメントのID（サーバーのメッセージID）
+  messageId?: string;
+  streaming?: boolean;
 }; 
\ No newline at end of file
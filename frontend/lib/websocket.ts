@@ -1,11 +1,31 @@
 import { WebSocketMessage } from './types';
 import { ChatStore } from './chatStore';
 
+// コメントを生成途中から逐次受信する（サーバー側はconfigメッセージで有効化）
+const STREAM_COMMENTS = true;
+
+// バイナリデータの封筒（backend/app/protocol.py と同じ形式、20バイトのヘッダー + ペイロード）
+const ENVELOPE_MAGIC = [0x53, 0x43]; // "SC"
+const ENVELOPE_VERSION = 1;
+const ENVELOPE_HEADER_SIZE = 20;
+const MODALITY_IDS = { screen: 1, camera: 2, audio: 3 } as const;
+const CODEC_IDS: Record<string, number> = {
+    'image/png': 1,
+    'image/jpeg': 2,
+    'image/webp': 3,
+    'audio/webm': 4,
+};
+
+export type Modality = keyof typeof MODALITY_IDS;
+
 export default class WebSocketManager {
     private static instance: WebSocketManager;
     private ws: WebSocket | null = null;
     private messageHandlers: ((data: any) => void)[] = [];
     private chatStore: ChatStore;
+    // モダリティごとのストリームIDとシーケンス番号
+    private streamIds: Record<Modality, number> = { screen: 0, camera: 0, audio: 0 };
+    private sequences: Record<Modality, number> = { screen: 0, camera: 0, audio: 0 };
 
     private constructor() {
         this.chatStore = ChatStore.getInstance();
@@ -15,6 +35,9 @@ export default class WebSocketManager {
 
         this.ws.onopen = () => {
             console.log('WebSocket connection established');
+            if (STREAM_COMMENTS) {
+                this.sendMessage(JSON.stringify({ type: 'config', stream: true }));
+            }
         };
 
         this.ws.onerror = (error) => {
@@ -42,10 +65,39 @@ export default class WebSocketManager {
         this.messageHandlers = this.messageHandlers.filter(h => h !== handler);
     }
 
-    public sendMessage(message: string | Blob) {
-        if (this.ws && this.ws.readyState === WebSocket.OPEN) {
+    // キャプチャを開始し直すときに呼ぶ（シーケンス番号を振り直す）
+    public startStream(modality: Modality) {
+        this.streamIds[modality] = (this.streamIds[modality] + 1) & 0xffff;
+        this.sequences[modality] = 0;
+    }
+
+    // modalityを指定したBlobは封筒に入れて送る（モダリティ・コーデック・シーケンス番号・キャプチャ時刻付き）
+    public sendMessage(message: string | Blob, modality?: Modality, capturedAt: number = Date.now()) {
+        if (!this.ws || this.ws.readyState !== WebSocket.OPEN) {
+            return;
+        }
+        if (typeof message === 'string' || !modality) {
+            this.ws.send(message);
+            return;
+        }
+        const codec = CODEC_IDS[message.type.split(';')[0].trim()];
+        if (!codec) {
+            // 封筒で表せない形式はそのまま送る（サーバー側で先頭バイトから判別）
             this.ws.send(message);
+            return;
         }
+        const header = new DataView(new ArrayBuffer(ENVELOPE_HEADER_SIZE));
+        header.setUint8(0, ENVELOPE_MAGIC[0]);
+        header.setUint8(1, ENVELOPE_MAGIC[1]);
+        header.setUint8(2, ENVELOPE_VERSION);
+        header.setUint8(3, MODALITY_IDS[modality]);
+        header.setUint8(4, codec);
+        header.setUint8(5, 0);
+        header.setUint16(6, this.streamIds[modality]);
+        header.setUint32(8, this.sequences[modality]);
+        header.setFloat64(12, capturedAt);
+        this.sequences[modality] = (this.sequences[modality] + 1) >>> 0;
+        this.ws.send(new Blob([header.buffer, message]));
     }
 
     close() {
@@ -64,7 +116,9 @@ export default class WebSocketManager {
                     const data = JSON.parse(event.data);
                     console.log('WebSocket parsed message:', data);
     
-                    if (data.type === 'message') {
+                    if (data.type === 'delta') {
+                        // 生成途中の差分はハンドラー側で組み立てる
+                    } else if (data.type === 'message') {
                         // コメントを追加
                         this.chatStore.addMessage(data.text);
                         console.log('Comment added:', data.text); // 追加されたコメントをログに表示